@@ -0,0 +1,182 @@
+"""
+Mask R-CNN
+Anchor cache.
+
+The anchors of a config only depend on the anchor scales and ratios, the
+backbone shapes and strides, and the anchor stride. They are generated once
+per process and, if a cache directory is given, once per machine: stored
+as a .npy file that other processes (e.g. DataLoader workers) memory map
+instead of building their own copy.
+
+Usage:
+
+    import anchors as anchorlib
+    anchors = anchorlib.get_anchors(config)
+    anchors.boxes    # [N, (y1, x1, y2, x2)]
+"""
+
+import collections
+import hashlib
+import os
+
+import numpy as np
+
+import utils
+
+
+# Bump when the layout of the cached arrays changes
+CACHE_VERSION = 1
+
+# Anchors generated in this process, by key()
+_anchors = {}
+
+
+# Anchors of one level of the pyramid are a lattice: rows of the feature map
+# (every anchor_stride), then columns, then one anchor per ratio. Anchor i of
+# the level has the center
+#     y = (i // (columns * ratios)) * stride, x = (i // ratios % columns) * stride
+# where stride = feature_stride * anchor_stride, and size heights/widths[i % ratios].
+PyramidLevel = collections.namedtuple(
+    "PyramidLevel", ["start", "end", "rows", "columns", "stride", "heights", "widths"])
+
+
+class Anchors(object):
+    """Anchors of all levels of the pyramid with their geometry precomputed.
+    data: [N, (y1, x1, y2, x2, center_y, center_x, height, width, area)]
+    levels: list of PyramidLevel, where the anchors of each level are.
+    """
+
+    def __init__(self, data, levels):
+        self.data = data
+        self.levels = levels
+
+        # Views into data, no copies
+        self.boxes = data[:, 0:4]
+        self.centers = data[:, 4:6]
+        self.sizes = data[:, 6:8]
+        self.areas = data[:, 8]
+
+    @property
+    def shape(self):
+        return self.boxes.shape
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def overlapping(self, boxes):
+        """Finds the anchors that may overlap the given boxes from the lattice
+        of each level, without computing any overlap. On each level, only
+        the anchors centered within half the largest anchor of the level
+        from a box can overlap it.
+        boxes: [N, (y1, x1, y2, x2)] in pixels.
+        Returns the sorted indices of the anchors. All anchors not in it
+        have an IoU of 0 with all the boxes.
+        """
+        # Mark the anchors rather than collect and sort their indices, boxes
+        # often share anchors.
+        overlapping = np.zeros([len(self)], dtype=bool)
+        for level in self.levels:
+            ratios = len(level.heights)
+            # [rows, columns, ratios] view of the anchors of the level
+            lattice = overlapping[level.start:level.end].reshape(level.rows, level.columns, ratios)
+            half_height = level.heights.max() / 2
+            half_width = level.widths.max() / 2
+            for y1, x1, y2, x2 in boxes:
+                # Rows and columns of the lattice, rounded outwards
+                r1 = max(int(np.floor((y1 - half_height) / level.stride)), 0)
+                r2 = min(int(np.ceil((y2 + half_height) / level.stride)), level.rows - 1)
+                c1 = max(int(np.floor((x1 - half_width) / level.stride)), 0)
+                c2 = min(int(np.ceil((x2 + half_width) / level.stride)), level.columns - 1)
+                lattice[r1:r2 + 1, c1:c2 + 1] = True
+        return np.nonzero(overlapping)[0]
+
+
+def key(scales, ratios, feature_shapes, feature_strides, anchor_stride):
+    """Hashable key of the anchors of a config."""
+    return (tuple(float(s) for s in scales),
+            tuple(float(r) for r in ratios),
+            tuple(tuple(int(d) for d in shape) for shape in feature_shapes),
+            tuple(int(s) for s in feature_strides[:len(scales)]),
+            int(anchor_stride))
+
+
+def pyramid_levels(scales, ratios, feature_shapes, feature_strides, anchor_stride):
+    """Layout of the anchors of utils.generate_pyramid_anchors().
+    Returns a list of PyramidLevel, one per scale.
+    """
+    ratios = np.array(ratios, dtype=np.float64)
+    levels = []
+    start = 0
+    for i, scale in enumerate(scales):
+        rows = len(range(0, feature_shapes[i][0], anchor_stride))
+        columns = len(range(0, feature_shapes[i][1], anchor_stride))
+        end = start + rows * columns * len(ratios)
+        levels.append(PyramidLevel(start, end, rows, columns, feature_strides[i] * anchor_stride,
+                                   scale / np.sqrt(ratios), scale * np.sqrt(ratios)))
+        start = end
+    return levels
+
+
+def pack_anchors(boxes):
+    """Precomputes the geometry of the anchors.
+    boxes: [N, (y1, x1, y2, x2)]
+    Returns [N, (y1, x1, y2, x2, center_y, center_x, height, width, area)]
+    """
+    # Same arithmetic as build_rpn_targets and compute_overlaps used to
+    # do on the fly, so the values are bit for bit the same.
+    sizes = boxes[:, 2:4] - boxes[:, 0:2]
+    centers = boxes[:, 0:2] + 0.5 * sizes
+    areas = sizes[:, 0] * sizes[:, 1]
+    return np.concatenate([boxes, centers, sizes, areas[:, np.newaxis]], axis=1)
+
+
+def generate_pyramid_anchors(scales, ratios, feature_shapes, feature_strides,
+                             anchor_stride, cache_dir=None):
+    """Cached version of utils.generate_pyramid_anchors().
+    cache_dir: Optional directory where the anchors are stored and memory
+        mapped from, to share them between processes.
+    Returns an Anchors object.
+    """
+    anchors_key = key(scales, ratios, feature_shapes, feature_strides, anchor_stride)
+    if anchors_key in _anchors:
+        return _anchors[anchors_key]
+
+    levels = pyramid_levels(scales, ratios, feature_shapes, feature_strides, anchor_stride)
+    data = None
+    if cache_dir:
+        digest = hashlib.sha1(repr((CACHE_VERSION, anchors_key)).encode()).hexdigest()[:16]
+        path = os.path.join(cache_dir, "anchors_{}.npy".format(digest))
+        if os.path.exists(path):
+            data = np.load(path, mmap_mode="r")
+            if data.shape != (levels[-1].end, 9):
+                # Left over by an interrupted or different run, rebuild it
+                data = None
+
+    if data is None:
+        boxes = utils.generate_pyramid_anchors(scales, ratios, feature_shapes,
+                                               feature_strides, anchor_stride)
+        data = pack_anchors(boxes)
+        if cache_dir:
+            # Write to a temporary file and rename, so concurrent processes
+            # never map a partially written file.
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp_path, "wb") as f:
+                np.save(f, data)
+            os.replace(tmp_path, path)
+            data = np.load(path, mmap_mode="r")
+
+    anchors = Anchors(data, levels)
+    _anchors[anchors_key] = anchors
+    return anchors
+
+
+def get_anchors(config):
+    """Returns the Anchors of the config. See generate_pyramid_anchors()."""
+    return generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
+                                    config.RPN_ANCHOR_RATIOS,
+                                    config.BACKBONE_SHAPES,
+                                    config.BACKBONE_STRIDES,
+                                    config.RPN_ANCHOR_STRIDE,
+                                    cache_dir=config.ANCHOR_CACHE_DIR)
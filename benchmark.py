@@ -0,0 +1,664 @@
+"""
+Mask R-CNN
+Micro-benchmarks of the hot spots of the pipeline.
+
+Usage: run from the command line as such:
+
+    # Tiled NMS against the one-box-at-a-time loop (and the compiled NMS
+    # if it is built) on proposal_layer sized inputs
+    python3 benchmark.py nms
+
+    # PyTorch crop and resize against the C extension (if it is built),
+    # forward and backward, on classifier head sized inputs
+    python3 benchmark.py roi_align
+
+    # Multi-level ROI pooling of the heads: the per-level loop followed by
+    # a sort against the fused single pass
+    python3 benchmark.py roi_pyramid
+
+    # RPN targets over the anchors that can overlap the GT boxes against
+    # over all anchors, on ISIC like images with a lesion or two
+    python3 benchmark.py rpn_targets
+
+    # Broadcast compute_overlaps against one column at a time, anchors
+    # against --boxes GT boxes
+    python3 benchmark.py overlaps --boxes 10
+
+    # extract_bboxes of all instances at once against one at a time
+    python3 benchmark.py bboxes
+
+    # Image and mask resizing of load_image_gt with each resize backend,
+    # against PIL, the backend with the results of scipy.misc.imresize
+    python3 benchmark.py resize
+
+    # Batched unmold_masks against unmold_mask one detection at a time, on
+    # a 4000x6000 image, for each mask format
+    python3 benchmark.py unmold --boxes 20
+
+    # refine_detections with one batched NMS against one NMS per class,
+    # with the 81 classes of COCO and the 2 of ISIC
+    python3 benchmark.py refine_detections
+
+    # Inference in float32 against bfloat16 autocast (MIXED_PRECISION),
+    # speed and drift of the features, detections and masks, with random
+    # weights or trained ones
+    python3 benchmark.py precision --boxes 1 --weights logs/isic.../mask_rcnn_isic_0200.pth
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+import anchors as anchorlib
+import model as modellib
+import utils
+from config import Config
+from nms import nms_wrapper
+from nms.py_nms import py_nms
+from roialign import roi_align
+from roialign.roi_align import crop_and_resize_torch
+
+
+############################################################
+#  Helpers
+############################################################
+
+def timeit(fn, *args, repeat=5):
+    """Runs fn(*args) repeat times and returns the last result and the
+    best time in seconds.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.time()
+        result = fn(*args)
+        best = min(best, time.time() - start)
+    return result, best
+
+
+def random_proposals(count, image_size=1024, clusters=20, seed=0):
+    """Generates boxes and scores that look like the pre-NMS proposals of
+    proposal_layer: boxes clustered around a few objects, so most of them
+    overlap, clipped to the image.
+    Returns [count, (y1, x1, y2, x2, score)] float tensor.
+    """
+    rng = np.random.RandomState(seed)
+    centers = rng.uniform(0, image_size, (clusters, 2))
+    sizes = rng.uniform(32, 512, (clusters, 2))
+    ix = rng.randint(0, clusters, count)
+    center = centers[ix] + rng.normal(0, 0.1, (count, 2)) * sizes[ix]
+    size = sizes[ix] * rng.uniform(0.5, 1.5, (count, 2))
+    boxes = np.concatenate([center - size / 2, center + size / 2], axis=1)
+    boxes = np.clip(boxes, 0, image_size)
+    scores = rng.uniform(0, 1, (count, 1))
+    return torch.from_numpy(np.concatenate([boxes, scores], axis=1)).float()
+
+
+############################################################
+#  NMS
+############################################################
+
+def naive_nms(dets, thresh):
+    """Greedy NMS one box at a time, as in nms/src/nms.c. Only the
+    overlaps of the current box with the remaining ones are vectorized.
+    """
+    y1, x1, y2, x2, scores = dets.unbind(1)
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    order = scores.sort(0, descending=True)[1]
+    suppressed = torch.zeros(dets.size(0), dtype=torch.bool)
+
+    keep = []
+    for _i in range(order.size(0)):
+        i = order[_i]
+        if suppressed[i]:
+            continue
+        keep.append(int(i))
+        rest = order[_i + 1:]
+        h = (torch.min(y2[i], y2[rest]) - torch.max(y1[i], y1[rest]) + 1).clamp(min=0)
+        w = (torch.min(x2[i], x2[rest]) - torch.max(x1[i], x1[rest]) + 1).clamp(min=0)
+        inter = h * w
+        ovr = inter / (areas[i] + areas[rest] - inter)
+        suppressed[rest[ovr >= thresh]] = True
+    return torch.LongTensor(keep)
+
+
+def benchmark_nms(args):
+    print("NMS on {} boxes, threshold {}".format(args.boxes, args.threshold))
+    dets = random_proposals(args.boxes)
+
+    naive_keep, naive_time = timeit(naive_nms, dets, args.threshold, repeat=args.repeat)
+    print("{:20} {:8.2f} ms  {} kept".format("naive loop", naive_time * 1000, naive_keep.size(0)))
+
+    for tile_size in [128, 256, 512, 1024]:
+        keep, t = timeit(py_nms, dets, args.threshold, tile_size, repeat=args.repeat)
+        print("{:20} {:8.2f} ms  {} kept  x{:.1f}  same output: {}".format(
+            "tiled ({})".format(tile_size), t * 1000, keep.size(0), naive_time / t,
+            torch.equal(keep, naive_keep)))
+
+    if nms_wrapper.pth_nms is not None:
+        keep, t = timeit(nms_wrapper.pth_nms, dets, args.threshold, repeat=args.repeat)
+        print("{:20} {:8.2f} ms  {} kept  x{:.1f}  same output: {}".format(
+            "compiled", t * 1000, keep.size(0), naive_time / t,
+            torch.equal(keep.long(), naive_keep)))
+    else:
+        print("Compiled NMS is not built, skipping it.")
+
+
+############################################################
+#  Crop and resize
+############################################################
+
+def benchmark_roi_align(args):
+    rng = np.random.RandomState(0)
+    image = torch.from_numpy(rng.normal(0, 1, (1, 256, 256, 256))).float()
+    y1x1 = rng.uniform(-0.1, 0.9, (args.boxes, 2))
+    boxes = torch.from_numpy(np.concatenate([y1x1, y1x1 + rng.uniform(0.01, 0.3, (args.boxes, 2))], axis=1)).float()
+    box_ind = torch.zeros(args.boxes).int()
+    print("Crop and resize of {} boxes to 7x7 on a {} feature map".format(args.boxes, list(image.size())))
+
+    def forward_backward(crop):
+        features = image.clone().requires_grad_()
+        crops = crop(features, boxes, box_ind)
+        crops.backward(torch.ones_like(crops))
+        return crops.detach(), features.grad
+
+    torch_crop = lambda *inputs: crop_and_resize_torch.crop_and_resize(*inputs, 7, 7, 0)
+    (crops, grad), t = timeit(forward_backward, torch_crop, repeat=args.repeat)
+    print("{:20} {:8.2f} ms".format("torch", t * 1000))
+
+    if "ext" in roi_align.available_backends():
+        ext_crop = lambda *inputs: roi_align.crop_and_resize_ext.CropAndResizeFunction(7, 7, 0)(*inputs)
+        (ext_crops, ext_grad), t = timeit(forward_backward, ext_crop, repeat=args.repeat)
+        print("{:20} {:8.2f} ms  max crop diff: {:.2e}  max grad diff: {:.2e}".format(
+            "ext", t * 1000, (crops - ext_crops).abs().max(), (grad - ext_grad).abs().max()))
+    else:
+        print("Crop and resize extension is not built, skipping it.")
+
+    # Numerical check of the autograd gradient on a small problem
+    small_image = torch.randn(2, 3, 9, 11, dtype=torch.double, requires_grad=True)
+    small_boxes = torch.tensor([[0.1, 0.2, 0.8, 0.9], [-0.2, 0.3, 0.6, 1.2]], dtype=torch.double)
+    small_ind = torch.tensor([0, 1])
+    ok = torch.autograd.gradcheck(
+        lambda x: crop_and_resize_torch.crop_and_resize(x, small_boxes, small_ind, 5, 4), (small_image,))
+    print("Gradient check: {}".format("passed" if ok else "failed"))
+
+
+############################################################
+#  Multi-level ROI pooling
+############################################################
+
+def sorted_roi_align(feature_maps, boxes, box_ind, levels, pool_size):
+    """Per-level pooling followed by a sort back to box order, as
+    pyramid_roi_align used to do.
+    """
+    pooled = []
+    box_to_level = []
+    for i in range(len(feature_maps)):
+        ix = torch.nonzero(levels == i)[:, 0]
+        if not ix.size(0):
+            continue
+        box_to_level.append(ix)
+        pooled.append(crop_and_resize_torch.crop_and_resize(
+            feature_maps[i], boxes[ix], box_ind[ix], pool_size, pool_size))
+    pooled = torch.cat(pooled, dim=0)
+    _, order = torch.sort(torch.cat(box_to_level, dim=0))
+    return pooled[order]
+
+
+def benchmark_roi_pyramid(args):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    image_shape = [1024, 1024, 3]
+    feature_maps = [torch.randn(1, 256, 1024 // stride, 1024 // stride, device=device)
+                    for stride in [4, 8, 16, 32]]
+    rng = np.random.RandomState(0)
+    y1x1 = rng.uniform(0, 0.9, (args.boxes, 2))
+    hw = rng.uniform(16, 600, (args.boxes, 2)) / 1024
+    boxes = torch.from_numpy(np.concatenate([y1x1, y1x1 + hw], axis=1)).float().to(device)
+    box_ind = torch.zeros(args.boxes, dtype=torch.long, device=device)
+    print("Pooling {} boxes over P2-P5 of a 1024x1024 image on {}".format(args.boxes, device))
+
+    def sync(fn, *inputs):
+        result = fn(*inputs)
+        if device == "cuda":
+            torch.cuda.synchronize()
+        return result
+
+    levels = modellib.ROIPyramid(feature_maps).levels(boxes, image_shape)
+    reference, t = timeit(sync, sorted_roi_align, feature_maps, boxes, box_ind, levels, 7,
+                          repeat=args.repeat)
+    print("{:20} {:8.2f} ms".format("loop and sort", t * 1000))
+
+    for fused in [False, True]:
+        def pool():
+            # Level assignment and the channels last copy are done once per
+            # forward pass and shared by both heads, so they are timed here
+            # too.
+            pyramid = modellib.ROIPyramid(feature_maps, fused=fused)
+            return modellib.pyramid_roi_align(pyramid, boxes, box_ind, 7, image_shape)
+        pooled, t = timeit(sync, pool, repeat=args.repeat)
+        print("{:20} {:8.2f} ms  max diff: {:.2e}".format(
+            "fused" if fused else "level scatter", t * 1000, (pooled - reference).abs().max()))
+
+
+############################################################
+#  RPN targets
+############################################################
+
+class BenchmarkConfig(Config):
+    NAME = "benchmark"
+    NUM_CLASSES = 2
+
+
+class DenseAnchors(anchorlib.Anchors):
+    """Anchors that consider every anchor as overlapping, to compute the
+    RPN targets over all of them as before.
+    """
+
+    def overlapping(self, boxes):
+        return np.arange(len(self))
+
+
+def random_lesions(rng, count, image_size=1024):
+    """GT boxes [count, (y1, x1, y2, x2)] of lesions of 50 to 800 pixels."""
+    size = rng.uniform(50, 800, (count, 2))
+    y1x1 = rng.uniform(0, 1, (count, 2)) * (image_size - size)
+    return np.concatenate([y1x1, y1x1 + size], axis=1).astype(np.int32)
+
+
+def benchmark_rpn_targets(args):
+    config = BenchmarkConfig()
+    anchors = anchorlib.get_anchors(config)
+    dense_anchors = DenseAnchors(anchors.data, anchors.levels)
+    rng = np.random.RandomState(0)
+    samples = [random_lesions(rng, rng.randint(1, 3)) for _ in range(args.boxes)]
+    print("RPN targets of {} images with {} anchors".format(args.boxes, len(anchors)))
+
+    def build(anchors):
+        # Same seed for both so they subsample the same anchors
+        np.random.seed(0)
+        return [modellib.build_rpn_targets(config.IMAGE_SHAPE, anchors, np.ones(gt_boxes.shape[0], np.int32),
+                                           gt_boxes, config)
+                for gt_boxes in samples]
+
+    dense, dense_time = timeit(build, dense_anchors, repeat=args.repeat)
+    print("{:20} {:8.2f} ms per image".format("all anchors", dense_time * 1000 / args.boxes))
+    sparse, t = timeit(build, anchors, repeat=args.repeat)
+    same = all(np.array_equal(m1, m2) and np.array_equal(b1, b2) for (m1, b1), (m2, b2) in zip(dense, sparse))
+    print("{:20} {:8.2f} ms per image  x{:.1f}  same output: {}".format(
+        "overlapping anchors", t * 1000 / args.boxes, dense_time / t, same))
+
+
+############################################################
+#  Boxes
+############################################################
+
+def loop_compute_overlaps(boxes1, boxes2):
+    """compute_overlaps one column at a time, as it used to be."""
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    overlaps = np.zeros((boxes1.shape[0], boxes2.shape[0]))
+    for i in range(overlaps.shape[1]):
+        overlaps[:, i] = utils.compute_iou(boxes2[i], boxes1, area2[i], area1)
+    return overlaps
+
+
+def loop_extract_bboxes(mask):
+    """extract_bboxes one instance at a time, as it used to be."""
+    boxes = np.zeros([mask.shape[-1], 4], dtype=np.int32)
+    for i in range(mask.shape[-1]):
+        m = mask[:, :, i]
+        horizontal_indicies = np.where(np.any(m, axis=0))[0]
+        vertical_indicies = np.where(np.any(m, axis=1))[0]
+        if horizontal_indicies.shape[0]:
+            x1, x2 = horizontal_indicies[[0, -1]]
+            y1, y2 = vertical_indicies[[0, -1]]
+            x2 += 1
+            y2 += 1
+        else:
+            x1, x2, y1, y2 = 0, 0, 0, 0
+        boxes[i] = np.array([y1, x1, y2, x2])
+    return boxes
+
+
+def benchmark_overlaps(args):
+    anchors = anchorlib.get_anchors(BenchmarkConfig()).boxes
+    gt_boxes = random_lesions(np.random.RandomState(0), args.boxes)
+    print("Overlaps of {} anchors with {} GT boxes".format(anchors.shape[0], args.boxes))
+
+    reference, loop_time = timeit(loop_compute_overlaps, anchors, gt_boxes, repeat=args.repeat)
+    print("{:20} {:8.2f} ms".format("column loop", loop_time * 1000))
+    for max_elements in [2 ** 12, 2 ** 16, 2 ** 20, 2 ** 24]:
+        overlaps, t = timeit(utils.compute_overlaps, anchors, gt_boxes, None, max_elements,
+                             repeat=args.repeat)
+        print("{:20} {:8.2f} ms  x{:.1f}  same output: {}".format(
+            "chunks of 2**{}".format(int(np.log2(max_elements))), t * 1000, loop_time / t,
+            np.array_equal(overlaps, reference)))
+
+
+def benchmark_bboxes(args):
+    # Full size ISIC like masks: large blobs
+    rng = np.random.RandomState(0)
+    mask = np.zeros([1024, 1024, args.boxes], dtype=bool)
+    y, x = np.mgrid[:1024, :1024]
+    for i in range(args.boxes):
+        cy, cx, r = rng.randint(100, 924, 2).tolist() + [rng.randint(20, 300)]
+        mask[:, :, i] = (y - cy) ** 2 + (x - cx) ** 2 < r ** 2
+    print("Boxes of {} instances of {}x{} masks".format(args.boxes, mask.shape[0], mask.shape[1]))
+
+    reference, loop_time = timeit(loop_extract_bboxes, mask, repeat=args.repeat)
+    print("{:20} {:8.2f} ms".format("instance loop", loop_time * 1000))
+    boxes, t = timeit(utils.extract_bboxes, mask, repeat=args.repeat)
+    print("{:20} {:8.2f} ms  x{:.1f}  same output: {}".format(
+        "all instances", t * 1000, loop_time / t, np.array_equal(boxes, reference)))
+
+
+def benchmark_resize(args):
+    import scipy.ndimage
+
+    # An ISIC like image and full size masks, resized to IMAGE_MAX_DIM
+    rng = np.random.RandomState(0)
+    image = (rng.rand(767, 1022, 3) * 255).astype(np.uint8)
+    mask = np.zeros([767, 1022, args.boxes], dtype=bool)
+    y, x = np.mgrid[:767, :1022]
+    for i in range(args.boxes):
+        cy, cx, r = rng.randint(100, 667, 2).tolist() + [rng.randint(20, 300)]
+        mask[:, :, i] = (y - cy) ** 2 + (x - cx) ** 2 < r ** 2
+    config = BenchmarkConfig()
+    print("Resize of a {}x{} image and {} masks to {}".format(
+        image.shape[0], image.shape[1], args.boxes, config.IMAGE_MAX_DIM))
+
+    resize = lambda: utils.resize_image(image, config.IMAGE_MIN_DIM, config.IMAGE_MAX_DIM, True)
+    _, _, scale, padding = resize()
+    reference, zoom_time = timeit(scipy.ndimage.zoom, mask, [scale, scale, 1], None, 0,
+                                  repeat=args.repeat)
+    masks, t = timeit(utils.resize_mask, mask, scale, [(0, 0), (0, 0), (0, 0)],
+                      repeat=args.repeat)
+    print("{:20} {:8.2f} ms".format("ndimage.zoom masks", zoom_time * 1000))
+    print("{:20} {:8.2f} ms  x{:.1f}  differing pixels: {}".format(
+        "resize_mask", t * 1000, zoom_time / t, np.count_nonzero(masks != reference)))
+
+    # Mini masks of the instances
+    bbox = utils.extract_bboxes(mask)
+    backend = utils.get_resize_backend()
+    utils.set_resize_backend("pil")
+    reference_image = resize()[0]
+    reference_masks = utils.minimize_mask(bbox, mask, config.MINI_MASK_SHAPE)
+    for name in utils.available_resize_backends():
+        utils.set_resize_backend(name)
+        (resized, _, _, _), image_time = timeit(resize, repeat=args.repeat)
+        mini_masks, mask_time = timeit(utils.minimize_mask, bbox, mask, config.MINI_MASK_SHAPE,
+                                       repeat=args.repeat)
+        print("{:6} image {:8.2f} ms  max difference: {:3}   mini masks {:8.2f} ms  "
+              "differing pixels: {}".format(
+                  name, image_time * 1000,
+                  np.abs(resized.astype(int) - reference_image).max(),
+                  mask_time * 1000, np.count_nonzero(mini_masks != reference_masks)))
+    utils.set_resize_backend(backend)
+
+
+def benchmark_unmold(args):
+    # Smooth 28x28 masks like the mask head's, in boxes of 50 to 2000
+    # pixels of a full resolution ISIC image
+    rng = np.random.RandomState(0)
+    image_shape = (4000, 6000, 3)
+    grid = np.linspace(-3, 3, 28) ** 2
+    logits = 4 - grid[:, np.newaxis] - grid[np.newaxis] + rng.randn(args.boxes, 28, 28)
+    masks = (1 / (1 + np.exp(-logits))).astype(np.float32)
+    sizes = rng.randint(50, 2000, [args.boxes, 2])
+    y1 = rng.randint(0, image_shape[0] - sizes[:, 0])
+    x1 = rng.randint(0, image_shape[1] - sizes[:, 1])
+    boxes = np.stack([y1, x1, y1 + sizes[:, 0], x1 + sizes[:, 1]], axis=1).astype(np.int32)
+    print("Unmold {} masks on a {}x{} image".format(args.boxes, image_shape[0], image_shape[1]))
+
+    def loop_unmold_masks():
+        return np.stack([utils.unmold_mask(masks[i], boxes[i], image_shape)
+                         for i in range(args.boxes)], axis=-1)
+
+    reference, loop_time = timeit(loop_unmold_masks, repeat=args.repeat)
+    print("{:20} {:8.2f} ms  {:8.1f} MB".format("detection loop", loop_time * 1000,
+                                                  reference.nbytes / 2 ** 20))
+    for mask_format in ["full", "crop", "rle"]:
+        unmolded, t = timeit(utils.unmold_masks, masks, boxes, image_shape, mask_format,
+                             repeat=args.repeat)
+        if mask_format == "full":
+            size = unmolded.nbytes
+            same = np.array_equal(unmolded, reference)
+        elif mask_format == "crop":
+            size = sum(crop.nbytes for crop in unmolded)
+            same = all(np.array_equal(crop, reference[y1:y2, x1:x2, i])
+                       for i, (crop, (y1, x1, y2, x2)) in enumerate(zip(unmolded, boxes)))
+        else:
+            size = sum(8 * len(rle["counts"]) for rle in unmolded)
+            same = all(np.array_equal(utils.rle_decode(rle), reference[:, :, i])
+                       for i, rle in enumerate(unmolded))
+        print("{:20} {:8.2f} ms  {:8.1f} MB  x{:.1f}  same masks: {}".format(
+            "unmold_masks " + mask_format, t * 1000, size / 2 ** 20, loop_time / t, same))
+
+
+############################################################
+#  Detections
+############################################################
+
+def loop_refine_detections(rois, probs, deltas, window, config):
+    """refine_detections with one NMS per class, as it used to be."""
+    _, class_ids = torch.max(probs, dim=1)
+    idx = torch.arange(class_ids.size()[0], device=probs.device).long()
+    class_scores = probs[idx, class_ids]
+    deltas_specific = deltas[idx, class_ids]
+    std_dev = torch.from_numpy(np.reshape(config.RPN_BBOX_STD_DEV, [1, 4])).float().to(probs.device)
+    refined_rois = modellib.apply_box_deltas(rois, deltas_specific * std_dev)
+    height, width = config.IMAGE_SHAPE[:2]
+    refined_rois *= torch.tensor([height, width, height, width], device=probs.device).float()
+    refined_rois = torch.round(modellib.clip_to_window(window, refined_rois))
+
+    keep_bool = class_ids > 0
+    if config.DETECTION_MIN_CONFIDENCE:
+        keep_bool = keep_bool & (class_scores >= config.DETECTION_MIN_CONFIDENCE)
+    keep = torch.nonzero(keep_bool)[:, 0]
+    if keep.size()[0] == 0:
+        return refined_rois.new_zeros(0, 6)
+
+    pre_nms_class_ids = class_ids[keep]
+    pre_nms_scores = class_scores[keep]
+    pre_nms_rois = refined_rois[keep]
+    for i, class_id in enumerate(modellib.unique1d(pre_nms_class_ids)):
+        ixs = torch.nonzero(pre_nms_class_ids == class_id)[:, 0]
+        ix_rois = pre_nms_rois[ixs]
+        ix_scores, order = pre_nms_scores[ixs].sort(descending=True)
+        ix_rois = ix_rois[order, :]
+        class_keep = nms_wrapper.nms(torch.cat((ix_rois, ix_scores.unsqueeze(1)), dim=1),
+                                     config.DETECTION_NMS_THRESHOLD)
+        class_keep = keep[ixs[order[class_keep]]]
+        if i == 0:
+            nms_keep = class_keep
+        else:
+            nms_keep = modellib.unique1d(torch.cat((nms_keep, class_keep)))
+    keep = modellib.intersect1d(keep, nms_keep)
+
+    top_ids = class_scores[keep].sort(descending=True)[1][:config.DETECTION_MAX_INSTANCES]
+    keep = keep[top_ids]
+    return torch.cat((refined_rois[keep], class_ids[keep].unsqueeze(1).float(),
+                      class_scores[keep].unsqueeze(1)), dim=1)
+
+
+def random_classifications(count, num_classes, seed=0):
+    """Classifier outputs for count proposals: rois in normalized
+    coordinates, confident class probabilities and small box deltas.
+    """
+    rng = np.random.RandomState(seed)
+    rois = random_proposals(count, seed=seed)[:, :4] / 1024
+    logits = rng.normal(0, 1, (count, num_classes))
+    logits[np.arange(count), rng.randint(1, num_classes, count)] += 8
+    probs = torch.from_numpy(logits).float().softmax(dim=1)
+    deltas = torch.from_numpy(rng.normal(0, 0.5, (count, num_classes, 4))).float()
+    return rois, probs, deltas
+
+
+def benchmark_refine_detections(args):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    window = torch.tensor([0, 0, 1024, 1024], device=device).float()
+    for num_classes in [81, 2]:
+        class ClassesConfig(BenchmarkConfig):
+            NUM_CLASSES = num_classes
+        config = ClassesConfig()
+        rois, probs, deltas = [x.to(device) for x in
+                               random_classifications(args.boxes, num_classes)]
+        print("refine_detections of {} rois with {} classes".format(args.boxes, num_classes))
+
+        reference, loop_time = timeit(loop_refine_detections, rois, probs, deltas, window,
+                                      config, repeat=args.repeat)
+        print("{:20} {:8.2f} ms  {} detections".format("per class NMS", loop_time * 1000,
+                                                       reference.size(0)))
+        constants = modellib.TensorConstants(config).to(device)
+        detections, t = timeit(modellib.refine_detections, rois, probs, deltas, window,
+                               config, constants, repeat=args.repeat)
+        # Detections of equal scores may come in a different order
+        same = sorted(map(tuple, detections.tolist())) == sorted(map(tuple, reference.tolist()))
+        print("{:20} {:8.2f} ms  {} detections  x{:.1f}  same output: {}".format(
+            "batched NMS", t * 1000, detections.size(0), loop_time / t, same))
+
+
+############################################################
+#  Mixed precision
+############################################################
+
+def match_detections(reference, detections, reference_masks, masks):
+    """Matches each reference detection with the detection of the same
+    class it overlaps most.
+    reference, detections: [N, (y1, x1, y2, x2, class_id, score)] numpy
+        arrays of the real detections of an image.
+    reference_masks, masks: [N, num_classes, height, width] mask probabilities.
+    Returns the box IoU, mask IoU and score difference of the matches with
+    an IoU >= 0.5, and the number of reference detections.
+    """
+    results = []
+    if len(reference) and len(detections):
+        # Boxes as inclusive pixel ranges: random weights give boxes one
+        # pixel high or wide, whose IoU would be nan.
+        inclusive = np.array([0, 0, 1, 1])
+        overlaps = utils.compute_overlaps(reference[:, :4] + inclusive, detections[:, :4] + inclusive)
+        overlaps[reference[:, 4:5] != detections[np.newaxis, :, 4]] = 0
+        for i, j in enumerate(np.argmax(overlaps, axis=1)):
+            if overlaps[i, j] < 0.5:
+                continue
+            class_id = int(reference[i, 4])
+            a = reference_masks[i, class_id] >= 0.5
+            b = masks[j, class_id] >= 0.5
+            union = np.sum(a | b)
+            mask_iou = np.sum(a & b) / union if union else 1.0
+            results.append((overlaps[i, j], mask_iou, abs(reference[i, 5] - detections[j, 5])))
+    return results, len(reference)
+
+
+def benchmark_precision(args):
+    class PrecisionConfig(BenchmarkConfig):
+        IMAGES_PER_GPU = args.boxes
+        # Random weights hardly give confident detections
+        DETECTION_MIN_CONFIDENCE = 0 if args.weights is None else 0.7
+    config = PrecisionConfig()
+    torch.manual_seed(0)
+    model = modellib.MaskRCNN(config, model_dir="logs")
+    if args.weights:
+        model.load_state_dict(torch.load(args.weights, map_location=model.device), strict=False)
+
+    # Smooth images, closer to photos than noise
+    rng = np.random.RandomState(0)
+    images = []
+    for _ in range(args.boxes):
+        image = rng.uniform(0, 255, (16, 16, 3)).astype(np.uint8)
+        images.append(utils.imresize(image, (768, 1024)))
+    molded_images, image_metas, windows = model.mold_inputs(images)
+    molded_images = torch.from_numpy(molded_images.transpose(0, 3, 1, 2)).float().to(model.device)
+    print("Inference on {} {}x{} images on {}, float32 against bfloat16 autocast".format(
+        args.boxes, molded_images.size(2), molded_images.size(3), model.device))
+
+    def predict(precision):
+        model.config.MIXED_PRECISION = precision
+        with torch.no_grad():
+            return [o.cpu().numpy() for o in model.predict([molded_images, image_metas], mode="inference")]
+
+    def features(precision):
+        model.config.MIXED_PRECISION = precision
+        with torch.no_grad(), model.autocast():
+            return [f.float() for f in model.fpn(molded_images)]
+
+    (reference, reference_masks), reference_time = timeit(predict, None, repeat=args.repeat)
+    (detections, masks), t = timeit(predict, "bfloat16", repeat=args.repeat)
+    model.config.MIXED_PRECISION = None
+
+    matches = []
+    count = 0
+    for b in range(args.boxes):
+        real = reference[b, :, 4] > 0
+        real_bf16 = detections[b, :, 4] > 0
+        image_matches, image_count = match_detections(reference[b][real], detections[b][real_bf16],
+                                                      reference_masks[b][real], masks[b][real_bf16])
+        matches += image_matches
+        count += image_count
+    print("{:20} {:8.2f} ms  {} detections".format("float32", reference_time * 1000,
+                                                   int(np.sum(reference[:, :, 4] > 0))))
+    print("{:20} {:8.2f} ms  {} detections  x{:.1f}".format("bfloat16", t * 1000,
+                                                          int(np.sum(detections[:, :, 4] > 0)),
+                                                          reference_time / t))
+
+    errors = [float((a - b).norm() / a.norm()) for a, b in zip(features(None), features("bfloat16"))]
+    print("FPN features relative error: " + ", ".join(
+        "P{} {:.4f}".format(level + 2, e) for level, e in enumerate(errors)))
+    if matches:
+        box_iou, mask_iou, score_diff = np.mean(matches, axis=0)
+        print("Detections matched (IoU >= 0.5): {}/{}  mean box IoU {:.3f}  mean mask IoU {:.3f}  "
+              "mean score difference {:.4f}".format(len(matches), count, box_iou, mask_iou, score_diff))
+    else:
+        print("Detections matched (IoU >= 0.5): 0/{}".format(count))
+
+
+############################################################
+#  Command line
+############################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Micro-benchmarks of Mask R-CNN building blocks.')
+    parser.add_argument("command",
+                        metavar="<command>",
+                        choices=["nms", "roi_align", "roi_pyramid", "rpn_targets", "overlaps", "bboxes",
+                                 "resize", "unmold", "refine_detections", "precision"],
+                        help="'nms', 'roi_align', 'roi_pyramid', 'rpn_targets', 'overlaps', "
+                             "'bboxes', 'resize', 'unmold', 'refine_detections' or 'precision'")
+    parser.add_argument('--boxes', required=False,
+                        default=None, type=int,
+                        help='Number of boxes (default=6000 for nms, the pre-NMS limit of '
+                             'proposal_layer, 1000 for roi_align and roi_pyramid, POST_NMS_ROIS_INFERENCE, '
+                             'the number of images, 20, for rpn_targets, the number of GT boxes, '
+                             '2, for overlaps, the number of instances, 8, for bboxes and resize, '
+                             'the number of detections, 20, for unmold, the number of rois, '
+                             '1000, for refine_detections and the number of images, 1, for precision)')
+    parser.add_argument('--threshold', required=False,
+                        default=0.7, type=float,
+                        help='NMS threshold (default=0.7, RPN_NMS_THRESHOLD)')
+    parser.add_argument('--repeat', required=False,
+                        default=5, type=int,
+                        help='Times each benchmark is run, the best time is reported (default=5)')
+    parser.add_argument('--weights', required=False,
+                        default=None,
+                        metavar="/path/to/weights.pth",
+                        help='Weights of the model for precision (default=random weights)')
+    args = parser.parse_args()
+
+    commands = {
+        "nms": (benchmark_nms, 6000),
+        "roi_align": (benchmark_roi_align, 1000),
+        "roi_pyramid": (benchmark_roi_pyramid, 1000),
+        "rpn_targets": (benchmark_rpn_targets, 20),
+        "overlaps": (benchmark_overlaps, 2),
+        "bboxes": (benchmark_bboxes, 8),
+        "resize": (benchmark_resize, 8),
+        "unmold": (benchmark_unmold, 20),
+        "refine_detections": (benchmark_refine_detections, 1000),
+        "precision": (benchmark_precision, 1),
+    }
+    command, default_boxes = commands[args.command]
+    if args.boxes is None:
+        args.boxes = default_boxes
+    command(args)
@@ -0,0 +1,164 @@
+"""
+Mask R-CNN
+Background checkpoint writer.
+
+Serializing the weights of a ResNet101-FPN takes seconds. The writer takes
+a snapshot of the tensors in CPU memory, which is fast, and hands it to a
+thread that serializes it while training goes on. Files are written to a
+temporary file and renamed, so an interrupted write never leaves a
+truncated checkpoint behind for find_last() to pick up.
+
+Old checkpoints are deleted as new ones are written: only the last `keep`
+epochs are kept, plus the one with the best validation loss.
+
+Usage:
+
+    import checkpoint as checkpointlib
+    writer = checkpointlib.CheckpointWriter(keep=5)
+    writer.save(epoch, {weights_path: model.state_dict()}, val_loss=val_loss)
+    ...
+    writer.flush()    # Wait for the pending writes
+"""
+
+import os
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+
+
+def snapshot(obj):
+    """Copy of a state dict, or of any nesting of dicts, lists and tuples,
+    with all tensors copied to CPU memory. Later updates of the model or
+    the optimizer don't change it.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+def save_atomic(obj, path):
+    """torch.save() to a temporary file next to path, then renamed to path.
+    Readers see either the previous file or the complete new one.
+    """
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def rng_state():
+    """State of the Python, NumPy and PyTorch random number generators, in
+    plain lists and tensors that torch.load() reads with weights_only.
+    """
+    numpy_state = np.random.get_state()
+    state = {
+        "python": random.getstate(),
+        "numpy": [numpy_state[0], numpy_state[1].tolist()] + list(numpy_state[2:]),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """Restores the random number generators from rng_state(). The states
+    are CPU tensors, wherever they were loaded to.
+    """
+    python_state = state["python"]
+    random.setstate((python_state[0], tuple(python_state[1]), python_state[2]))
+    numpy_state = state["numpy"]
+    np.random.set_state((numpy_state[0], np.array(numpy_state[1], dtype=np.uint32)) + tuple(numpy_state[2:]))
+    torch.set_rng_state(state["torch"].cpu())
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state["cuda"]])
+
+
+class CheckpointWriter(object):
+    """Writes the checkpoints of a training in a background thread.
+    keep: Number of most recent checkpoints to keep. None keeps them all.
+    keep_best: If True, also keeps the checkpoint with the lowest
+        validation loss.
+    Only the files written by this writer are ever deleted.
+    """
+
+    def __init__(self, keep=None, keep_best=True):
+        self.keep = keep
+        self.keep_best = keep_best
+        # One snapshot waits while the previous one is written, so at most
+        # two are held in memory and save() blocks if training gets ahead.
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = None
+        self.error = None
+        # Written checkpoints, in order: (epoch, paths)
+        self.checkpoints = []
+        # (validation loss, epoch) of the best checkpoint
+        self.best = None
+
+    def save(self, epoch, files, val_loss=None):
+        """Snapshots and queues a checkpoint for writing.
+        epoch: Epoch of the checkpoint.
+        files: dict of path: object to torch.save() to it, e.g. a state dict.
+        val_loss: Validation loss of the epoch, to keep the best checkpoint.
+        """
+        self.check()
+        files = [(path, snapshot(obj)) for path, obj in files.items()]
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="CheckpointWriter", daemon=True)
+            self.thread.start()
+        self.queue.put((epoch, files, val_loss))
+
+    def flush(self):
+        """Waits for the queued checkpoints to be written."""
+        self.queue.join()
+        self.check()
+
+    def check(self):
+        """Raises the error of a failed write, if any."""
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def run(self):
+        while True:
+            epoch, files, val_loss = self.queue.get()
+            try:
+                for path, obj in files:
+                    save_atomic(obj, path)
+                self.checkpoints.append((epoch, [path for path, _ in files]))
+                if val_loss is not None and (self.best is None or val_loss < self.best[0]):
+                    self.best = (val_loss, epoch)
+                self.remove_old()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def remove_old(self):
+        """Deletes the checkpoints that are neither among the last `keep`
+        nor the best one.
+        """
+        if self.keep is None:
+            return
+        kept = set(epoch for epoch, _ in self.checkpoints[-self.keep:]) if self.keep > 0 else set()
+        if self.keep_best and self.best is not None:
+            kept.add(self.best[1])
+
+        checkpoints = []
+        for epoch, paths in self.checkpoints:
+            if epoch in kept:
+                checkpoints.append((epoch, paths))
+                continue
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+        self.checkpoints = checkpoints
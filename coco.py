@@ -48,6 +48,7 @@ import shutil
 from config import Config
 import utils
 import model as modellib
+import parallel
 
 import torch
 
@@ -267,6 +268,24 @@ class CocoDataset(utils.Dataset):
             # Call super class to return an empty mask
             return super(CocoDataset, self).load_mask(image_id)
 
+    def instance_count(self, image_id):
+        """Counts the non-crowd instances load_mask() returns from the areas
+        of their RLE masks, without decoding them.
+        """
+        image_info = self.image_info[image_id]
+        if image_info["source"] != "coco":
+            return super(CocoDataset, self).instance_count(image_id)
+
+        count = 0
+        for annotation in image_info["annotations"]:
+            class_id = self.map_source_class_id(
+                "coco.{}".format(annotation['category_id']))
+            if class_id and not annotation['iscrowd'] and \
+                    maskUtils.area(self.annToRLE(annotation, image_info["height"],
+                                                 image_info["width"])) > 0:
+                count += 1
+        return count
+
     def image_reference(self, image_id):
         """Return a link to the image in the COCO Website."""
         info = self.image_info[image_id]
@@ -337,6 +356,26 @@ def build_coco_results(dataset, image_ids, rois, class_ids, scores, masks):
     return results
 
 
+def build_coco_results_from_detections(dataset, image_id, detections):
+    """Same as build_coco_results() for the utils.Detection objects of
+    one image. Their RLEs are compressed as they are, without building
+    the masks of the size of the image.
+    """
+    results = []
+    for detection in detections:
+        bbox = np.around(detection.box, 1)
+        height, width = detection.image_shape
+        result = {
+            "image_id": image_id,
+            "category_id": dataset.get_source_class_id(detection.class_id, "coco"),
+            "bbox": [bbox[1], bbox[0], bbox[3] - bbox[1], bbox[2] - bbox[0]],
+            "score": detection.score,
+            "segmentation": maskUtils.frPyObjects(detection.to_rle(), height, width)
+        }
+        results.append(result)
+    return results
+
+
 def evaluate_coco(model, dataset, coco, eval_type="bbox", limit=0, image_ids=None):
     """Runs official COCO evaluation.
     dataset: A Dataset object with valiadtion data
@@ -363,13 +402,12 @@ def evaluate_coco(model, dataset, coco, eval_type="bbox", limit=0, image_ids=Non
 
         # Run detection
         t = time.time()
-        r = model.detect([image])[0]
+        detections = model.detect([image], mask_format="rle", as_detections=True)[0]
         t_prediction += (time.time() - t)
 
         # Convert results to COCO format
-        image_results = build_coco_results(dataset, coco_image_ids[i:i + 1],
-                                           r["rois"], r["class_ids"],
-                                           r["scores"], r["masks"])
+        image_results = build_coco_results_from_detections(dataset, coco_image_ids[i],
+                                                           detections)
         results.extend(image_results)
 
     # Load results. This modifies results with additional attributes.
@@ -435,6 +473,8 @@ if __name__ == '__main__':
     # Configurations
     if args.command == "train":
         config = CocoConfig()
+        # Distributed training when started with torchrun, see parallel.py
+        parallel.init_process_group(config)
     else:
         class InferenceConfig(CocoConfig):
             # Set batch size to 1 since we'll be running inference on
@@ -443,7 +483,8 @@ if __name__ == '__main__':
             IMAGES_PER_GPU = 1
             DETECTION_MIN_CONFIDENCE = 0
         config = InferenceConfig()
-    config.display()
+    if parallel.is_main_process():
+        config.display()
 
     # Create model
     if args.command == "train":
@@ -452,8 +493,6 @@ if __name__ == '__main__':
     else:
         model = modellib.MaskRCNN(config=config,
                                   model_dir=args.logs)
-    if config.GPU_COUNT:
-        model = model.cuda()
 
     # Select weights file to load
     if args.model:
@@ -470,9 +509,12 @@ if __name__ == '__main__':
     else:
         model_path = ""
 
-    # Load weights
+    # Load weights. The last training continues with its training state.
     print("Loading weights ", model_path)
-    model.load_weights(model_path)
+    if args.command == "train" and args.model and args.model.lower() == "last":
+        model.resume(model_path)
+    else:
+        model.load_weights(model_path)
 
     # Train or evaluate
     if args.command == "train":
@@ -32,13 +32,18 @@ class Config(object):
     # NUMBER OF GPUs to use. For CPU use 0
     GPU_COUNT = 1
 
+    # Device to run on, e.g. "cuda:1" or "cpu". None picks the current GPU
+    # if GPU_COUNT > 0 and CUDA is available, the CPU otherwise.
+    DEVICE = None
+
     # Number of images to train with on each GPU. A 12GB GPU can typically
     # handle 2 images of 1024x1024px.
     # Adjust based on your GPU memory and image sizes. Use the highest
     # number that your GPU can handle for best performance.
     IMAGES_PER_GPU = 1
 
-    # Number of training steps per epoch
+    # Number of training steps per epoch. Each step trains on a batch of
+    # BATCH_SIZE images.
     # This doesn't need to match the size of the training set. Tensorboard
     # updates are saved at the end of each epoch, so setting this to a
     # smaller number means getting more frequent TensorBoard updates.
@@ -47,11 +52,41 @@ class Config(object):
     # a lot of time on validation stats.
     STEPS_PER_EPOCH = 1000
 
-    # Number of validation steps to run at the end of every training epoch.
+    # Number of validation images to run at the end of every training epoch,
+    # in batches of BATCH_SIZE: __init__() turns it into a number of steps.
     # A bigger number improves accuracy of validation stats, but slows
     # down the training.
     VALIDATION_STEPS = 50
 
+    # Training DataLoaders. Number of worker processes loading batches,
+    # None for one per CPU available to the process, 0 to load them in
+    # the training process.
+    DATALOADER_WORKERS = 4
+    # Batches loaded in advance by each worker
+    DATALOADER_PREFETCH_FACTOR = 2
+    # Load batches in page-locked memory, which is copied to the GPU
+    # asynchronously. None pins them when the model runs on a GPU.
+    DATALOADER_PIN_MEMORY = None
+    # Keep the workers between epochs and between train_model() calls
+    # instead of starting new ones for every pass over the data.
+    DATALOADER_PERSISTENT_WORKERS = True
+    # CPUs to pin the workers to, one CPU per worker round robin, e.g.
+    # range(48, 64) to keep them off the cores of the training process.
+    # None lets the OS schedule them.
+    DATALOADER_WORKER_CPUS = None
+
+    # Checkpoints are written every epoch in the background. Number of the
+    # most recent ones to keep, None to keep them all, and whether to also
+    # keep the one with the lowest validation loss.
+    CHECKPOINT_KEEP = 5
+    CHECKPOINT_KEEP_BEST = True
+
+    # Distributed training, see parallel.py. torch.distributed backend of
+    # the process group, gloo runs on CPU-only hosts.
+    DISTRIBUTED_BACKEND = "gloo"
+    # Gradients are averaged across processes in buckets of this many bytes
+    DISTRIBUTED_BUCKET_SIZE = 25 * 2**20
+
     # The strides of each layer of the FPN Pyramid. These values
     # are based on a Resnet101 backbone.
     BACKBONE_STRIDES = [4, 8, 16, 32, 64]
@@ -71,6 +106,11 @@ class Config(object):
     # If 2, then anchors are created for every other cell, and so on.
     RPN_ANCHOR_STRIDE = 1
 
+    # Directory where the generated anchors are stored and memory mapped
+    # from, so processes of the same machine (e.g. DataLoader workers)
+    # share one copy. None keeps them in memory, generated once per process.
+    ANCHOR_CACHE_DIR = None
+
     # Non-max suppression threshold to filter RPN proposals.
     # You can reduce this during training to generate more propsals.
     RPN_NMS_THRESHOLD = 0.7
@@ -87,6 +127,12 @@ class Config(object):
     USE_MINI_MASK = True
     MINI_MASK_SHAPE = (56, 56)  # (height, width) of the mini-mask
 
+    # Directory where the preprocessed training samples (resized image,
+    # boxes and masks) are cached, to not decode and resize them again
+    # every epoch. None disables the cache. Changing the image or mask
+    # settings above starts a new cache.
+    SAMPLE_CACHE_DIR = None
+
     # Input image resing
     # Images are resized such that the smallest side is >= IMAGE_MIN_DIM and
     # the longest side is <= IMAGE_MAX_DIM. In case both conditions can't
@@ -131,6 +177,12 @@ class Config(object):
     # Non-maximum suppression threshold for detection
     DETECTION_NMS_THRESHOLD = 0.3
 
+    # Reduced precision of the backbone and the heads, for training and
+    # inference: None for float32, or "bfloat16", which runs on the bf16
+    # units of recent Xeons (AMX, AVX512-BF16) and GPUs. Box math, NMS and
+    # the losses stay in float32.
+    MIXED_PRECISION = None
+
     # Learning rate and momentum
     # The Mask RCNN paper uses lr=0.02, but on TensorFlow it causes
     # weights to explode. Likely due to differences in optimzer
@@ -156,8 +208,8 @@ class Config(object):
         else:
             self.BATCH_SIZE = self.IMAGES_PER_GPU
 
-        # Adjust step size based on batch size
-        self.STEPS_PER_EPOCH = self.BATCH_SIZE * self.STEPS_PER_EPOCH
+        # Validation steps, of BATCH_SIZE images each
+        self.VALIDATION_STEPS = max(1, math.ceil(self.VALIDATION_STEPS / self.BATCH_SIZE))
 
         # Input image size
         self.IMAGE_SHAPE = np.array(
@@ -41,11 +41,9 @@ config.display()
 
 # Create model object.
 model = modellib.MaskRCNN(model_dir=MODEL_DIR, config=config)
-if config.GPU_COUNT:
-    model = model.cuda()
 
 # Load weights trained on MS-COCO
-model.load_state_dict(torch.load(COCO_MODEL_PATH))
+model.load_state_dict(torch.load(COCO_MODEL_PATH, map_location=model.device))
 
 # COCO Class names
 # Index of the class in the list is its ID. For example, to get ID of
@@ -6,9 +6,11 @@ import numpy as np
 import utils
 import math
 import time
+import json
 import os
 
 import model as modellib
+import parallel
 
 # Root directory of the project
 ROOT_DIR = os.getcwd()
@@ -86,6 +88,19 @@ class ISICDataset(utils.Dataset):
             # Call super class to return an empty mask
             return super(ISICDataset, self).load_mask(image_id)
 
+    def instance_count(self, image_id):
+        """Counts the non-crowd instances load_mask() returns from the areas
+        of their RLE masks, without decoding them.
+        """
+        image_info = self.image_info[image_id]
+        count = 0
+        for ann in image_info["annotations"]:
+            class_id = self.map_source_class_id("isic.{}".format(ann['category_id']))
+            if class_id and not ann['iscrowd'] and \
+                    maskUtils.area(self.annToRLE(ann, image_info["height"], image_info["width"])) > 0:
+                count += 1
+        return count
+
     # The following two functions are from pycocotools with a few changes.
 
     def annToRLE(self, ann, height, width):
@@ -117,24 +132,135 @@ class ISICDataset(utils.Dataset):
         return m
 
 
+############################################################
+#  Packed Dataset
+############################################################
+
+# Bump when the layout of the packed files changes
+PACKED_VERSION = 2
+
+
+def packed_path(dataset_dir, subset):
+    """Path, without extension, of the packed files of a subset written by
+    pack_isic.py: <path>.bin holds the images and masks and <path>.json the
+    index.
+    """
+    return os.path.join(dataset_dir, "packed_isic_{}".format(subset.lower()))
+
+
+class PackedISICDataset(ISICDataset):
+    """ISIC images and annotations packed by pack_isic.py into two files:
+    - <path>.bin: the images, already resized for training, as raw uint8
+      [height, width, 3] arrays one after the other, each followed by the
+      compressed RLE masks of its annotations.
+    - <path>.json: the classes and, per image, its offset, shape and
+      original shape, and its annotations with the offset and length of
+      their masks in the .bin file.
+    The .bin file is memory mapped and images are read without copying,
+    so workers don't open, stat and decode a file per image.
+    """
+
+    def load_packed(self, path, config=None):
+        """Loads the index of packed files.
+        config: If given, the packed images must have been resized for its
+            IMAGE_MIN_DIM and IMAGE_MAX_DIM. They would be resized again
+            otherwise, and differ from the images of ISICDataset.
+        """
+        with open(path + ".json") as f:
+            index = json.load(f)
+        if index["version"] != PACKED_VERSION:
+            raise Exception("{} was packed with another version of pack_isic.py. "
+                            "Pack it again.".format(path))
+        if config is not None and (index["image_min_dim"], index["image_max_dim"]) != \
+                (config.IMAGE_MIN_DIM, config.IMAGE_MAX_DIM):
+            raise Exception("{} was packed for IMAGE_MIN_DIM={} and IMAGE_MAX_DIM={}, the config "
+                            "has {} and {}. Pack it again.".format(
+                                path, index["image_min_dim"], index["image_max_dim"],
+                                config.IMAGE_MIN_DIM, config.IMAGE_MAX_DIM))
+
+        self.shard_path = path + ".bin"
+        self.shard = None
+
+        for c in index["classes"]:
+            self.add_class("isic", c["id"], c["name"])
+
+        for image in index["images"]:
+            height, width = image["shape"][:2]
+            self.add_image("isic", image_id=image["id"], path=self.shard_path,
+                           file_name=image["file_name"],
+                           offset=image["offset"], shape=image["shape"],
+                           original_shape=image["original_shape"],
+                           width=width, height=height,
+                           annotations=image["annotations"])
+
+    def mapped_shard(self):
+        # Mapped on first use, so each DataLoader worker maps it itself
+        if self.shard is None:
+            self.shard = np.memmap(self.shard_path, dtype=np.uint8, mode="r")
+        return self.shard
+
+    def load_image(self, image_id):
+        """Returns a read-only [H,W,3] view of the image in the shard."""
+        info = self.image_info[image_id]
+        size = int(np.prod(info["shape"]))
+        return self.mapped_shard()[info["offset"]:info["offset"] + size].reshape(info["shape"])
+
+    def annToRLE(self, ann, height, width):
+        """Reads the RLE mask of a packed annotation from the shard."""
+        offset = ann["offset"]
+        return {"size": ann["size"],
+                "counts": self.mapped_shard()[offset:offset + ann["length"]].tobytes()}
+
+    def __getstate__(self):
+        # Don't send the mapping to spawned workers, they map the file again
+        state = self.__dict__.copy()
+        state["shard"] = None
+        return state
+
+
+def load_dataset(dataset_dir, subset, config=None):
+    """Loads a subset from its packed files if pack_isic.py wrote them,
+    from the COCO annotations and the images otherwise.
+    config: If given, the packed files must have been packed for it.
+    """
+    path = packed_path(dataset_dir, subset)
+    if os.path.exists(path + ".json"):
+        dataset = PackedISICDataset()
+        dataset.load_packed(path, config)
+    else:
+        dataset = ISICDataset()
+        dataset.load_isic(dataset_dir, subset)
+    dataset.prepare()
+    return dataset
+
+
 if __name__ == "__main__":
-    config = ISICConfig()
-    config.display()
+    import argparse
 
-    model = modellib.MaskRCNN(config=config, model_dir=DEFAULT_LOGS_DIR)
+    parser = argparse.ArgumentParser(
+        description='Train Mask R-CNN on ISIC.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume the last training of the logs directory, '
+                             'with its optimizer state, loss history and random state')
+    args = parser.parse_args()
 
-    if config.GPU_COUNT:
-        model = model.cuda()
+    config = ISICConfig()
 
-    model.load_weights(config.IMAGENET_MODEL_PATH)
+    # Distributed training when started with torchrun, see parallel.py
+    parallel.init_process_group(config)
+    if parallel.is_main_process():
+        config.display()
+
+    model = modellib.MaskRCNN(config=config, model_dir=DEFAULT_LOGS_DIR)
 
-    dataset_train = ISICDataset()
-    dataset_train.load_isic(ISIC_TRAIN_DIR, "Train")
-    dataset_train.prepare()
+    # Continue the last training if asked to and there is one, start from
+    # ImageNet weights otherwise. The schedule below skips the epochs
+    # already done.
+    if not (args.resume and model.resume()):
+        model.load_weights(config.IMAGENET_MODEL_PATH)
 
-    dataset_val = ISICDataset()
-    dataset_val.load_isic(ISIC_VAL_DIR, "Val")
-    dataset_val.prepare()
+    dataset_train = load_dataset(ISIC_TRAIN_DIR, "Train", config)
+    dataset_val = load_dataset(ISIC_VAL_DIR, "Val", config)
 
     start_time = time.time()
 
@@ -7,6 +7,7 @@ Written by Waleed Abdulla
 """
 
 import datetime
+import functools
 import math
 import os
 import random
@@ -18,12 +19,18 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 import torch.utils.data
+from torch.ao.nn.quantized import FloatFunctional
+from torch.ao.quantization import DeQuantStub, QuantStub
 from torch.autograd import Variable
 
+import anchors as anchorlib
+import checkpoint as checkpointlib
+import parallel
+import sample_cache as samplecache
 import utils
 import visualize
-from nms.nms_wrapper import nms
-from roialign.roi_align.crop_and_resize import CropAndResizeFunction
+from nms.nms_wrapper import nms, batched_nms
+from roialign.roi_align import CropAndResizeFunction, crop_and_resize_torch, get_backend
 
 
 ############################################################
@@ -72,9 +79,7 @@ def unique1d(tensor):
         return tensor
     tensor = tensor.sort()[0]
     unique_bool = tensor[1:] != tensor [:-1]
-    first_element = Variable(torch.ByteTensor([True]), requires_grad=False)
-    if tensor.is_cuda:
-        first_element = first_element.cuda()
+    first_element = unique_bool.new_ones(1)
     unique_bool = torch.cat((first_element, unique_bool),dim=0)
     return tensor[unique_bool.data]
 
@@ -83,12 +88,30 @@ def intersect1d(tensor1, tensor2):
     aux = aux.sort()[0]
     return aux[:-1][(aux[1:] == aux[:-1]).data]
 
+def batch_pack(tensor, valid):
+    """Packs the valid rows of a zero padded [batch, N, ...] tensor into
+    a single [num_valid, ...] tensor.
+    valid: [batch, N] boolean mask of the rows to keep.
+    Returns the packed rows and their [num_valid, (batch index, row index)]
+    positions in the padded tensor.
+    """
+    ix = torch.nonzero(valid)
+    return tensor[ix[:, 0].data, ix[:, 1].data], ix
+
+def select_device(config):
+    """The torch.device a model of the config runs on: config.DEVICE if
+    set, otherwise the current GPU if GPU_COUNT > 0 and CUDA is available,
+    and the CPU otherwise.
+    """
+    if config.DEVICE:
+        return torch.device(config.DEVICE)
+    if config.GPU_COUNT and torch.cuda.is_available():
+        return torch.device("cuda")
+    return torch.device("cpu")
+
 def log2(x):
     """Implementatin of Log2. Pytorch doesn't have a native implemenation."""
-    ln2 = Variable(torch.log(torch.FloatTensor([2.0])), requires_grad=False)
-    if x.is_cuda:
-        ln2 = ln2.cuda()
-    return torch.log(x) / ln2
+    return torch.log(x) / math.log(2.0)
 
 class SamePad2d(nn.Module):
     """Mimics tensorflow's 'SAME' padding.
@@ -117,6 +140,33 @@ class SamePad2d(nn.Module):
     def __repr__(self):
         return self.__class__.__name__
 
+class TensorConstants(nn.Module):
+    """Tensor constants of the graph, built once from the config when the
+    model is built instead of from NumPy on every call.
+
+    They are registered as buffers, so they follow the model to its device
+    and dtype with .cuda(), .to() or .half(). They are not persistent, so
+    they are not part of the state dict and checkpoints don't change.
+
+    rpn_bbox_std_dev: [4] RPN_BBOX_STD_DEV
+    bbox_std_dev: [4] BBOX_STD_DEV
+    image_scale: [4] (height, width, height, width) of the image, to convert
+        boxes between pixels and normalized coordinates.
+    anchors: [anchor_count, (y1, x1, y2, x2)] anchors in pixels.
+    """
+
+    def __init__(self, config):
+        super(TensorConstants, self).__init__()
+        h, w = config.IMAGE_SHAPE[:2]
+        self.register_constant("rpn_bbox_std_dev", config.RPN_BBOX_STD_DEV)
+        self.register_constant("bbox_std_dev", config.BBOX_STD_DEV)
+        self.register_constant("image_scale", [h, w, h, w])
+        self.register_constant("anchors", anchorlib.get_anchors(config).boxes)
+
+    def register_constant(self, name, value):
+        self.register_buffer(name, torch.from_numpy(np.array(value, dtype=np.float32)),
+                             persistent=False)
+
 
 ############################################################
 #  FPN Graph
@@ -135,9 +185,16 @@ class TopDownLayer(nn.Module):
         return self.conv2(self.padding2(x+y))
 
 class FPN(nn.Module):
+    """ResNet stages C1 to C5 and the top-down layers on top of them.
+    The stubs and the FloatFunctional additions do nothing in float32 and
+    mark where the quantized graph starts and ends, see quantization.py.
+    """
+
     def __init__(self, C1, C2, C3, C4, C5, out_channels):
         super(FPN, self).__init__()
         self.out_channels = out_channels
+        self.quant = QuantStub()
+        self.dequant = DeQuantStub()
         self.C1 = C1
         self.C2 = C2
         self.C3 = C3
@@ -164,8 +221,12 @@ class FPN(nn.Module):
             SamePad2d(kernel_size=3, stride=1),
             nn.Conv2d(self.out_channels, self.out_channels, kernel_size=3, stride=1),
         )
+        self.P4_add = FloatFunctional()
+        self.P3_add = FloatFunctional()
+        self.P2_add = FloatFunctional()
 
     def forward(self, x):
+        x = self.quant(x)
         x = self.C1(x)
         x = self.C2(x)
         c2_out = x
@@ -175,9 +236,9 @@ class FPN(nn.Module):
         c4_out = x
         x = self.C5(x)
         p5_out = self.P5_conv1(x)
-        p4_out = self.P4_conv1(c4_out) + F.upsample(p5_out, scale_factor=2)
-        p3_out = self.P3_conv1(c3_out) + F.upsample(p4_out, scale_factor=2)
-        p2_out = self.P2_conv1(c2_out) + F.upsample(p3_out, scale_factor=2)
+        p4_out = self.P4_add.add(self.P4_conv1(c4_out), F.upsample(p5_out, scale_factor=2))
+        p3_out = self.P3_add.add(self.P3_conv1(c3_out), F.upsample(p4_out, scale_factor=2))
+        p2_out = self.P2_add.add(self.P2_conv1(c2_out), F.upsample(p3_out, scale_factor=2))
 
         p5_out = self.P5_conv2(p5_out)
         p4_out = self.P4_conv2(p4_out)
@@ -188,7 +249,7 @@ class FPN(nn.Module):
         # subsampling from P5 with stride of 2.
         p6_out = self.P6(p5_out)
 
-        return [p2_out, p3_out, p4_out, p5_out, p6_out]
+        return [self.dequant(p) for p in [p2_out, p3_out, p4_out, p5_out, p6_out]]
 
 
 ############################################################
@@ -202,12 +263,16 @@ class Bottleneck(nn.Module):
         super(Bottleneck, self).__init__()
         self.conv1 = nn.Conv2d(inplanes, planes, kernel_size=1, stride=stride)
         self.bn1 = nn.BatchNorm2d(planes, eps=0.001, momentum=0.01)
+        self.relu1 = nn.ReLU(inplace=True)
         self.padding2 = SamePad2d(kernel_size=3, stride=1)
         self.conv2 = nn.Conv2d(planes, planes, kernel_size=3)
         self.bn2 = nn.BatchNorm2d(planes, eps=0.001, momentum=0.01)
+        self.relu2 = nn.ReLU(inplace=True)
         self.conv3 = nn.Conv2d(planes, planes * 4, kernel_size=1)
         self.bn3 = nn.BatchNorm2d(planes * 4, eps=0.001, momentum=0.01)
-        self.relu = nn.ReLU(inplace=True)
+        # One ReLU per convolution, so each can be fused with its
+        # convolution, and the residual addition with the last one.
+        self.residual_add = FloatFunctional()
         self.downsample = downsample
         self.stride = stride
 
@@ -216,12 +281,12 @@ class Bottleneck(nn.Module):
 
         out = self.conv1(x)
         out = self.bn1(out)
-        out = self.relu(out)
+        out = self.relu1(out)
 
         out = self.padding2(out)
         out = self.conv2(out)
         out = self.bn2(out)
-        out = self.relu(out)
+        out = self.relu2(out)
 
         out = self.conv3(out)
         out = self.bn3(out)
@@ -229,8 +294,7 @@ class Bottleneck(nn.Module):
         if self.downsample is not None:
             residual = self.downsample(x)
 
-        out += residual
-        out = self.relu(out)
+        out = self.residual_add.add_relu(out, residual)
 
         return out
 
@@ -328,7 +392,7 @@ def clip_boxes(boxes, window):
          boxes[:, 3].clamp(float(window[1]), float(window[3]))], 1)
     return boxes
 
-def proposal_layer(inputs, proposal_count, nms_threshold, anchors, config=None):
+def proposal_layer(inputs, proposal_count, nms_threshold, constants, config=None):
     """Receives anchor scores and selects a subset to pass as proposals
     to the second stage. Filtering is done based on anchor scores and
     non-max suppression to remove overlaps. It also applies bounding
@@ -336,59 +400,60 @@ def proposal_layer(inputs, proposal_count, nms_threshold, anchors, config=None):
     Inputs:
         rpn_probs: [batch, anchors, (bg prob, fg prob)]
         rpn_bbox: [batch, anchors, (dy, dx, log(dh), log(dw))]
+    constants: TensorConstants of the model, with the anchors.
     Returns:
-        Proposals in normalized coordinates [batch, rois, (y1, x1, y2, x2)]
+        Proposals in normalized coordinates [batch, rois, (y1, x1, y2, x2)].
+        Each image is zero padded to proposal_count rois.
     """
 
-    # Currently only supports batchsize 1
-    inputs[0] = inputs[0].squeeze(0)
-    inputs[1] = inputs[1].squeeze(0)
-
-    # Box Scores. Use the foreground class confidence. [Batch, num_rois, 1]
-    scores = inputs[0][:, 1]
+    # Box Scores. Use the foreground class confidence. [Batch, num_rois]
+    scores = inputs[0][:, :, 1]
 
     # Box deltas [batch, num_rois, 4]
     deltas = inputs[1]
-    std_dev = Variable(torch.from_numpy(np.reshape(config.RPN_BBOX_STD_DEV, [1, 4])).float(), requires_grad=False)
-    if config.GPU_COUNT:
-        std_dev = std_dev.cuda()
-    deltas = deltas * std_dev
+    deltas = deltas * constants.rpn_bbox_std_dev
 
     # Improve performance by trimming to top anchors by score
     # and doing the rest on the smaller subset.
+    batch_size = scores.size()[0]
+    anchors = constants.anchors
     pre_nms_limit = min(6000, anchors.size()[0])
-    scores, order = scores.sort(descending=True)
-    order = order[:pre_nms_limit]
-    scores = scores[:pre_nms_limit]
-    deltas = deltas[order.data, :] # TODO: Support batch size > 1 ff.
-    anchors = anchors[order.data, :]
+    scores, order = scores.sort(dim=1, descending=True)
+    order = order[:, :pre_nms_limit]
+    scores = scores[:, :pre_nms_limit]
+    deltas = torch.gather(deltas, 1, order.unsqueeze(2).expand(batch_size, pre_nms_limit, 4))
+    anchors = anchors[order.contiguous().view(-1).data, :]
 
     # Apply deltas to anchors to get refined anchors.
-    # [batch, N, (y1, x1, y2, x2)]
-    boxes = apply_box_deltas(anchors, deltas)
+    # [batch * N, (y1, x1, y2, x2)]
+    boxes = apply_box_deltas(anchors, deltas.contiguous().view(-1, 4))
 
     # Clip to image boundaries. [batch, N, (y1, x1, y2, x2)]
     height, width = config.IMAGE_SHAPE[:2]
     window = np.array([0, 0, height, width]).astype(np.float32)
-    boxes = clip_boxes(boxes, window)
+    boxes = clip_boxes(boxes, window).view(batch_size, pre_nms_limit, 4)
 
     # Filter out small boxes
     # According to Xinlei Chen's paper, this reduces detection accuracy
     # for small objects, so we're skipping it.
 
-    # Non-max suppression
-    keep = nms(torch.cat((boxes, scores.unsqueeze(1)), 1).data, nms_threshold)
-    keep = keep[:proposal_count]
-    boxes = boxes[keep, :]
+    norm = constants.image_scale
 
-    # Normalize dimensions to range of 0 to 1.
-    norm = Variable(torch.from_numpy(np.array([height, width, height, width])).float(), requires_grad=False)
-    if config.GPU_COUNT:
-        norm = norm.cuda()
-    normalized_boxes = boxes / norm
+    # Non-max suppression. NMS is done per image and the surviving boxes
+    # are zero padded to proposal_count so all images stack into one batch.
+    proposals = []
+    for b in range(batch_size):
+        keep = nms(torch.cat((boxes[b], scores[b].unsqueeze(1)), 1).data, nms_threshold)
+        keep = keep[:proposal_count]
 
-    # Add back batch dimension
-    normalized_boxes = normalized_boxes.unsqueeze(0)
+        # Normalize dimensions to range of 0 to 1.
+        image_boxes = boxes[b][keep, :] / norm
+
+        padding = proposal_count - image_boxes.size()[0]
+        if padding > 0:
+            image_boxes = torch.cat([image_boxes, image_boxes.new_zeros(padding, 4)], dim=0)
+        proposals.append(image_boxes)
+    normalized_boxes = torch.stack(proposals, dim=0)
 
     return normalized_boxes
 
@@ -397,91 +462,114 @@ def proposal_layer(inputs, proposal_count, nms_threshold, anchors, config=None):
 #  ROIAlign Layer
 ############################################################
 
-def pyramid_roi_align(inputs, pool_size, image_shape):
+class ROIPyramid(object):
+    """The feature maps pooled by the heads, prepared once per forward pass
+    and shared by the classifier and mask heads.
+    - feature_maps: List of feature maps from different levels of the pyramid.
+                    Each is [batch, channels, height, width]
+    - fused: Whether to pack the levels and pool all boxes in one pass. By
+             default with the PyTorch crop and resize on the GPU.
+    The PyTorch crop and resize samples channels last features, so the levels
+    are laid out channels last once here, either packed into a single tensor
+    so that all boxes are pooled in one pass (faster on the GPU) or level by
+    level (faster on the CPU), rather than on every call of both heads. The
+    pyramid level of the last boxes is kept, so heads pooling the same boxes
+    (the classifier and mask heads in training) assign them once.
+    """
+
+    def __init__(self, feature_maps, fused=None):
+        # The C extension only takes float32 feature maps, the PyTorch
+        # crop and resize also pools the bfloat16 ones of autocast.
+        torch_backend = get_backend() == "torch"
+        if not torch_backend:
+            feature_maps = [f.float() for f in feature_maps]
+        if fused is None:
+            fused = torch_backend and feature_maps[0].is_cuda
+        self.feature_maps = feature_maps
+        self.fused = fused
+        self.packed = crop_and_resize_torch.pack_levels(feature_maps) if fused else None
+        self.channels_last = None
+        if torch_backend and not fused:
+            self.channels_last = [crop_and_resize_torch.channels_last(f) for f in feature_maps]
+        self._boxes = None
+        self._levels = None
+
+    def levels(self, boxes, image_shape):
+        """Assigns each ROI to a level in the pyramid based on the ROI area.
+        boxes: [num_boxes, (y1, x1, y2, x2)] in normalized coordinates.
+        Returns [num_boxes] index of the level in feature_maps (0 for P2).
+        """
+        if boxes is self._boxes:
+            return self._levels
+
+        y1, x1, y2, x2 = boxes.detach().unbind(1)
+        h = y2 - y1
+        w = x2 - x1
+
+        # Equation 1 in the Feature Pyramid Networks paper. Account for
+        # the fact that our coordinates are normalized here.
+        # e.g. a 224x224 ROI (in pixels) maps to P4
+        image_area = float(image_shape[0]*image_shape[1])
+        roi_level = 4 + log2(torch.sqrt(h*w)/(224.0/math.sqrt(image_area)))
+        roi_level = roi_level.round().long()
+        roi_level = roi_level.clamp(2, 5)
+
+        # Holding on to the boxes keeps their identity from being reused
+        self._boxes = boxes
+        self._levels = roi_level - 2
+        return self._levels
+
+
+def pyramid_roi_align(pyramid, boxes, box_ind, pool_size, image_shape):
     """Implements ROI Pooling on multiple levels of the feature pyramid.
     Params:
+    - pyramid: ROIPyramid of the feature maps to pool from.
+    - boxes: [num_boxes, (y1, x1, y2, x2)] in normalized coordinates. The
+             boxes of all images in the batch packed together.
+    - box_ind: [num_boxes] index of the image in the batch each box belongs to.
     - pool_size: [height, width] of the output pooled regions. Usually [7, 7]
     - image_shape: [height, width, channels]. Shape of input image in pixels
-    Inputs:
-    - boxes: [batch, num_boxes, (y1, x1, y2, x2)] in normalized
-             coordinates.
-    - Feature maps: List of feature maps from different levels of the pyramid.
-                    Each is [batch, channels, height, width]
     Output:
-    Pooled regions in the shape: [num_boxes, height, width, channels].
+    Pooled regions in the shape: [num_boxes, channels, height, width], in
+    the order of the boxes.
     The width and height are those specific in the pool_shape in the layer
     constructor.
     """
+    levels = pyramid.levels(boxes, image_shape)
+
+    # Stop gradient propogation to ROI proposals
+    boxes = boxes.detach()
 
-    # Currently only supports batchsize 1
-    for i in range(len(inputs)):
-        inputs[i] = inputs[i].squeeze(0)
-
-    # Crop boxes [batch, num_boxes, (y1, x1, y2, x2)] in normalized coords
-    boxes = inputs[0]
-
-    # Feature Maps. List of feature maps from different level of the
-    # feature pyramid. Each is [batch, height, width, channels]
-    feature_maps = inputs[1:]
-
-    # Assign each ROI to a level in the pyramid based on the ROI area.
-    y1, x1, y2, x2 = boxes.chunk(4, dim=1)
-    h = y2 - y1
-    w = x2 - x1
-
-    # Equation 1 in the Feature Pyramid Networks paper. Account for
-    # the fact that our coordinates are normalized here.
-    # e.g. a 224x224 ROI (in pixels) maps to P4
-    image_area = Variable(torch.FloatTensor([float(image_shape[0]*image_shape[1])]), requires_grad=False)
-    if boxes.is_cuda:
-        image_area = image_area.cuda()
-    roi_level = 4 + log2(torch.sqrt(h*w)/(224.0/torch.sqrt(image_area)))
-    roi_level = roi_level.round().int()
-    roi_level = roi_level.clamp(2,5)
-
-
-    # Loop through levels and apply ROI pooling to each. P2 to P5.
-    pooled = []
-    box_to_level = []
-    for i, level in enumerate(range(2, 6)):
-        ix  = roi_level==level
-        if not ix.any():
+    # Crop and Resize
+    # From Mask R-CNN paper: "We sample four regular locations, so
+    # that we can evaluate either max or average pooling. In fact,
+    # interpolating only a single value at each bin center (without
+    # pooling) is nearly as effective."
+    #
+    # Here we use the simplified approach of a single value per bin,
+    # which is how it's done in tf.crop_and_resize()
+    # Result: [num_boxes, channels, pool_height, pool_width]
+    # The box indices select the image of the batch to crop from.
+    if pyramid.fused:
+        return crop_and_resize_torch.multilevel_crop_and_resize(
+            pyramid.packed, boxes, box_ind, levels, pool_size, pool_size)
+
+    # Otherwise pool level by level, P2 to P5, straight into the rows of
+    # the boxes of the level.
+    feature_maps = pyramid.feature_maps
+    pooled = feature_maps[0].new_zeros(boxes.size()[0], feature_maps[0].size()[1], pool_size, pool_size)
+    for i in range(len(feature_maps)):
+        ix = torch.nonzero(levels == i)[:, 0]
+        if not ix.size()[0]:
             continue
-        ix = torch.nonzero(ix)[:,0]
-        level_boxes = boxes[ix.data, :]
-
-        # Keep track of which box is mapped to which level
-        box_to_level.append(ix.data)
-
-        # Stop gradient propogation to ROI proposals
-        level_boxes = level_boxes.detach()
-
-        # Crop and Resize
-        # From Mask R-CNN paper: "We sample four regular locations, so
-        # that we can evaluate either max or average pooling. In fact,
-        # interpolating only a single value at each bin center (without
-        # pooling) is nearly as effective."
-        #
-        # Here we use the simplified approach of a single value per bin,
-        # which is how it's done in tf.crop_and_resize()
-        # Result: [batch * num_boxes, pool_height, pool_width, channels]
-        ind = Variable(torch.zeros(level_boxes.size()[0]),requires_grad=False).int()
-        if level_boxes.is_cuda:
-            ind = ind.cuda()
-        feature_maps[i] = feature_maps[i].unsqueeze(0)  #CropAndResizeFunction needs batch dimension
-        pooled_features = CropAndResizeFunction(pool_size, pool_size, 0)(feature_maps[i], level_boxes, ind)
-        pooled.append(pooled_features)
-
-    # Pack pooled features into one tensor
-    pooled = torch.cat(pooled, dim=0)
-
-    # Pack box_to_level mapping into one array and add another
-    # column representing the order of pooled boxes
-    box_to_level = torch.cat(box_to_level, dim=0)
-
-    # Rearrange pooled features to match the order of the original boxes
-    _, box_to_level = torch.sort(box_to_level)
-    pooled = pooled[box_to_level, :, :]
+        ind = box_ind[ix].int()
+        if pyramid.channels_last is not None:
+            crops = crop_and_resize_torch.crop_and_resize(feature_maps[i], boxes[ix], ind, pool_size, pool_size,
+                                                          features=pyramid.channels_last[i])
+        else:
+            crops = CropAndResizeFunction(pool_size, pool_size, 0)(feature_maps[i], boxes[ix], ind)
+        # Under autocast the crops may come back in float32 from bfloat16 maps
+        pooled[ix] = crops.to(pooled.dtype)
 
     return pooled
 
@@ -509,10 +597,7 @@ def bbox_overlaps(boxes1, boxes2):
     x1 = torch.max(b1_x1, b2_x1)[:, 0]
     y2 = torch.min(b1_y2, b2_y2)[:, 0]
     x2 = torch.min(b1_x2, b2_x2)[:, 0]
-    zeros = Variable(torch.zeros(y1.size()[0]), requires_grad=False)
-    if y1.is_cuda:
-        zeros = zeros.cuda()
-    intersection = torch.max(x2 - x1, zeros) * torch.max(y2 - y1, zeros)
+    intersection = (x2 - x1).clamp(min=0) * (y2 - y1).clamp(min=0)
 
     # 3. Compute unions
     b1_area = (b1_y2 - b1_y1) * (b1_x2 - b1_x1)
@@ -525,39 +610,30 @@ def bbox_overlaps(boxes1, boxes2):
 
     return overlaps
 
-def detection_target_layer(proposals, gt_class_ids, gt_boxes, gt_masks, config):
-    """Subsamples proposals and generates target box refinment, class_ids,
-    and masks for each.
+def detection_targets(proposals, gt_class_ids, gt_boxes, gt_masks, config, constants):
+    """Subsamples the proposals of one image and generates target box
+    refinment, class_ids, and masks for each.
     Inputs:
-    proposals: [batch, N, (y1, x1, y2, x2)] in normalized coordinates. Might
-               be zero padded if there are not enough proposals.
-    gt_class_ids: [batch, MAX_GT_INSTANCES] Integer class IDs.
-    gt_boxes: [batch, MAX_GT_INSTANCES, (y1, x1, y2, x2)] in normalized
-              coordinates.
-    gt_masks: [batch, height, width, MAX_GT_INSTANCES] of boolean type
+    proposals: [N, (y1, x1, y2, x2)] in normalized coordinates, without
+               zero padding.
+    gt_class_ids: [instances] Integer class IDs, without zero padding.
+    gt_boxes: [instances, (y1, x1, y2, x2)] in normalized coordinates.
+    gt_masks: [instances, height, width] of 0/1 values
+    constants: TensorConstants of the model.
     Returns: Target ROIs and corresponding class IDs, bounding box shifts,
     and masks.
-    rois: [batch, TRAIN_ROIS_PER_IMAGE, (y1, x1, y2, x2)] in normalized
-          coordinates
-    target_class_ids: [batch, TRAIN_ROIS_PER_IMAGE]. Integer class IDs.
-    target_deltas: [batch, TRAIN_ROIS_PER_IMAGE, NUM_CLASSES,
-                    (dy, dx, log(dh), log(dw), class_id)]
-                   Class-specific bbox refinments.
-    target_mask: [batch, TRAIN_ROIS_PER_IMAGE, height, width)
-                 Masks cropped to bbox boundaries and resized to neural
-                 network output size.
+    rois: [num_rois, (y1, x1, y2, x2)] in normalized coordinates, at most
+          TRAIN_ROIS_PER_IMAGE.
+    target_class_ids: [num_rois]. Integer class IDs.
+    target_deltas: [num_rois, (dy, dx, log(dh), log(dw))]. Bbox refinments
+                   of the positive ROIs, zeros for the negative ones.
+    target_mask: [num_rois, height, width]. Masks cropped to bbox
+                 boundaries and resized to neural network output size.
     """
-
-    # Currently only supports batchsize 1
-    proposals = proposals.squeeze(0)
-    gt_class_ids = gt_class_ids.squeeze(0)
-    gt_boxes = gt_boxes.squeeze(0)
-    gt_masks = gt_masks.squeeze(0)
-
     # Handle COCO crowds
     # A crowd box in COCO is a bounding box around several instances. Exclude
     # them from training. A crowd box is given a negative class ID.
-    if torch.nonzero(gt_class_ids < 0).size():
+    if torch.nonzero(gt_class_ids < 0).size()[0]:
         crowd_ix = torch.nonzero(gt_class_ids < 0)[:, 0]
         non_crowd_ix = torch.nonzero(gt_class_ids > 0)[:, 0]
         crowd_boxes = gt_boxes[crowd_ix.data, :]
@@ -571,30 +647,29 @@ def detection_target_layer(proposals, gt_class_ids, gt_boxes, gt_masks, config):
         crowd_iou_max = torch.max(crowd_overlaps, dim=1)[0]
         no_crowd_bool = crowd_iou_max < 0.001
     else:
-        no_crowd_bool =  Variable(torch.ByteTensor(proposals.size()[0]*[True]), requires_grad=False)
-        if config.GPU_COUNT:
-            no_crowd_bool = no_crowd_bool.cuda()
+        no_crowd_bool = proposals.new_ones(proposals.size()[0], dtype=torch.bool)
 
     # Compute overlaps matrix [proposals, gt_boxes]
     overlaps = bbox_overlaps(proposals, gt_boxes)
 
-    # Determine postive and negative ROIs
-    roi_iou_max = torch.max(overlaps, dim=1)[0]
+    # Determine postive and negative ROIs. Images of only crowds have none.
+    if gt_boxes.size()[0]:
+        roi_iou_max = torch.max(overlaps, dim=1)[0]
+    else:
+        roi_iou_max = proposals.new_zeros(proposals.size()[0])
 
     # 1. Positive ROIs are those with >= 0.5 IoU with a GT box
     positive_roi_bool = roi_iou_max >= 0.5
 
     # Subsample ROIs. Aim for 33% positive
     # Positive ROIs
-    if torch.nonzero(positive_roi_bool).size():
+    if torch.nonzero(positive_roi_bool).size()[0]:
         positive_indices = torch.nonzero(positive_roi_bool)[:, 0]
 
         positive_count = int(config.TRAIN_ROIS_PER_IMAGE *
                              config.ROI_POSITIVE_RATIO)
-        rand_idx = torch.randperm(positive_indices.size()[0])
+        rand_idx = torch.randperm(positive_indices.size()[0], device=positive_indices.device)
         rand_idx = rand_idx[:positive_count]
-        if config.GPU_COUNT:
-            rand_idx = rand_idx.cuda()
         positive_indices = positive_indices[rand_idx]
         positive_count = positive_indices.size()[0]
         positive_rois = proposals[positive_indices.data,:]
@@ -607,10 +682,7 @@ def detection_target_layer(proposals, gt_class_ids, gt_boxes, gt_masks, config):
 
         # Compute bbox refinement for positive ROIs
         deltas = Variable(utils.box_refinement(positive_rois.data, roi_gt_boxes.data), requires_grad=False)
-        std_dev = Variable(torch.from_numpy(config.BBOX_STD_DEV).float(), requires_grad=False)
-        if config.GPU_COUNT:
-            std_dev = std_dev.cuda()
-        deltas /= std_dev
+        deltas /= constants.bbox_std_dev
 
         # Assign positive ROIs to GT masks
         roi_masks = gt_masks[roi_gt_box_assignment.data,:,:]
@@ -629,9 +701,7 @@ def detection_target_layer(proposals, gt_class_ids, gt_boxes, gt_masks, config):
             y2 = (y2 - gt_y1) / gt_h
             x2 = (x2 - gt_x1) / gt_w
             boxes = torch.cat([y1, x1, y2, x2], dim=1)
-        box_ids = Variable(torch.arange(roi_masks.size()[0]), requires_grad=False).int()
-        if config.GPU_COUNT:
-            box_ids = box_ids.cuda()
+        box_ids = torch.arange(roi_masks.size()[0], dtype=torch.int, device=roi_masks.device)
         masks = Variable(CropAndResizeFunction(config.MASK_SHAPE[0], config.MASK_SHAPE[1], 0)(roi_masks.unsqueeze(1), boxes, box_ids).data, requires_grad=False)
         masks = masks.squeeze(1)
 
@@ -645,14 +715,12 @@ def detection_target_layer(proposals, gt_class_ids, gt_boxes, gt_masks, config):
     negative_roi_bool = roi_iou_max < 0.5
     negative_roi_bool = negative_roi_bool & no_crowd_bool
     # Negative ROIs. Add enough to maintain positive:negative ratio.
-    if torch.nonzero(negative_roi_bool).size() and positive_count>0:
+    if torch.nonzero(negative_roi_bool).size()[0] and positive_count>0:
         negative_indices = torch.nonzero(negative_roi_bool)[:, 0]
         r = 1.0 / config.ROI_POSITIVE_RATIO
         negative_count = int(r * positive_count - positive_count)
-        rand_idx = torch.randperm(negative_indices.size()[0])
+        rand_idx = torch.randperm(negative_indices.size()[0], device=negative_indices.device)
         rand_idx = rand_idx[:negative_count]
-        if config.GPU_COUNT:
-            rand_idx = rand_idx.cuda()
         negative_indices = negative_indices[rand_idx]
         negative_count = negative_indices.size()[0]
         negative_rois = proposals[negative_indices.data, :]
@@ -663,47 +731,57 @@ def detection_target_layer(proposals, gt_class_ids, gt_boxes, gt_masks, config):
     # are not used for negative ROIs with zeros.
     if positive_count > 0 and negative_count > 0:
         rois = torch.cat((positive_rois, negative_rois), dim=0)
-        zeros = Variable(torch.zeros(negative_count), requires_grad=False).int()
-        if config.GPU_COUNT:
-            zeros = zeros.cuda()
+        zeros = roi_gt_class_ids.new_zeros(negative_count)
         roi_gt_class_ids = torch.cat([roi_gt_class_ids, zeros], dim=0)
-        zeros = Variable(torch.zeros(negative_count,4), requires_grad=False)
-        if config.GPU_COUNT:
-            zeros = zeros.cuda()
+        zeros = deltas.new_zeros(negative_count, 4)
         deltas = torch.cat([deltas, zeros], dim=0)
-        zeros = Variable(torch.zeros(negative_count,config.MASK_SHAPE[0],config.MASK_SHAPE[1]), requires_grad=False)
-        if config.GPU_COUNT:
-            zeros = zeros.cuda()
+        zeros = masks.new_zeros(negative_count, config.MASK_SHAPE[0], config.MASK_SHAPE[1])
         masks = torch.cat([masks, zeros], dim=0)
     elif positive_count > 0:
         rois = positive_rois
-    elif negative_count > 0:
-        rois = negative_rois
-        zeros = Variable(torch.zeros(negative_count), requires_grad=False)
-        if config.GPU_COUNT:
-            zeros = zeros.cuda()
-        roi_gt_class_ids = zeros
-        zeros = Variable(torch.zeros(negative_count,4), requires_grad=False).int()
-        if config.GPU_COUNT:
-            zeros = zeros.cuda()
-        deltas = zeros
-        zeros = Variable(torch.zeros(negative_count,config.MASK_SHAPE[0],config.MASK_SHAPE[1]), requires_grad=False)
-        if config.GPU_COUNT:
-            zeros = zeros.cuda()
-        masks = zeros
     else:
-        rois = Variable(torch.FloatTensor(), requires_grad=False)
-        roi_gt_class_ids = Variable(torch.IntTensor(), requires_grad=False)
-        deltas = Variable(torch.FloatTensor(), requires_grad=False)
-        masks = Variable(torch.FloatTensor(), requires_grad=False)
-        if config.GPU_COUNT:
-            rois = rois.cuda()
-            roi_gt_class_ids = roi_gt_class_ids.cuda()
-            deltas = deltas.cuda()
-            masks = masks.cuda()
+        # No positive ROIs, and so no negative ones either
+        rois = proposals.new_zeros(0, 4)
+        roi_gt_class_ids = gt_class_ids.new_zeros(0)
+        deltas = proposals.new_zeros(0, 4)
+        masks = proposals.new_zeros(0, config.MASK_SHAPE[0], config.MASK_SHAPE[1])
 
     return rois, roi_gt_class_ids, deltas, masks
 
+def detection_target_layer(proposals, gt_class_ids, gt_boxes, gt_masks, config, constants):
+    """Generates the detection targets of every image of a batch, see
+    detection_targets(), and packs them into single lists of ROIs.
+    Inputs:
+    proposals: [batch, N, (y1, x1, y2, x2)] in normalized coordinates. Might
+               be zero padded if there are not enough proposals.
+    gt_class_ids: [batch, instances] Integer class IDs. Zero padded.
+    gt_boxes: [batch, instances, (y1, x1, y2, x2)] in normalized
+              coordinates. Zero padded.
+    gt_masks: [batch, instances, height, width] of 0/1 values. Zero padded.
+    constants: TensorConstants of the model.
+    Returns: the targets of all images one after the other,
+    rois: [num_rois, (y1, x1, y2, x2)] in normalized coordinates
+    roi_image_ids: [num_rois] image of the batch of each ROI.
+    target_class_ids: [num_rois]. Integer class IDs.
+    target_deltas: [num_rois, (dy, dx, log(dh), log(dw))]
+    target_mask: [num_rois, height, width]
+    """
+    # Sampling the ROIs of an image depends on its number of proposals and
+    # instances, so go image by image. The heads and losses then run on
+    # the ROIs of the whole batch at once.
+    targets = []
+    for b in range(proposals.size()[0]):
+        # Remove the zero padding of the proposals and of the instances
+        image_proposals = proposals[b][torch.nonzero(proposals[b].abs().sum(dim=1) > 0)[:, 0].data]
+        instances = torch.nonzero(gt_class_ids[b] != 0)[:, 0].data
+        targets.append(detection_targets(image_proposals, gt_class_ids[b][instances], gt_boxes[b][instances],
+                                         gt_masks[b][instances], config, constants))
+
+    rois, target_class_ids, target_deltas, target_mask = [torch.cat(t, dim=0) for t in zip(*targets)]
+    roi_image_ids = torch.cat([torch.full((t[0].size()[0],), b, dtype=torch.long, device=rois.device)
+                               for b, t in enumerate(targets)])
+    return rois, roi_image_ids, target_class_ids, target_deltas, target_mask
+
 
 ############################################################
 #  Detection Layer
@@ -721,7 +799,7 @@ def clip_to_window(window, boxes):
 
     return boxes
 
-def refine_detections(rois, probs, deltas, window, config):
+def refine_detections(rois, probs, deltas, window, config, constants):
     """Refine classified proposals and filter overlaps and return final
     detections.
     Inputs:
@@ -731,6 +809,7 @@ def refine_detections(rois, probs, deltas, window, config):
                 bounding box deltas.
         window: (y1, x1, y2, x2) in image coordinates. The part of the image
             that contains the image excluding the padding.
+        constants: TensorConstants of the model.
     Returns detections shaped: [N, (y1, x1, y2, x2, class_id, score)]
     """
 
@@ -739,25 +818,16 @@ def refine_detections(rois, probs, deltas, window, config):
 
     # Class probability of the top class of each ROI
     # Class-specific bounding box deltas
-    idx = torch.arange(class_ids.size()[0]).long()
-    if config.GPU_COUNT:
-        idx = idx.cuda()
+    idx = torch.arange(class_ids.size()[0], device=class_ids.device)
     class_scores = probs[idx, class_ids.data]
     deltas_specific = deltas[idx, class_ids.data]
 
     # Apply bounding box deltas
     # Shape: [boxes, (y1, x1, y2, x2)] in normalized coordinates
-    std_dev = Variable(torch.from_numpy(np.reshape(config.RPN_BBOX_STD_DEV, [1, 4])).float(), requires_grad=False)
-    if config.GPU_COUNT:
-        std_dev = std_dev.cuda()
-    refined_rois = apply_box_deltas(rois, deltas_specific * std_dev)
+    refined_rois = apply_box_deltas(rois, deltas_specific * constants.rpn_bbox_std_dev)
 
     # Convert coordiates to image domain
-    height, width = config.IMAGE_SHAPE[:2]
-    scale = Variable(torch.from_numpy(np.array([height, width, height, width])).float(), requires_grad=False)
-    if config.GPU_COUNT:
-        scale = scale.cuda()
-    refined_rois *= scale
+    refined_rois *= constants.image_scale
 
     # Clip boxes to image window
     refined_rois = clip_to_window(window, refined_rois)
@@ -775,36 +845,20 @@ def refine_detections(rois, probs, deltas, window, config):
         keep_bool = keep_bool & (class_scores >= config.DETECTION_MIN_CONFIDENCE)
     keep = torch.nonzero(keep_bool)[:,0]
 
-    # Apply per-class NMS
+    # Nothing left to suppress
+    if keep.size()[0] == 0:
+        return refined_rois.new_zeros(0, 6)
+
+    # Apply per-class NMS to all classes in one call
     pre_nms_class_ids = class_ids[keep.data]
     pre_nms_scores = class_scores[keep.data]
     pre_nms_rois = refined_rois[keep.data]
+    nms_keep = batched_nms(torch.cat((pre_nms_rois, pre_nms_scores.unsqueeze(1)), dim=1).data,
+                           pre_nms_class_ids.data, config.DETECTION_NMS_THRESHOLD)
 
-    for i, class_id in enumerate(unique1d(pre_nms_class_ids)):
-        # Pick detections of this class
-        ixs = torch.nonzero(pre_nms_class_ids == class_id)[:,0]
-
-        # Sort
-        ix_rois = pre_nms_rois[ixs.data]
-        ix_scores = pre_nms_scores[ixs]
-        ix_scores, order = ix_scores.sort(descending=True)
-        ix_rois = ix_rois[order.data,:]
-
-        class_keep = nms(torch.cat((ix_rois, ix_scores.unsqueeze(1)), dim=1).data, config.DETECTION_NMS_THRESHOLD)
-
-        # Map indicies
-        class_keep = keep[ixs[order[class_keep].data].data]
-
-        if i==0:
-            nms_keep = class_keep
-        else:
-            nms_keep = unique1d(torch.cat((nms_keep, class_keep)))
-    keep = intersect1d(keep, nms_keep)
-
-    # Keep top detections
+    # Keep top detections. batched_nms() returns them by decreasing score.
     roi_count = config.DETECTION_MAX_INSTANCES
-    top_ids = class_scores[keep.data].sort(descending=True)[1][:roi_count]
-    keep = keep[top_ids.data]
+    keep = keep[nms_keep[:roi_count]]
 
     # Arrange output as [N, (y1, x1, y2, x2, class_id, score)]
     # Coordinates are in image domain.
@@ -815,21 +869,32 @@ def refine_detections(rois, probs, deltas, window, config):
     return result
 
 
-def detection_layer(config, rois, mrcnn_class, mrcnn_bbox, image_meta):
+def detection_layer(config, rois, roi_image_ids, mrcnn_class, mrcnn_bbox, image_meta, constants):
     """Takes classified proposal boxes and their bounding box deltas and
     returns the final detection boxes.
+    rois: [num_rois, (y1, x1, y2, x2)] ROIs of all images in the batch in
+          normalized coordinates.
+    roi_image_ids: [num_rois] index of the image in the batch each ROI
+                   belongs to.
     Returns:
-    [batch, num_detections, (y1, x1, y2, x2, class_score)] in pixels
+    [batch, DETECTION_MAX_INSTANCES, (y1, x1, y2, x2, class_id, score)] in
+    pixels. Zero padded if an image has fewer detections.
     """
 
-    # Currently only supports batchsize 1
-    rois = rois.squeeze(0)
+    _, _, windows, _ = parse_image_meta(image_meta)
+
+    detections = []
+    for b in range(windows.shape[0]):
+        ix = torch.nonzero(roi_image_ids == b)[:, 0]
+        image_detections = refine_detections(rois[ix.data], mrcnn_class[ix.data],
+                                             mrcnn_bbox[ix.data], windows[b], config, constants)
 
-    _, _, window, _ = parse_image_meta(image_meta)
-    window = window[0]
-    detections = refine_detections(rois, mrcnn_class, mrcnn_bbox, window, config)
+        padding = config.DETECTION_MAX_INSTANCES - image_detections.size()[0]
+        if padding > 0:
+            image_detections = torch.cat([image_detections, image_detections.new_zeros(padding, 6)], dim=0)
+        detections.append(image_detections)
 
-    return detections
+    return torch.stack(detections, dim=0)
 
 
 ############################################################
@@ -874,7 +939,8 @@ class RPN(nn.Module):
         rpn_class_logits = rpn_class_logits.view(x.size()[0], -1, 2)
 
         # Softmax on last dimension of BG/FG.
-        rpn_probs = self.softmax(rpn_class_logits)
+        # Scores in float32 under autocast, bfloat16 would tie most of them
+        rpn_probs = self.softmax(rpn_class_logits.float())
 
         # Bounding box refinement. [batch, H, W, anchors per location, depth]
         # where depth is [x, y, log(w), log(h)]
@@ -910,8 +976,8 @@ class Classifier(nn.Module):
 
         self.linear_bbox = nn.Linear(1024, num_classes * 4)
 
-    def forward(self, x, rois):
-        x = pyramid_roi_align([rois]+x, self.pool_size, self.image_shape)
+    def forward(self, pyramid, rois, roi_image_ids):
+        x = pyramid_roi_align(pyramid, rois, roi_image_ids, self.pool_size, self.image_shape)
         x = self.conv1(x)
         x = self.bn1(x)
         x = self.relu(x)
@@ -921,7 +987,7 @@ class Classifier(nn.Module):
 
         x = x.view(-1,1024)
         mrcnn_class_logits = self.linear_class(x)
-        mrcnn_probs = self.softmax(mrcnn_class_logits)
+        mrcnn_probs = self.softmax(mrcnn_class_logits.float())
 
         mrcnn_bbox = self.linear_bbox(x)
         mrcnn_bbox = mrcnn_bbox.view(mrcnn_bbox.size()[0], -1, 4)
@@ -949,8 +1015,8 @@ class Mask(nn.Module):
         self.sigmoid = nn.Sigmoid()
         self.relu = nn.ReLU(inplace=True)
 
-    def forward(self, x, rois):
-        x = pyramid_roi_align([rois] + x, self.pool_size, self.image_shape)
+    def forward(self, pyramid, rois, roi_image_ids):
+        x = pyramid_roi_align(pyramid, rois, roi_image_ids, self.pool_size, self.image_shape)
         x = self.conv1(self.padding(x))
         x = self.bn1(x)
         x = self.relu(x)
@@ -1015,13 +1081,21 @@ def compute_rpn_bbox_loss(target_bbox, rpn_match, rpn_bbox):
 
     # Positive anchors contribute to the loss, but negative and
     # neutral anchors (match value of 0 or -1) don't.
-    indices = torch.nonzero(rpn_match==1)
+    positive = rpn_match == 1
+    indices = torch.nonzero(positive)
 
     # Pick bbox deltas that contribute to the loss
     rpn_bbox = rpn_bbox[indices.data[:,0],indices.data[:,1]]
 
-    # Trim target bounding box deltas to the same length as rpn_bbox.
-    target_bbox = target_bbox[0,:rpn_bbox.size()[0],:]
+    # The target deltas of each image are those of its positive anchors in
+    # anchor order, followed by zero padding. indices are sorted by image
+    # then anchor, so the target of a positive anchor is at its rank among
+    # the positive anchors of its image.
+    counts = positive.long().sum(dim=1)
+    starts = torch.cumsum(counts, dim=0) - counts
+    image_ix = indices.data[:, 0]
+    rank = torch.arange(indices.size()[0], device=indices.device) - starts[image_ix]
+    target_bbox = target_bbox[image_ix, rank]
 
     # Smooth L1 loss
     loss = F.smooth_l1_loss(rpn_bbox, target_bbox)
@@ -1031,30 +1105,28 @@ def compute_rpn_bbox_loss(target_bbox, rpn_match, rpn_bbox):
 
 def compute_mrcnn_class_loss(target_class_ids, pred_class_logits):
     """Loss for the classifier head of Mask RCNN.
-    target_class_ids: [batch, num_rois]. Integer class IDs. Uses zero
-        padding to fill in the array.
-    pred_class_logits: [batch, num_rois, num_classes]
+    target_class_ids: [num_rois]. Integer class IDs of the ROIs of all
+        images of the batch.
+    pred_class_logits: [num_rois, num_classes]
     """
 
     # Loss
-    if target_class_ids.size():
+    if target_class_ids.size()[0]:
         loss = F.cross_entropy(pred_class_logits,target_class_ids.long())
     else:
-        loss = Variable(torch.FloatTensor([0]), requires_grad=False)
-        if target_class_ids.is_cuda:
-            loss = loss.cuda()
+        loss = pred_class_logits.new_zeros(1)
 
     return loss
 
 
 def compute_mrcnn_bbox_loss(target_bbox, target_class_ids, pred_bbox):
     """Loss for Mask R-CNN bounding box refinement.
-    target_bbox: [batch, num_rois, (dy, dx, log(dh), log(dw))]
-    target_class_ids: [batch, num_rois]. Integer class IDs.
-    pred_bbox: [batch, num_rois, num_classes, (dy, dx, log(dh), log(dw))]
+    target_bbox: [num_rois, (dy, dx, log(dh), log(dw))]
+    target_class_ids: [num_rois]. Integer class IDs.
+    pred_bbox: [num_rois, num_classes, (dy, dx, log(dh), log(dw))]
     """
 
-    if target_class_ids.size():
+    if target_class_ids.size()[0]:
         # Only positive ROIs contribute to the loss. And only
         # the right class_id of each ROI. Get their indicies.
         positive_roi_ix = torch.nonzero(target_class_ids > 0)[:, 0]
@@ -1068,22 +1140,20 @@ def compute_mrcnn_bbox_loss(target_bbox, target_class_ids, pred_bbox):
         # Smooth L1 loss
         loss = F.smooth_l1_loss(pred_bbox, target_bbox)
     else:
-        loss = Variable(torch.FloatTensor([0]), requires_grad=False)
-        if target_class_ids.is_cuda:
-            loss = loss.cuda()
+        loss = pred_bbox.new_zeros(1)
 
     return loss
 
 
 def compute_mrcnn_mask_loss(target_masks, target_class_ids, pred_masks):
     """Mask binary cross-entropy loss for the masks head.
-    target_masks: [batch, num_rois, height, width].
-        A float32 tensor of values 0 or 1. Uses zero padding to fill array.
-    target_class_ids: [batch, num_rois]. Integer class IDs. Zero padded.
-    pred_masks: [batch, proposals, height, width, num_classes] float32 tensor
+    target_masks: [num_rois, height, width].
+        A float32 tensor of values 0 or 1.
+    target_class_ids: [num_rois]. Integer class IDs.
+    pred_masks: [num_rois, num_classes, height, width] float32 tensor
                 with values from 0 to 1.
     """
-    if target_class_ids.size():
+    if target_class_ids.size()[0]:
         # Only positive ROIs contribute to the loss. And only
         # the class specific mask of each ROI.
         positive_ix = torch.nonzero(target_class_ids > 0)[:, 0]
@@ -1097,9 +1167,7 @@ def compute_mrcnn_mask_loss(target_masks, target_class_ids, pred_masks):
         # Binary cross entropy
         loss = F.binary_cross_entropy(y_pred, y_true)
     else:
-        loss = Variable(torch.FloatTensor([0]), requires_grad=False)
-        if target_class_ids.is_cuda:
-            loss = loss.cuda()
+        loss = pred_masks.new_zeros(1)
 
     return loss
 
@@ -1118,6 +1186,41 @@ def compute_losses(rpn_match, rpn_bbox, rpn_class_logits, rpn_pred_bbox, target_
 #  Data Generator
 ############################################################
 
+def load_image_sample(dataset, config, image_id, use_mini_mask=False):
+    """Loads an image and its masks and preprocesses them. This is the
+    deterministic part of load_image_gt(), the one that can be cached.
+    Returns:
+    image: [height, width, 3]
+    shape: the original shape of the image before resizing and cropping.
+    window: (y1, x1, y2, x2) of the image in the padded image.
+    class_ids: [instance_count] Integer class IDs
+    bbox: [instance_count, (y1, x1, y2, x2)]
+    mask: [height, width, instance_count] or mini masks, see load_image_gt()
+    """
+    # Load image and mask
+    image = dataset.load_image(image_id)
+    mask, class_ids = dataset.load_mask(image_id)
+    # Packed images are stored resized, their info keeps the source shape
+    shape = tuple(dataset.image_info[image_id].get("original_shape", image.shape))
+    image, window, scale, padding = utils.resize_image(
+        image,
+        min_dim=config.IMAGE_MIN_DIM,
+        max_dim=config.IMAGE_MAX_DIM,
+        padding=config.IMAGE_PADDING)
+    mask = utils.resize_mask(mask, scale, padding)
+
+    # Bounding boxes. Note that some boxes might be all zeros
+    # if the corresponding mask got cropped out.
+    # bbox: [num_instances, (y1, x1, y2, x2)]
+    bbox = utils.extract_bboxes(mask)
+
+    # Resize masks to smaller size to reduce memory usage
+    if use_mini_mask:
+        mask = utils.minimize_mask(bbox, mask, config.MINI_MASK_SHAPE)
+
+    return image, shape, window, class_ids, bbox, mask
+
+
 def load_image_gt(dataset, config, image_id, augment=False,
                   use_mini_mask=False):
     """Load and return ground truth data for an image (image, mask, bounding boxes).
@@ -1137,27 +1240,28 @@ def load_image_gt(dataset, config, image_id, augment=False,
         of the image unless use_mini_mask is True, in which case they are
         defined in MINI_MASK_SHAPE.
     """
-    # Load image and mask
-    image = dataset.load_image(image_id)
-    mask, class_ids = dataset.load_mask(image_id)
-    shape = image.shape
-    image, window, scale, padding = utils.resize_image(
-        image,
-        min_dim=config.IMAGE_MIN_DIM,
-        max_dim=config.IMAGE_MAX_DIM,
-        padding=config.IMAGE_PADDING)
-    mask = utils.resize_mask(mask, scale, padding)
+    # Load and preprocess the image, or get it from the sample cache
+    if config.SAMPLE_CACHE_DIR:
+        cache = samplecache.SampleCache(config.SAMPLE_CACHE_DIR, config, use_mini_mask)
+        sample = cache.load(dataset, image_id)
+        if sample is None:
+            sample = load_image_sample(dataset, config, image_id, use_mini_mask)
+            cache.save(dataset, image_id, sample)
+    else:
+        sample = load_image_sample(dataset, config, image_id, use_mini_mask)
+    image, shape, window, class_ids, bbox, mask = sample
 
     # Random horizontal flips.
+    # Applied to the preprocessed sample: mini masks are flipped with their
+    # box, so they can be cached.
     if augment:
         if random.randint(0, 1):
             image = np.fliplr(image)
             mask = np.fliplr(mask)
-
-    # Bounding boxes. Note that some boxes might be all zeros
-    # if the corresponding mask got cropped out.
-    # bbox: [num_instances, (y1, x1, y2, x2)]
-    bbox = utils.extract_bboxes(mask)
+            # Mirror the boxes. All zero boxes of cropped out masks stay so.
+            width = image.shape[1]
+            flipped = np.stack([bbox[:, 0], width - bbox[:, 3], bbox[:, 2], width - bbox[:, 1]], axis=1)
+            bbox = np.where(np.any(bbox != 0, axis=1, keepdims=True), flipped, bbox).astype(np.int32)
 
     # Active classes
     # Different datasets have different classes, so track the
@@ -1166,10 +1270,6 @@ def load_image_gt(dataset, config, image_id, augment=False,
     source_class_ids = dataset.source_class_ids[dataset.image_info[image_id]["source"]]
     active_class_ids[source_class_ids] = 1
 
-    # Resize masks to smaller size to reduce memory usage
-    if use_mini_mask:
-        mask = utils.minimize_mask(bbox, mask, config.MINI_MASK_SHAPE)
-
     # Image meta data
     image_meta = compose_image_meta(image_id, shape, window, active_class_ids)
 
@@ -1178,7 +1278,7 @@ def load_image_gt(dataset, config, image_id, augment=False,
 def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
     """Given the anchors and GT boxes, compute overlaps and identify positive
     anchors and deltas to refine them to match their corresponding GT boxes.
-    anchors: [num_anchors, (y1, x1, y2, x2)]
+    anchors: Anchors of the config, see anchors.get_anchors().
     gt_class_ids: [num_gt_boxes] Integer class IDs.
     gt_boxes: [num_gt_boxes, (y1, x1, y2, x2)]
     Returns:
@@ -1201,16 +1301,25 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
         crowd_boxes = gt_boxes[crowd_ix]
         gt_class_ids = gt_class_ids[non_crowd_ix]
         gt_boxes = gt_boxes[non_crowd_ix]
-        # Compute overlaps with crowd boxes [anchors, crowds]
-        crowd_overlaps = utils.compute_overlaps(anchors, crowd_boxes)
+        # Compute overlaps with crowd boxes [anchors, crowds], only for the
+        # anchors that can overlap them. The others are not in a crowd.
+        no_crowd_bool = np.ones([anchors.shape[0]], dtype=bool)
+        crowd_candidates = anchors.overlapping(crowd_boxes)
+        crowd_overlaps = utils.compute_overlaps(anchors.boxes[crowd_candidates], crowd_boxes,
+                                                anchors.areas[crowd_candidates])
         crowd_iou_max = np.amax(crowd_overlaps, axis=1)
-        no_crowd_bool = (crowd_iou_max < 0.001)
+        no_crowd_bool[crowd_candidates] = (crowd_iou_max < 0.001)
     else:
         # All anchors don't intersect a crowd
         no_crowd_bool = np.ones([anchors.shape[0]], dtype=bool)
 
-    # Compute overlaps [num_anchors, num_gt_boxes]
-    overlaps = utils.compute_overlaps(anchors, gt_boxes)
+    # Compute overlaps [candidates, num_gt_boxes]
+    # Only for the anchors that can overlap a GT box. With few GT boxes per
+    # image that's a small part of the anchors. All the others have an IoU
+    # of 0 with every GT box.
+    candidates = anchors.overlapping(gt_boxes)
+    overlaps = utils.compute_overlaps(anchors.boxes[candidates], gt_boxes,
+                                      anchors.areas[candidates])
 
     # Match anchors to GT Boxes
     # If an anchor overlaps a GT box with IoU >= 0.7 then it's positive.
@@ -1222,12 +1331,23 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
     #
     # 1. Set negative anchors first. They get overwritten below if a GT box is
     # matched to them. Skip boxes in crowd areas.
-    anchor_iou_argmax = np.argmax(overlaps, axis=1)
-    anchor_iou_max = overlaps[np.arange(overlaps.shape[0]), anchor_iou_argmax]
+    # Anchors out of the candidates have a max IoU of 0 and, as argmax of
+    # their row of zeros, the first GT box.
+    anchor_iou_argmax = np.zeros([anchors.shape[0]], dtype=np.int64)
+    anchor_iou_max = np.zeros([anchors.shape[0]])
+    if candidates.shape[0]:
+        anchor_iou_argmax[candidates] = np.argmax(overlaps, axis=1)
+        anchor_iou_max[candidates] = overlaps[np.arange(overlaps.shape[0]), anchor_iou_argmax[candidates]]
     rpn_match[(anchor_iou_max < 0.3) & (no_crowd_bool)] = -1
     # 2. Set an anchor for each GT box (regardless of IoU value).
     # TODO: If multiple anchors have the same IoU match all of them
-    gt_iou_argmax = np.argmax(overlaps, axis=0)
+    # Candidates are sorted, so the argmax is still the first anchor with
+    # the max IoU. A GT box that overlaps no anchor gets the first anchor,
+    # the argmax of its column of zeros.
+    gt_iou_argmax = np.zeros([gt_boxes.shape[0]], dtype=np.int64)
+    if candidates.shape[0]:
+        gt_iou_argmax = np.where(np.amax(overlaps, axis=0) > 0,
+                                 candidates[np.argmax(overlaps, axis=0)], 0)
     rpn_match[gt_iou_argmax] = 1
     # 3. Set anchors with high overlap as positive.
     rpn_match[anchor_iou_max >= 0.7] = 1
@@ -1252,34 +1372,29 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
     # For positive anchors, compute shift and scale needed to transform them
     # to match the corresponding GT boxes.
     ids = np.where(rpn_match == 1)[0]
-    ix = 0  # index into rpn_bbox
     # TODO: use box_refinment() rather than duplicating the code here
-    for i, a in zip(ids, anchors[ids]):
-        # Closest gt box (it might have IoU < 0.7)
-        gt = gt_boxes[anchor_iou_argmax[i]]
-
-        # Convert coordinates to center plus width/height.
-        # GT Box
-        gt_h = gt[2] - gt[0]
-        gt_w = gt[3] - gt[1]
-        gt_center_y = gt[0] + 0.5 * gt_h
-        gt_center_x = gt[1] + 0.5 * gt_w
-        # Anchor
-        a_h = a[2] - a[0]
-        a_w = a[3] - a[1]
-        a_center_y = a[0] + 0.5 * a_h
-        a_center_x = a[1] + 0.5 * a_w
-
-        # Compute the bbox refinement that the RPN should predict.
-        rpn_bbox[ix] = [
-            (gt_center_y - a_center_y) / a_h,
-            (gt_center_x - a_center_x) / a_w,
-            np.log(gt_h / a_h),
-            np.log(gt_w / a_w),
-        ]
-        # Normalize
-        rpn_bbox[ix] /= config.RPN_BBOX_STD_DEV
-        ix += 1
+    # Closest gt box (it might have IoU < 0.7)
+    gt = gt_boxes[anchor_iou_argmax[ids]]
+
+    # Convert coordinates to center plus width/height.
+    # GT Box
+    gt_h = gt[:, 2] - gt[:, 0]
+    gt_w = gt[:, 3] - gt[:, 1]
+    gt_center_y = gt[:, 0] + 0.5 * gt_h
+    gt_center_x = gt[:, 1] + 0.5 * gt_w
+    # Anchor, precomputed
+    a_center_y, a_center_x = anchors.centers[ids].T
+    a_h, a_w = anchors.sizes[ids].T
+
+    # Compute the bbox refinement that the RPN should predict.
+    rpn_bbox[:ids.shape[0]] = np.stack([
+        (gt_center_y - a_center_y) / a_h,
+        (gt_center_x - a_center_x) / a_w,
+        np.log(gt_h / a_h),
+        np.log(gt_w / a_w),
+    ], axis=1)
+    # Normalize
+    rpn_bbox[:ids.shape[0]] /= config.RPN_BBOX_STD_DEV
 
     return rpn_match, rpn_bbox
 
@@ -1300,11 +1415,13 @@ class Dataset(torch.utils.data.Dataset):
             - image_metas: [batch, size of image meta]
             - rpn_match: [batch, N] Integer (1=positive anchor, -1=negative, 0=neutral)
             - rpn_bbox: [batch, N, (dy, dx, log(dh), log(dw))] Anchor bbox deltas.
-            - gt_class_ids: [batch, MAX_GT_INSTANCES] Integer class IDs
-            - gt_boxes: [batch, MAX_GT_INSTANCES, (y1, x1, y2, x2)]
-            - gt_masks: [batch, height, width, MAX_GT_INSTANCES]. The height and width
+            - gt_class_ids: [batch, instances] Integer class IDs
+            - gt_boxes: [batch, instances, (y1, x1, y2, x2)]
+            - gt_masks: [batch, instances, height, width]. The height and width
                         are those of the image unless use_mini_mask is True, in which
                         case they are defined in MINI_MASK_SHAPE.
+            The instances are at most MAX_GT_INSTANCES, and zero padded to
+            the same number in a batch by collate_samples().
             outputs list: Usually empty in regular training. But if detection_targets
                 is True then the outputs list contains target class_ids, bbox deltas,
                 and masks.
@@ -1318,13 +1435,11 @@ class Dataset(torch.utils.data.Dataset):
         self.config = config
         self.augment = augment
 
-        # Anchors
-        # [anchor_count, (y1, x1, y2, x2)]
-        self.anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
-                                                 config.RPN_ANCHOR_RATIOS,
-                                                 config.BACKBONE_SHAPES,
-                                                 config.BACKBONE_STRIDES,
-                                                 config.RPN_ANCHOR_STRIDE)
+        # Anchors, shared with the model and the other datasets
+        self.anchors = anchorlib.get_anchors(config)
+
+        # Instances per image, to skip images without any, see InstanceSampler
+        self.instance_counts = dataset.instance_counts()[self.image_ids]
 
     def __getitem__(self, image_index):
         # Get GT bounding boxes and masks for image.
@@ -1362,18 +1477,117 @@ class Dataset(torch.utils.data.Dataset):
         rpn_bbox = torch.from_numpy(rpn_bbox).float()
         gt_class_ids = torch.from_numpy(gt_class_ids)
         gt_boxes = torch.from_numpy(gt_boxes).float()
-        gt_masks = torch.from_numpy(gt_masks.astype(int).transpose(2, 0, 1)).float()
+        gt_masks = torch.from_numpy(gt_masks.astype(np.uint8).transpose(2, 0, 1))
 
         return images, image_metas, rpn_match, rpn_bbox, gt_class_ids, gt_boxes, gt_masks
 
     def __len__(self):
         return self.image_ids.shape[0]
 
+class InstanceSampler(torch.utils.data.Sampler):
+    """Samples the images of a Dataset that have instances, in a random
+    order every epoch. Images without instances are filtered out once from
+    the instance counts of the dataset, so workers don't load them only for
+    Dataset to return None.
+
+    In distributed training, each rank samples its own share of the images.
+    All ranks shuffle the images the same way, from seed and the number of
+    passes so far, and take every world_size-th one.
+    """
+
+    def __init__(self, data, shuffle=True, rank=0, world_size=1, seed=0):
+        self.indices = np.nonzero(data.instance_counts > 0)[0]
+        self.shuffle = shuffle
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self):
+        indices = self.indices
+        if self.shuffle:
+            generator = None
+            if self.world_size > 1:
+                generator = torch.Generator()
+                generator.manual_seed(self.seed + self.epoch)
+            indices = indices[torch.randperm(len(indices), generator=generator).numpy()]
+        self.epoch += 1
+
+        if self.world_size > 1:
+            # Repeat the first images so all ranks get as many, and so take
+            # as many steps.
+            indices = np.concatenate([indices, indices[:len(self) * self.world_size - len(indices)]])
+            indices = indices[self.rank::self.world_size]
+        return iter(indices.tolist())
+
+    def __len__(self):
+        return -(-len(self.indices) // self.world_size)
+
+def batch_tensor(tensor, size):
+    """Zeroed tensor of the type of tensor for a batch. In DataLoader
+    workers, it is allocated in shared memory so the batch is sent to the
+    main process without being copied again.
+    """
+    batch = tensor.new_zeros(size)
+    if torch.utils.data.get_worker_info() is not None:
+        batch.share_memory_()
+    return batch
+
+def collate_samples(samples):
+    """Collates samples of Dataset into a batch for the DataLoader.
+    Samples of images without instances (None) are dropped. The ground
+    truth instances are zero padded to the largest number of instances in
+    the batch, at most MAX_GT_INSTANCES.
+    Returns the tensors of Dataset.__getitem__() with a batch dimension
+    first, each one contiguous, or None if no image of the batch has
+    instances.
+    """
+    samples = [sample for sample in samples if sample is not None]
+    if not samples:
+        return None
+    fields = list(zip(*samples))
+    instance_count = max(ids.size()[0] for ids in fields[4])
+
+    batch = []
+    for i, tensors in enumerate(fields):
+        # Images, metas and RPN targets have the same size in all samples,
+        # the ground truth instances are padded.
+        size = tensors[0].size() if i < 4 else (instance_count,) + tensors[0].size()[1:]
+        packed = batch_tensor(tensors[0], (len(tensors),) + tuple(size))
+        for b, tensor in enumerate(tensors):
+            packed[b, :tensor.size()[0]] = tensor
+        batch.append(packed)
+    return tuple(batch)
+
+def available_cpus():
+    """CPUs this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+def set_worker_affinity(worker_id, cpus):
+    """worker_init_fn pinning each DataLoader worker to one of the cpus,
+    round robin, so workers don't migrate between cores and compete with
+    the training process on its cores.
+    """
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, [cpus[worker_id % len(cpus)]])
+
 
 ############################################################
 #  MaskRCNN Class
 ############################################################
 
+# Bump when the content of the training state files changes
+TRAINING_STATE_VERSION = 1
+
+# Values of config.MIXED_PRECISION. float16 has too narrow a range to train
+# without loss scaling, bfloat16 has the range of float32.
+MIXED_PRECISION_DTYPES = {
+    None: None,
+    "bfloat16": torch.bfloat16,
+}
+
 class MaskRCNN(nn.Module):
     """Encapsulates the Mask RCNN model functionality.
     """
@@ -1392,6 +1606,46 @@ class MaskRCNN(nn.Module):
         self.loss_history = []
         self.val_loss_history = []
 
+        # DataLoaders of the datasets trained on, see data_loader()
+        self.data_loaders = {}
+
+        # Writes the checkpoints in the background, started by train_model()
+        self.checkpoint_writer = None
+
+        # Optimizer state restored by resume(), for the next train_model()
+        self.optimizer_state = None
+
+        # All layers run on the device of their inputs, which is the device
+        # of the model. See select_device().
+        self.to(select_device(config))
+
+    @property
+    def device(self):
+        """The device the model is on. Follows .to(), .cuda() and .cpu()."""
+        return self.constants.image_scale.device
+
+    def autocast(self):
+        """Context of the layers that run in the reduced precision of
+        config.MIXED_PRECISION: the ResNet, FPN, RPN and the classifier and
+        mask heads. Box math (apply_box_deltas, clip_boxes), NMS, the
+        detection targets and the losses take float32 outputs of these
+        layers and run outside of it.
+        """
+        if self.config.MIXED_PRECISION not in MIXED_PRECISION_DTYPES:
+            raise ValueError("Unknown MIXED_PRECISION {!r}, use one of {}".format(
+                self.config.MIXED_PRECISION, list(MIXED_PRECISION_DTYPES)))
+        dtype = MIXED_PRECISION_DTYPES[self.config.MIXED_PRECISION]
+        return torch.autocast(device_type=self.device.type, dtype=dtype or torch.bfloat16,
+                              enabled=dtype is not None)
+
+    def to_device(self, *tensors):
+        """Moves tensors to the device of the model. The copy of tensors in
+        pinned memory, like the batches of DataLoaders with pin_memory=True,
+        is asynchronous and overlaps with the computations already queued.
+        Returns a list of the moved tensors.
+        """
+        return [tensor.to(self.device, non_blocking=True) for tensor in tensors]
+
     def build(self, config):
         """Build Mask R-CNN architecture.
         """
@@ -1414,14 +1668,8 @@ class MaskRCNN(nn.Module):
         # TODO: add assert to varify feature map sizes match what's in config
         self.fpn = FPN(C1, C2, C3, C4, C5, out_channels=256)
 
-        # Generate Anchors
-        self.anchors = Variable(torch.from_numpy(utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
-                                                                                config.RPN_ANCHOR_RATIOS,
-                                                                                config.BACKBONE_SHAPES,
-                                                                                config.BACKBONE_STRIDES,
-                                                                                config.RPN_ANCHOR_STRIDE)).float(), requires_grad=False)
-        if self.config.GPU_COUNT:
-            self.anchors = self.anchors.cuda()
+        # Tensor constants of the graph, including the anchors
+        self.constants = TensorConstants(config)
 
         # RPN
         self.rpn = RPN(len(config.RPN_ANCHOR_RATIOS), config.RPN_ANCHOR_STRIDE, 256)
@@ -1501,6 +1749,11 @@ class MaskRCNN(nn.Module):
         self.checkpoint_path = self.checkpoint_path.replace(
             "*epoch*", "{:04d}")
 
+        # Path of the training state saved along with each checkpoint, see
+        # training_state()
+        self.training_state_path = os.path.join(self.log_dir, "training_state_{}_{{:04d}}.pth".format(
+            self.config.NAME.lower()))
+
     def find_last(self):
         """Finds the last checkpoint file of the last trained model in the
         model directory.
@@ -1517,9 +1770,11 @@ class MaskRCNN(nn.Module):
             return None, None
         # Pick last directory
         dir_name = os.path.join(self.model_dir, dir_names[-1])
-        # Find the last checkpoint
+        # Find the last checkpoint. Skip the temporary files of checkpoints
+        # being written and any other file.
+        regex = r"mask\_rcnn\_{}\_\d{{4}}\.pth".format(re.escape(key))
         checkpoints = next(os.walk(dir_name))[2]
-        checkpoints = filter(lambda f: f.startswith("mask_rcnn"), checkpoints)
+        checkpoints = filter(lambda f: re.fullmatch(regex, f), checkpoints)
         checkpoints = sorted(checkpoints)
         if not checkpoints:
             return dir_name, None
@@ -1533,7 +1788,7 @@ class MaskRCNN(nn.Module):
         exlude: list of layer names to excluce
         """
         if os.path.exists(filepath):
-            state_dict = torch.load(filepath)
+            state_dict = torch.load(filepath, map_location=self.device)
             self.load_state_dict(state_dict, strict=False)
         else:
             print("Weight file not found ...")
@@ -1541,33 +1796,104 @@ class MaskRCNN(nn.Module):
         # Update the log directory
         self.set_log_dir(filepath)
         if not os.path.exists(self.log_dir):
-            os.makedirs(self.log_dir)
+            # Ranks of a distributed training may share the file system
+            os.makedirs(self.log_dir, exist_ok=True)
 
-    def detect(self, images):
+    def training_state(self, optimizer):
+        """What resume() needs besides the weights to continue a training
+        exactly where it stopped.
+        """
+        return {
+            "version": TRAINING_STATE_VERSION,
+            "epoch": self.epoch,
+            "optimizer": optimizer.state_dict(),
+            "loss_history": self.loss_history,
+            "val_loss_history": self.val_loss_history,
+            "rng": checkpointlib.rng_state(),
+        }
+
+    def resume(self, checkpoint_path=None):
+        """Restores a training from a checkpoint written by train_model():
+        the weights and the epoch, and from the training state saved with
+        them the loss history, the random number generators and the
+        optimizer state, which the next train_model() call that trains
+        picks up. Call train_model() with the same schedule as before, the
+        epochs already done are skipped.
+        checkpoint_path: Path of the weights. None resumes from the last
+            checkpoint, see find_last().
+        Returns the path of the checkpoint resumed from, or None if there
+        is none.
+        """
+        if checkpoint_path is None:
+            checkpoint_path = self.find_last()[1]
+            if checkpoint_path is None:
+                return None
+        self.load_weights(checkpoint_path)
+
+        state_path = self.training_state_path.format(self.epoch)
+        if not os.path.exists(state_path):
+            log("No training state found in {}, resuming with a new optimizer".format(state_path))
+            return checkpoint_path
+        # On the CPU: the random states must be CPU tensors, and
+        # optimizer.load_state_dict() moves its state to the parameters.
+        state = torch.load(state_path, map_location="cpu")
+        if state.get("version") != TRAINING_STATE_VERSION:
+            log("{} is from another version, resuming with a new optimizer".format(state_path))
+            return checkpoint_path
+
+        self.loss_history = state["loss_history"]
+        self.val_loss_history = state["val_loss_history"]
+        self.optimizer_state = state["optimizer"]
+        checkpointlib.set_rng_state(state["rng"])
+        return checkpoint_path
+
+    def detect(self, images, mask_format="full", as_detections=False):
         """Runs the detection pipeline.
-        images: List of images, potentially of different sizes.
+        images: List of images, potentially of different sizes. All images
+            are run through the network as one batch.
+        mask_format: "full", "crop" or "rle". See utils.unmold_masks().
+        as_detections: If True, returns a list of utils.Detection per image
+            instead of a dict, with their masks as crops or RLEs depending
+            on mask_format, which can't be "full".
         Returns a list of dicts, one dict per image. The dict contains:
         rois: [N, (y1, x1, y2, x2)] detection bounding boxes
         class_ids: [N] int class IDs
         scores: [N] float probability scores for the class IDs
-        masks: [H, W, N] instance binary masks
+        masks: [H, W, N] instance binary masks, or a list of N box crops
+            or RLEs, depending on mask_format
         """
 
         # Mold inputs to format expected by the neural network
         molded_images, image_metas, windows = self.mold_inputs(images)
 
-        # Convert images to torch tensor
-        molded_images = torch.from_numpy(molded_images.transpose(0, 3, 1, 2)).float()
+        return self.detect_molded(molded_images, image_metas, windows,
+                                  [image.shape for image in images], mask_format,
+                                  as_detections)
 
-        # To GPU
-        if self.config.GPU_COUNT:
-            molded_images = molded_images.cuda()
+    def detect_molded(self, molded_images, image_metas, windows, image_shapes,
+                      mask_format="full", as_detections=False):
+        """Runs the detection pipeline on images that were already molded
+        with mold_inputs(). Allows molding images ahead of time, e.g. in
+        other threads, while the model is busy.
+        molded_images: [N, h, w, 3]. Images resized and normalized.
+        image_metas: [N, length of meta data]. Details about each image.
+        windows: [N, (y1, x1, y2, x2)]. The portion of each molded image
+            that has the original image.
+        image_shapes: List of the original shapes of the images.
+        mask_format: "full", "crop" or "rle". See utils.unmold_masks().
+        as_detections: Return lists of utils.Detection. See detect().
+        Returns a list of dicts, one dict per image. See detect().
+        """
+        if as_detections and mask_format == "full":
+            raise ValueError("Detections keep their masks as 'crop' or 'rle', not 'full'")
 
-        # Wrap in variable
-        molded_images = Variable(molded_images, volatile=True)
+        # Convert images to torch tensor on the device of the model
+        molded_images = torch.from_numpy(molded_images.transpose(0, 3, 1, 2)).float()
+        molded_images, = self.to_device(molded_images)
 
         # Run object detection
-        detections, mrcnn_mask = self.predict([molded_images, image_metas], mode='inference')
+        with torch.no_grad():
+            detections, mrcnn_mask = self.predict([molded_images, image_metas], mode='inference')
 
         # Convert to numpy
         detections = detections.data.cpu().numpy()
@@ -1575,10 +1901,14 @@ class MaskRCNN(nn.Module):
 
         # Process detections
         results = []
-        for i, image in enumerate(images):
+        for i, image_shape in enumerate(image_shapes):
             final_rois, final_class_ids, final_scores, final_masks =\
                 self.unmold_detections(detections[i], mrcnn_mask[i],
-                                       image.shape, windows[i])
+                                       image_shape, windows[i], mask_format)
+            if as_detections:
+                results.append(utils.build_detections(final_rois, final_class_ids,
+                                                      final_scores, final_masks, image_shape))
+                continue
             results.append({
                 "rois": final_rois,
                 "class_ids": final_class_ids,
@@ -1604,24 +1934,26 @@ class MaskRCNN(nn.Module):
 
             self.apply(set_bn_eval)
 
-        # Feature extraction
-        [p2_out, p3_out, p4_out, p5_out, p6_out] = self.fpn(molded_images)
+        # Feature extraction and RPN, in reduced precision if enabled. The
+        # layers that follow get float32 outputs, see autocast().
+        with self.autocast():
+            [p2_out, p3_out, p4_out, p5_out, p6_out] = self.fpn(molded_images)
 
-        # Note that P6 is used in RPN, but not in the classifier heads.
-        rpn_feature_maps = [p2_out, p3_out, p4_out, p5_out, p6_out]
-        mrcnn_feature_maps = [p2_out, p3_out, p4_out, p5_out]
+            # Note that P6 is used in RPN, but not in the classifier heads.
+            rpn_feature_maps = [p2_out, p3_out, p4_out, p5_out, p6_out]
+            mrcnn_feature_maps = ROIPyramid([p2_out, p3_out, p4_out, p5_out])
 
-        # Loop through pyramid layers
-        layer_outputs = []  # list of lists
-        for p in rpn_feature_maps:
-            layer_outputs.append(self.rpn(p))
+            # Loop through pyramid layers
+            layer_outputs = []  # list of lists
+            for p in rpn_feature_maps:
+                layer_outputs.append(self.rpn(p))
 
         # Concatenate layer outputs
         # Convert from list of lists of level outputs to list of lists
         # of outputs across levels.
         # e.g. [[a1, b1, c1], [a2, b2, c2]] => [[a1, a2], [b1, b2], [c1, c2]]
         outputs = list(zip(*layer_outputs))
-        outputs = [torch.cat(list(o), dim=1) for o in outputs]
+        outputs = [torch.cat(list(o), dim=1).float() for o in outputs]
         rpn_class_logits, rpn_class, rpn_bbox = outputs
 
         # Generate proposals
@@ -1632,36 +1964,51 @@ class MaskRCNN(nn.Module):
         rpn_rois = proposal_layer([rpn_class, rpn_bbox],
                                  proposal_count=proposal_count,
                                  nms_threshold=self.config.RPN_NMS_THRESHOLD,
-                                 anchors=self.anchors,
+                                 constants=self.constants,
                                  config=self.config)
 
         if mode == 'inference':
-            # Network Heads
-            # Proposal classifier and BBox regressor heads
-            mrcnn_class_logits, mrcnn_class, mrcnn_bbox = self.classifier(mrcnn_feature_maps, rpn_rois)
+            # Pack the proposals of all images into one list of ROIs,
+            # dropping the zero padding, and remember the image of each ROI.
+            rois, roi_ix = batch_pack(rpn_rois, rpn_rois.abs().sum(dim=2) > 0)
+            roi_image_ids = roi_ix[:, 0]
 
-            # Detections
-            # output is [batch, num_detections, (y1, x1, y2, x2, class_id, score)] in image coordinates
-            detections = detection_layer(self.config, rpn_rois, mrcnn_class, mrcnn_bbox, image_metas)
+            batch_size = rpn_rois.size()[0]
+            if rois.size()[0]:
+                # Network Heads
+                # Proposal classifier and BBox regressor heads
+                with self.autocast():
+                    outputs = self.classifier(mrcnn_feature_maps, rois, roi_image_ids)
+                mrcnn_class_logits, mrcnn_class, mrcnn_bbox = [o.float() for o in outputs]
+
+                # Detections
+                # output is [batch, num_detections, (y1, x1, y2, x2, class_id, score)] in image coordinates
+                detections = detection_layer(self.config, rois, roi_image_ids, mrcnn_class, mrcnn_bbox, image_metas,
+                                             self.constants)
+            else:
+                detections = rpn_rois.new_zeros(batch_size, self.config.DETECTION_MAX_INSTANCES, 6)
 
             # Convert boxes to normalized coordinates
             # TODO: let DetectionLayer return normalized coordinates to avoid
             #       unnecessary conversions
-            h, w = self.config.IMAGE_SHAPE[:2]
-            scale = Variable(torch.from_numpy(np.array([h, w, h, w])).float(), requires_grad=False)
-            if self.config.GPU_COUNT:
-                scale = scale.cuda()
-            detection_boxes = detections[:, :4] / scale
+            scale = self.constants.image_scale
 
-            # Add back batch dimension
-            detection_boxes = detection_boxes.unsqueeze(0)
+            # Only the real detections go through the mask head. Detections
+            # are zero padded and real ones have a class_id > 0.
+            detection_boxes, detection_ix = batch_pack(detections[:, :, :4] / scale, detections[:, :, 4] > 0)
 
-            # Create masks for detections
-            mrcnn_mask = self.mask(mrcnn_feature_maps, detection_boxes)
+            # Masks are [batch, num_detections, num_classes, height, width]
+            mrcnn_mask = detections.new_zeros((batch_size, detections.size()[1], self.config.NUM_CLASSES) +
+                                              tuple(self.config.MASK_SHAPE))
 
-            # Add back batch dimension
-            detections = detections.unsqueeze(0)
-            mrcnn_mask = mrcnn_mask.unsqueeze(0)
+            # Skip the mask head altogether when nothing was detected in
+            # the batch, which is common for lesion free images.
+            if detection_boxes.size()[0]:
+                # Create masks for detections, reusing the pyramid of the
+                # classifier, and scatter them to their detections
+                with self.autocast():
+                    masks = self.mask(mrcnn_feature_maps, detection_boxes, detection_ix[:, 0])
+                mrcnn_mask[detection_ix[:, 0].data, detection_ix[:, 1].data] = masks.float()
 
             return [detections, mrcnn_mask]
 
@@ -1672,36 +2019,33 @@ class MaskRCNN(nn.Module):
             gt_masks = input[4]
 
             # Normalize coordinates
-            h, w = self.config.IMAGE_SHAPE[:2]
-            scale = Variable(torch.from_numpy(np.array([h, w, h, w])).float(), requires_grad=False)
-            if self.config.GPU_COUNT:
-                scale = scale.cuda()
-            gt_boxes = gt_boxes / scale
+            gt_boxes = gt_boxes / self.constants.image_scale
+
+            # Masks come as uint8 to keep batches small
+            gt_masks = gt_masks.float()
 
             # Generate detection targets
             # Subsamples proposals and generates target outputs for training
             # Note that proposal class IDs, gt_boxes, and gt_masks are zero
             # padded. Equally, returned rois and targets are zero padded.
-            rois, target_class_ids, target_deltas, target_mask = \
-                detection_target_layer(rpn_rois, gt_class_ids, gt_boxes, gt_masks, self.config)
-
-            if not rois.size():
-                mrcnn_class_logits = Variable(torch.FloatTensor())
-                mrcnn_class = Variable(torch.IntTensor())
-                mrcnn_bbox = Variable(torch.FloatTensor())
-                mrcnn_mask = Variable(torch.FloatTensor())
-                if self.config.GPU_COUNT:
-                    mrcnn_class_logits = mrcnn_class_logits.cuda()
-                    mrcnn_class = mrcnn_class.cuda()
-                    mrcnn_bbox = mrcnn_bbox.cuda()
-                    mrcnn_mask = mrcnn_mask.cuda()
+            # The ROIs of all images are packed into one list.
+            rois, roi_image_ids, target_class_ids, target_deltas, target_mask = \
+                detection_target_layer(rpn_rois, gt_class_ids, gt_boxes, gt_masks, self.config,
+                                       self.constants)
+
+            if not rois.size()[0]:
+                mrcnn_class_logits = rois.new_zeros(0)
+                mrcnn_class = rois.new_zeros(0, dtype=torch.int)
+                mrcnn_bbox = rois.new_zeros(0)
+                mrcnn_mask = rois.new_zeros(0)
             else:
                 # Network Heads
-                # Proposal classifier and BBox regressor heads
-                mrcnn_class_logits, mrcnn_class, mrcnn_bbox = self.classifier(mrcnn_feature_maps, rois)
-
-                # Create masks for detections
-                mrcnn_mask = self.mask(mrcnn_feature_maps, rois)
+                # Proposal classifier and BBox regressor heads, and masks
+                with self.autocast():
+                    outputs = self.classifier(mrcnn_feature_maps, rois, roi_image_ids)
+                    mrcnn_mask = self.mask(mrcnn_feature_maps, rois, roi_image_ids)
+                mrcnn_class_logits, mrcnn_class, mrcnn_bbox = [o.float() for o in outputs]
+                mrcnn_mask = mrcnn_mask.float()
 
             return [rpn_class_logits, rpn_bbox, target_class_ids, mrcnn_class_logits, target_deltas, mrcnn_bbox, target_mask, mrcnn_mask]
 
@@ -1738,14 +2082,22 @@ class MaskRCNN(nn.Module):
             layers = layer_regex[layers]
 
         # Data generators
-        train_set = Dataset(train_dataset, self.config, augment=True)
-        train_generator = torch.utils.data.DataLoader(train_set, batch_size=1, shuffle=True, num_workers=4)
-        val_set = Dataset(val_dataset, self.config, augment=True)
-        val_generator = torch.utils.data.DataLoader(val_set, batch_size=1, shuffle=True, num_workers=4)
+        train_generator = self.data_loader(train_dataset)
+        val_generator = self.data_loader(val_dataset)
+
+        # In distributed training, all replicas start from the weights of
+        # rank 0 and only rank 0 logs and saves. See parallel.py.
+        if parallel.is_initialized():
+            parallel.broadcast_parameters(self)
+        main_process = parallel.is_main_process()
+        if main_process and self.checkpoint_writer is None:
+            self.checkpoint_writer = checkpointlib.CheckpointWriter(keep=self.config.CHECKPOINT_KEEP,
+                                                                    keep_best=self.config.CHECKPOINT_KEEP_BEST)
 
         # Train
-        log("\nStarting at epoch {}. LR={}\n".format(self.epoch+1, learning_rate))
-        log("Checkpoint Path: {}".format(self.checkpoint_path))
+        if main_process:
+            log("\nStarting at epoch {}. LR={}\n".format(self.epoch+1, learning_rate))
+            log("Checkpoint Path: {}".format(self.checkpoint_path))
         self.set_trainable(layers)
 
         # Optimizer object
@@ -1758,29 +2110,98 @@ class MaskRCNN(nn.Module):
             {'params': trainables_only_bn}
         ], lr=learning_rate, momentum=self.config.LEARNING_MOMENTUM)
 
+        # Momentum of the resumed training. Kept for the next call if this
+        # one has no epoch left to train, and dropped if the trained layers
+        # changed since.
+        if self.optimizer_state is not None and self.epoch < epochs:
+            try:
+                optimizer.load_state_dict(self.optimizer_state)
+                for group in optimizer.param_groups:
+                    group["lr"] = learning_rate
+            except ValueError:
+                log("The resumed optimizer state doesn't match the layers to train, dropped")
+            self.optimizer_state = None
+
+        # In distributed training, the ranks share the steps of an epoch, so
+        # an epoch covers as many images whatever the number of ranks.
+        world_size = parallel.world_size()
+        steps = max(1, math.ceil(self.config.STEPS_PER_EPOCH / world_size))
+        validation_steps = max(1, math.ceil(self.config.VALIDATION_STEPS / world_size))
+
         for epoch in range(self.epoch+1, epochs+1):
-            log("Epoch {}/{}.".format(epoch,epochs))
+            if main_process:
+                log("Epoch {}/{}.".format(epoch,epochs))
+
+            # Shuffle the same way on all ranks, and as before a resume
+            train_generator.sampler.epoch = epoch
+            val_generator.sampler.epoch = epoch
 
             # Training
-            loss, loss_rpn_class, loss_rpn_bbox, loss_mrcnn_class, loss_mrcnn_bbox, loss_mrcnn_mask = self.train_epoch(train_generator, optimizer, self.config.STEPS_PER_EPOCH)
+            loss, loss_rpn_class, loss_rpn_bbox, loss_mrcnn_class, loss_mrcnn_bbox, loss_mrcnn_mask = self.train_epoch(train_generator, optimizer, steps)
 
             # Validation
-            val_loss, val_loss_rpn_class, val_loss_rpn_bbox, val_loss_mrcnn_class, val_loss_mrcnn_bbox, val_loss_mrcnn_mask = self.valid_epoch(val_generator, self.config.VALIDATION_STEPS)
-
-            # Statistics
-            self.loss_history.append([loss, loss_rpn_class, loss_rpn_bbox, loss_mrcnn_class, loss_mrcnn_bbox, loss_mrcnn_mask])
-            self.val_loss_history.append([val_loss, val_loss_rpn_class, val_loss_rpn_bbox, val_loss_mrcnn_class, val_loss_mrcnn_bbox, val_loss_mrcnn_mask])
-            visualize.plot_loss(self.loss_history, self.val_loss_history, save=True, log_dir=self.log_dir)
-
-            # Save model
-            torch.save(self.state_dict(), self.checkpoint_path.format(epoch))
-
-        self.epoch = epochs
-
-
+            val_loss, val_loss_rpn_class, val_loss_rpn_bbox, val_loss_mrcnn_class, val_loss_mrcnn_bbox, val_loss_mrcnn_mask = self.valid_epoch(val_generator, validation_steps)
+
+            # Statistics, averaged over the ranks in distributed training
+            self.loss_history.append(parallel.all_reduce_mean([loss, loss_rpn_class, loss_rpn_bbox, loss_mrcnn_class, loss_mrcnn_bbox, loss_mrcnn_mask]))
+            self.val_loss_history.append(parallel.all_reduce_mean([val_loss, val_loss_rpn_class, val_loss_rpn_bbox, val_loss_mrcnn_class, val_loss_mrcnn_bbox, val_loss_mrcnn_mask]))
+            if main_process:
+                visualize.plot_loss(self.loss_history, self.val_loss_history, save=True, log_dir=self.log_dir)
+
+            # Save model and training state in the background
+            self.epoch = epoch
+            if main_process:
+                self.checkpoint_writer.save(epoch, {
+                    self.checkpoint_path.format(epoch): self.state_dict(),
+                    self.training_state_path.format(epoch): self.training_state(optimizer),
+                }, val_loss=self.val_loss_history[-1][0])
+
+        # The checkpoints are on disk when training returns
+        if main_process:
+            self.checkpoint_writer.flush()
+        self.epoch = max(self.epoch, epochs)
+
+
+
+    def data_loader(self, dataset, augment=True):
+        """Returns the DataLoader of training batches of a dataset, set up
+        from the DATALOADER_* config fields. It is built on the first call
+        and reused by the next ones, e.g. by the successive train_model()
+        calls of a training schedule, along with its persistent workers.
+        dataset: A utils.Dataset object.
+        augment: If True, applies image augmentation.
+        """
+        # The loader holds the dataset, so its id isn't reused meanwhile
+        key = (id(dataset), augment)
+        if key not in self.data_loaders:
+            config = self.config
+            workers = config.DATALOADER_WORKERS
+            if workers is None:
+                workers = len(available_cpus())
+
+            # Batches in pinned memory are copied to the GPU asynchronously,
+            # see to_device().
+            pin_memory = config.DATALOADER_PIN_MEMORY
+            if pin_memory is None:
+                pin_memory = self.device.type == "cuda"
+
+            options = {}
+            if workers > 0:
+                options["prefetch_factor"] = config.DATALOADER_PREFETCH_FACTOR
+                options["persistent_workers"] = config.DATALOADER_PERSISTENT_WORKERS
+                if config.DATALOADER_WORKER_CPUS:
+                    options["worker_init_fn"] = functools.partial(
+                        set_worker_affinity, cpus=list(config.DATALOADER_WORKER_CPUS))
+
+            # Each rank of a distributed training loads its own shard
+            data = Dataset(dataset, config, augment=augment)
+            sampler = InstanceSampler(data, rank=parallel.rank(), world_size=parallel.world_size())
+            self.data_loaders[key] = torch.utils.data.DataLoader(
+                data, batch_size=config.BATCH_SIZE, sampler=sampler,
+                num_workers=workers, collate_fn=collate_samples, pin_memory=pin_memory, **options)
+        return self.data_loaders[key]
 
     def train_epoch(self, datagenerator, optimizer, steps):
-        batch_count = 0
         loss_sum = 0
         loss_rpn_class_sum = 0
         loss_rpn_bbox_sum = 0
@@ -1789,10 +2210,23 @@ class MaskRCNN(nn.Module):
         loss_mrcnn_mask_sum = 0
         step = 0
 
-        optimizer.zero_grad()
+        distributed = parallel.is_initialized()
+        main_process = parallel.is_main_process()
+        trainables = [param for param in self.parameters() if param.requires_grad]
 
         for inputs in datagenerator:
-            batch_count += 1
+            # None when no image of the batch has instances
+            if inputs is None:
+                if not distributed:
+                    continue
+                # The other ranks wait for the gradients of this step, take
+                # it with none.
+                optimizer.zero_grad()
+                self.optimizer_step(optimizer, trainables)
+                if step==steps-1:
+                    break
+                step += 1
+                continue
 
             images = inputs[0]
             image_metas = inputs[1]
@@ -1805,22 +2239,9 @@ class MaskRCNN(nn.Module):
             # image_metas as numpy array
             image_metas = image_metas.numpy()
 
-            # Wrap in variables
-            images = Variable(images)
-            rpn_match = Variable(rpn_match)
-            rpn_bbox = Variable(rpn_bbox)
-            gt_class_ids = Variable(gt_class_ids)
-            gt_boxes = Variable(gt_boxes)
-            gt_masks = Variable(gt_masks)
-
-            # To GPU
-            if self.config.GPU_COUNT:
-                images = images.cuda()
-                rpn_match = rpn_match.cuda()
-                rpn_bbox = rpn_bbox.cuda()
-                gt_class_ids = gt_class_ids.cuda()
-                gt_boxes = gt_boxes.cuda()
-                gt_masks = gt_masks.cuda()
+            # To the device of the model
+            images, rpn_match, rpn_bbox, gt_class_ids, gt_boxes, gt_masks = \
+                self.to_device(images, rpn_match, rpn_bbox, gt_class_ids, gt_boxes, gt_masks)
 
             # Run object detection
             rpn_class_logits, rpn_pred_bbox, target_class_ids, mrcnn_class_logits, target_deltas, mrcnn_bbox, target_mask, mrcnn_mask = \
@@ -1830,28 +2251,29 @@ class MaskRCNN(nn.Module):
             rpn_class_loss, rpn_bbox_loss, mrcnn_class_loss, mrcnn_bbox_loss, mrcnn_mask_loss = compute_losses(rpn_match, rpn_bbox, rpn_class_logits, rpn_pred_bbox, target_class_ids, mrcnn_class_logits, target_deltas, mrcnn_bbox, target_mask, mrcnn_mask)
             loss = rpn_class_loss + rpn_bbox_loss + mrcnn_class_loss + mrcnn_bbox_loss + mrcnn_mask_loss
 
-            # Backpropagation
-            loss.backward()
-            torch.nn.utils.clip_grad_norm(self.parameters(), 5.0)
-            if (batch_count % self.config.BATCH_SIZE) == 0:
-                optimizer.step()
-                optimizer.zero_grad()
-                batch_count = 0
+            # Backpropagation. The losses are means over the batch, the
+            # gradient is summed over its images as when they were
+            # backpropagated one at a time, which the learning rates are set
+            # for.
+            optimizer.zero_grad()
+            (loss * images.size()[0]).backward()
+            self.optimizer_step(optimizer, trainables)
 
             # Progress
-            printProgressBar(step + 1, steps, prefix="\t{}/{}".format(step + 1, steps),
-                             suffix="Complete - loss: {:.5f} - rpn_class_loss: {:.5f} - rpn_bbox_loss: {:.5f} - mrcnn_class_loss: {:.5f} - mrcnn_bbox_loss: {:.5f} - mrcnn_mask_loss: {:.5f}".format(
-                                 loss.data.cpu()[0], rpn_class_loss.data.cpu()[0], rpn_bbox_loss.data.cpu()[0],
-                                 mrcnn_class_loss.data.cpu()[0], mrcnn_bbox_loss.data.cpu()[0],
-                                 mrcnn_mask_loss.data.cpu()[0]), length=10)
+            if main_process:
+                printProgressBar(step + 1, steps, prefix="\t{}/{}".format(step + 1, steps),
+                                 suffix="Complete - loss: {:.5f} - rpn_class_loss: {:.5f} - rpn_bbox_loss: {:.5f} - mrcnn_class_loss: {:.5f} - mrcnn_bbox_loss: {:.5f} - mrcnn_mask_loss: {:.5f}".format(
+                                     loss.item(), rpn_class_loss.item(), rpn_bbox_loss.item(),
+                                     mrcnn_class_loss.item(), mrcnn_bbox_loss.item(),
+                                     mrcnn_mask_loss.item()), length=10)
 
             # Statistics
-            loss_sum += loss.data.cpu()[0]/steps
-            loss_rpn_class_sum += rpn_class_loss.data.cpu()[0]/steps
-            loss_rpn_bbox_sum += rpn_bbox_loss.data.cpu()[0]/steps
-            loss_mrcnn_class_sum += mrcnn_class_loss.data.cpu()[0]/steps
-            loss_mrcnn_bbox_sum += mrcnn_bbox_loss.data.cpu()[0]/steps
-            loss_mrcnn_mask_sum += mrcnn_mask_loss.data.cpu()[0]/steps
+            loss_sum += loss.item()/steps
+            loss_rpn_class_sum += rpn_class_loss.item()/steps
+            loss_rpn_bbox_sum += rpn_bbox_loss.item()/steps
+            loss_mrcnn_class_sum += mrcnn_class_loss.item()/steps
+            loss_mrcnn_bbox_sum += mrcnn_bbox_loss.item()/steps
+            loss_mrcnn_mask_sum += mrcnn_mask_loss.item()/steps
 
             # Break after 'steps' steps
             if step==steps-1:
@@ -1860,6 +2282,19 @@ class MaskRCNN(nn.Module):
 
         return loss_sum, loss_rpn_class_sum, loss_rpn_bbox_sum, loss_mrcnn_class_sum, loss_mrcnn_bbox_sum, loss_mrcnn_mask_sum
 
+    def optimizer_step(self, optimizer, trainables):
+        """Clips the gradients and takes an optimizer step. In distributed
+        training, the gradients are first averaged over the ranks. Every
+        rank goes through here once per step, with or without a batch, so
+        all replicas take the same step.
+        trainables: list of the parameters that require gradients.
+        """
+        if parallel.is_initialized():
+            parallel.all_reduce_gradients(trainables, self.config.DISTRIBUTED_BUCKET_SIZE)
+        torch.nn.utils.clip_grad_norm_(self.parameters(), 5.0)
+        optimizer.step()
+
+    @torch.no_grad()
     def valid_epoch(self, datagenerator, steps):
 
         step = 0
@@ -1871,6 +2306,10 @@ class MaskRCNN(nn.Module):
         loss_mrcnn_mask_sum = 0
 
         for inputs in datagenerator:
+            # None when no image of the batch has instances
+            if inputs is None:
+                continue
+
             images = inputs[0]
             image_metas = inputs[1]
             rpn_match = inputs[2]
@@ -1882,28 +2321,15 @@ class MaskRCNN(nn.Module):
             # image_metas as numpy array
             image_metas = image_metas.numpy()
 
-            # Wrap in variables
-            images = Variable(images, volatile=True)
-            rpn_match = Variable(rpn_match, volatile=True)
-            rpn_bbox = Variable(rpn_bbox, volatile=True)
-            gt_class_ids = Variable(gt_class_ids, volatile=True)
-            gt_boxes = Variable(gt_boxes, volatile=True)
-            gt_masks = Variable(gt_masks, volatile=True)
-
-            # To GPU
-            if self.config.GPU_COUNT:
-                images = images.cuda()
-                rpn_match = rpn_match.cuda()
-                rpn_bbox = rpn_bbox.cuda()
-                gt_class_ids = gt_class_ids.cuda()
-                gt_boxes = gt_boxes.cuda()
-                gt_masks = gt_masks.cuda()
+            # To the device of the model
+            images, rpn_match, rpn_bbox, gt_class_ids, gt_boxes, gt_masks = \
+                self.to_device(images, rpn_match, rpn_bbox, gt_class_ids, gt_boxes, gt_masks)
 
             # Run object detection
             rpn_class_logits, rpn_pred_bbox, target_class_ids, mrcnn_class_logits, target_deltas, mrcnn_bbox, target_mask, mrcnn_mask = \
                 self.predict([images, image_metas, gt_class_ids, gt_boxes, gt_masks], mode='training')
 
-            if not target_class_ids.size():
+            if not target_class_ids.size()[0]:
                 continue
 
             # Compute losses
@@ -1911,19 +2337,20 @@ class MaskRCNN(nn.Module):
             loss = rpn_class_loss + rpn_bbox_loss + mrcnn_class_loss + mrcnn_bbox_loss + mrcnn_mask_loss
 
             # Progress
-            printProgressBar(step + 1, steps, prefix="\t{}/{}".format(step + 1, steps),
-                             suffix="Complete - loss: {:.5f} - rpn_class_loss: {:.5f} - rpn_bbox_loss: {:.5f} - mrcnn_class_loss: {:.5f} - mrcnn_bbox_loss: {:.5f} - mrcnn_mask_loss: {:.5f}".format(
-                                 loss.data.cpu()[0], rpn_class_loss.data.cpu()[0], rpn_bbox_loss.data.cpu()[0],
-                                 mrcnn_class_loss.data.cpu()[0], mrcnn_bbox_loss.data.cpu()[0],
-                                 mrcnn_mask_loss.data.cpu()[0]), length=10)
+            if parallel.is_main_process():
+                printProgressBar(step + 1, steps, prefix="\t{}/{}".format(step + 1, steps),
+                                 suffix="Complete - loss: {:.5f} - rpn_class_loss: {:.5f} - rpn_bbox_loss: {:.5f} - mrcnn_class_loss: {:.5f} - mrcnn_bbox_loss: {:.5f} - mrcnn_mask_loss: {:.5f}".format(
+                                     loss.item(), rpn_class_loss.item(), rpn_bbox_loss.item(),
+                                     mrcnn_class_loss.item(), mrcnn_bbox_loss.item(),
+                                     mrcnn_mask_loss.item()), length=10)
 
             # Statistics
-            loss_sum += loss.data.cpu()[0]/steps
-            loss_rpn_class_sum += rpn_class_loss.data.cpu()[0]/steps
-            loss_rpn_bbox_sum += rpn_bbox_loss.data.cpu()[0]/steps
-            loss_mrcnn_class_sum += mrcnn_class_loss.data.cpu()[0]/steps
-            loss_mrcnn_bbox_sum += mrcnn_bbox_loss.data.cpu()[0]/steps
-            loss_mrcnn_mask_sum += mrcnn_mask_loss.data.cpu()[0]/steps
+            loss_sum += loss.item()/steps
+            loss_rpn_class_sum += rpn_class_loss.item()/steps
+            loss_rpn_bbox_sum += rpn_bbox_loss.item()/steps
+            loss_mrcnn_class_sum += mrcnn_class_loss.item()/steps
+            loss_mrcnn_bbox_sum += mrcnn_bbox_loss.item()/steps
+            loss_mrcnn_mask_sum += mrcnn_mask_loss.item()/steps
 
             # Break after 'steps' steps
             if step==steps-1:
@@ -1971,7 +2398,8 @@ class MaskRCNN(nn.Module):
         windows = np.stack(windows)
         return molded_images, image_metas, windows
 
-    def unmold_detections(self, detections, mrcnn_mask, image_shape, window):
+    def unmold_detections(self, detections, mrcnn_mask, image_shape, window,
+                          mask_format="full"):
         """Reformats the detections of one image from the format of the neural
         network output to a format suitable for use in the rest of the
         application.
@@ -1980,11 +2408,13 @@ class MaskRCNN(nn.Module):
         image_shape: [height, width, depth] Original size of the image before resizing
         window: [y1, x1, y2, x2] Box in the image where the real image is
                 excluding the padding.
+        mask_format: "full", "crop" or "rle". See utils.unmold_masks().
         Returns:
         boxes: [N, (y1, x1, y2, x2)] Bounding boxes in pixels
         class_ids: [N] Integer class IDs for each bounding box
         scores: [N] Float probability scores of the class_id
-        masks: [height, width, num_instances] Instance masks
+        masks: [height, width, num_instances] Instance masks, or a list of
+            crops or RLEs of the instances, depending on mask_format
         """
         # How many detections do we have?
         # Detections array is padded with zeros. Find the first class_id == 0.
@@ -2020,13 +2450,7 @@ class MaskRCNN(nn.Module):
             N = class_ids.shape[0]
 
         # Resize masks to original image size and set boundary threshold.
-        full_masks = []
-        for i in range(N):
-            # Convert neural network mask to full size mask
-            full_mask = utils.unmold_mask(masks[i], boxes[i], image_shape)
-            full_masks.append(full_mask)
-        full_masks = np.stack(full_masks, axis=-1)\
-            if full_masks else np.empty((0,) + masks.shape[1:3])
+        full_masks = utils.unmold_masks(masks, boxes, image_shape, mask_format)
 
         return boxes, class_ids, scores, full_masks
 
@@ -8,10 +8,40 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from nms.pth_nms import pth_nms
+try:
+  from nms.pth_nms import pth_nms
+except ImportError:
+  # The compiled extension is not built, or can't be built with this
+  # version of PyTorch (torch.utils.ffi is gone). Use the PyTorch version.
+  pth_nms = None
+
+from nms.py_nms import py_nms
 
 
 def nms(dets, thresh):
   """Dispatch to either CPU or GPU NMS implementations.
   Accept dets as tensor"""
-  return pth_nms(dets, thresh)
+  if pth_nms is not None:
+    return pth_nms(dets, thresh)
+  return py_nms(dets, thresh)
+
+
+def batched_nms(dets, idxs, thresh):
+  """NMS done independently for each category in a single NMS call.
+  dets: [N, (y1, x1, y2, x2, score)] tensor
+  idxs: [N] category of each box.
+  Returns the indices of the kept boxes by decreasing score.
+
+  The boxes of each category are shifted by a per-category offset larger
+  than all box coordinates, so boxes of different categories never overlap.
+  """
+  if dets.size(0) == 0:
+    return idxs.new_zeros(0).long()
+
+  boxes = dets[:, :4]
+  # +2 keeps a gap of more than one pixel between categories, as the
+  # overlaps are computed with the +1 pixel convention.
+  offset = boxes.max() - boxes.min() + 2
+  shifted = dets.clone()
+  shifted[:, :4] += (idxs.to(dets.dtype) * offset).unsqueeze(1)
+  return nms(shifted, thresh)
@@ -0,0 +1,73 @@
+import torch
+
+# Number of boxes whose pairwise overlaps are computed at once. Bounds the
+# IoU matrices to TILE_SIZE x TILE_SIZE within a tile and
+# kept x TILE_SIZE against the boxes kept by the previous tiles.
+TILE_SIZE = 512
+
+
+def _overlaps(boxes1, areas1, boxes2, areas2):
+  """IoU of every box in boxes1 with every box in boxes2, [N1, N2].
+  Follows nms/src/nms.c to the letter, including the +1 pixel convention,
+  so the suppression decisions are the same as the compiled version.
+  """
+  yy1 = torch.max(boxes1[:, 0].unsqueeze(1), boxes2[:, 0].unsqueeze(0))
+  xx1 = torch.max(boxes1[:, 1].unsqueeze(1), boxes2[:, 1].unsqueeze(0))
+  yy2 = torch.min(boxes1[:, 2].unsqueeze(1), boxes2[:, 2].unsqueeze(0))
+  xx2 = torch.min(boxes1[:, 3].unsqueeze(1), boxes2[:, 3].unsqueeze(0))
+  h = (yy2 - yy1 + 1).clamp(min=0)
+  w = (xx2 - xx1 + 1).clamp(min=0)
+  inter = h * w
+  return inter / (areas1.unsqueeze(1) + areas2.unsqueeze(0) - inter)
+
+
+def py_nms(dets, thresh, tile_size=TILE_SIZE):
+  """Greedy NMS in pure PyTorch. Same signature and output as pth_nms.
+  dets: [N, (y1, x1, y2, x2, score)] tensor
+  Returns the indices of the kept boxes by decreasing score.
+
+  Boxes are visited in tiles of tile_size by decreasing score. A tile is
+  first suppressed by all the boxes kept in the previous tiles in one
+  vectorized op. Suppression inside the tile is then resolved by iterating
+  "keep the boxes not suppressed by a kept box before them" to its fixed
+  point, which is exactly the greedy result and usually takes a few steps.
+  """
+  if dets.size(0) == 0:
+    return torch.zeros(0, dtype=torch.long, device=dets.device)
+
+  scores = dets[:, 4]
+  order = scores.sort(0, descending=True)[1]
+  boxes = dets[order, :4].contiguous()
+  areas = (boxes[:, 3] - boxes[:, 1] + 1) * (boxes[:, 2] - boxes[:, 0] + 1)
+
+  num_boxes = boxes.size(0)
+  kept = torch.zeros(0, dtype=torch.long, device=dets.device)
+  for start in range(0, num_boxes, tile_size):
+    end = min(start + tile_size, num_boxes)
+    tile_boxes = boxes[start:end]
+    tile_areas = areas[start:end]
+
+    # 1. Suppress by the boxes kept in the previous tiles
+    if kept.size(0):
+      iou = _overlaps(boxes[kept], areas[kept], tile_boxes, tile_areas)
+      candidates = ~(iou >= thresh).any(0)
+    else:
+      candidates = torch.ones(end - start, dtype=torch.bool, device=dets.device)
+    if not candidates.any():
+      continue
+
+    # 2. Resolve the suppression inside the tile. suppress[i, j] is True
+    # if box i comes before box j and overlaps it enough to remove it.
+    ix = torch.arange(end - start, device=dets.device)
+    suppress = (_overlaps(tile_boxes, tile_areas, tile_boxes, tile_areas) >= thresh) & \
+        (ix.unsqueeze(1) < ix.unsqueeze(0))
+    tile_keep = candidates
+    while True:
+      new_keep = candidates & ~(suppress & tile_keep.unsqueeze(1)).any(0)
+      if torch.equal(new_keep, tile_keep):
+        break
+      tile_keep = new_keep
+
+    kept = torch.cat([kept, torch.nonzero(tile_keep)[:, 0] + start])
+
+  return order[kept]
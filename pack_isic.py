@@ -0,0 +1,128 @@
+"""
+Mask R-CNN
+Packs an ISIC subset for training with isic.PackedISICDataset.
+
+The images are decoded and resized for the config once, and written one
+after the other as raw uint8 arrays to a single .bin file, each followed
+by the RLE masks of its annotations, resized the same way. A .json index
+holds the offsets of the images and masks in the .bin file. Training then
+memory maps the .bin file instead of opening and decoding thousands of
+JPEGs.
+
+Usage: run from the command line as such:
+
+    # Pack the training and validation sets next to their annotations
+    python3 pack_isic.py --dataset-dir ../../ISIC_Challenge_2017/Training/ --subset Train
+    python3 pack_isic.py --dataset-dir ../../ISIC_Challenge_2017/Val/ --subset Val
+
+isic.py picks the packed files up when they exist.
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+from pycocotools import mask as maskUtils
+
+import isic
+import utils
+
+
+def pack_image(dataset, image_id, config):
+    """Loads an image and its masks, and resizes them as load_image_gt()
+    would, without the padding. Packed images already have the training
+    size, so load_image_gt() only pads them.
+    Returns the image, its original shape and its annotations, with their
+    RLE mask as "rle", whose "counts" are bytes.
+    """
+    image = dataset.load_image(image_id)
+    mask, class_ids = dataset.load_mask(image_id)
+    original_shape = image.shape
+    image, window, scale, padding = utils.resize_image(
+        image,
+        min_dim=config.IMAGE_MIN_DIM,
+        max_dim=config.IMAGE_MAX_DIM,
+        padding=False)
+    mask = utils.resize_mask(mask, scale, [(0, 0), (0, 0), (0, 0)])
+
+    annotations = []
+    for i, class_id in enumerate(class_ids):
+        # Crowds have negative class ids, see ISICDataset.load_mask()
+        rle = maskUtils.encode(np.asfortranarray(mask[:, :, i].astype(np.uint8)))
+        annotations.append({
+            "category_id": dataset.class_info[abs(class_id)]["id"],
+            "iscrowd": int(class_id < 0),
+            "rle": rle,
+        })
+    return np.ascontiguousarray(image, dtype=np.uint8), original_shape, annotations
+
+
+def pack(dataset_dir, subset, output, config):
+    dataset = isic.ISICDataset()
+    dataset.load_isic(dataset_dir, subset)
+    dataset.prepare()
+
+    # Write to temporary files and rename them at the end, so an
+    # interrupted run doesn't leave a packed dataset behind.
+    index = {
+        "version": isic.PACKED_VERSION,
+        # Sizes the images were resized for, load_packed() checks them
+        # against the config
+        "image_min_dim": config.IMAGE_MIN_DIM,
+        "image_max_dim": config.IMAGE_MAX_DIM,
+        "classes": [{"id": c["id"], "name": c["name"]} for c in dataset.class_info
+                    if c["source"] == "isic"],
+        "images": [],
+    }
+    offset = 0
+    with open(output + ".bin.tmp", "wb") as shard:
+        for image_id in dataset.image_ids:
+            info = dataset.image_info[image_id]
+            image, original_shape, annotations = pack_image(dataset, image_id, config)
+            shard.write(image.tobytes())
+            entry = {
+                "id": info["id"],
+                "file_name": os.path.basename(info["path"]),
+                "offset": offset,
+                "shape": list(image.shape),
+                "original_shape": list(original_shape),
+                "annotations": [],
+            }
+            offset += image.nbytes
+
+            # The masks follow the image, the index only keeps where
+            for annotation in annotations:
+                rle = annotation.pop("rle")
+                shard.write(rle["counts"])
+                annotation.update(size=rle["size"], offset=offset, length=len(rle["counts"]))
+                entry["annotations"].append(annotation)
+                offset += len(rle["counts"])
+            index["images"].append(entry)
+            print("Packed {}/{} images.".format(len(index["images"]), len(dataset.image_ids)))
+
+    with open(output + ".json.tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(output + ".bin.tmp", output + ".bin")
+    os.replace(output + ".json.tmp", output + ".json")
+    print("Wrote {}.bin ({:.1f} MB) and {}.json".format(output, offset / 2**20, output))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Pack an ISIC subset into a memory mapped file.')
+    parser.add_argument('--dataset-dir', required=True,
+                        metavar="/path/to/ISIC/subset/",
+                        help='Directory with the annotations_isic_<subset>.json file and the Images directory')
+    parser.add_argument('--subset', required=True,
+                        metavar="<subset>",
+                        help="Subset of the annotations file, e.g. 'Train' or 'Val'")
+    parser.add_argument('--output', required=False,
+                        metavar="/path/to/packed",
+                        help='Path without extension of the packed files '
+                             '(default=<dataset-dir>/packed_isic_<subset>, where isic.py looks for them)')
+    args = parser.parse_args()
+
+    config = isic.ISICConfig()
+    output = args.output or isic.packed_path(args.dataset_dir, args.subset)
+    pack(args.dataset_dir, args.subset, output, config)
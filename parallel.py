@@ -0,0 +1,117 @@
+"""
+Mask R-CNN
+Multi-process data-parallel training.
+
+Every process trains a replica of the model on its own shard of the
+dataset, and the gradients are averaged across processes after each
+backward pass so all replicas take the same optimizer steps. It is built
+on torch.distributed with the gloo backend by default, which runs on
+CPU-only hosts.
+
+Usage: start the training script with torchrun, which sets the RANK,
+WORLD_SIZE, MASTER_ADDR and MASTER_PORT environment variables, e.g. on
+each of 4 nodes:
+
+    torchrun --nnodes=4 --nproc_per_node=1 --rdzv_backend=c10d \
+        --rdzv_endpoint=<first node>:29500 isic.py
+
+Processes started without them train alone, as before.
+"""
+
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def init_process_group(config):
+    """Joins the process group of a torchrun launch with the backend of
+    config.DISTRIBUTED_BACKEND.
+    Returns True if training is distributed, False if this process trains
+    alone.
+    """
+    if dist.is_available() and dist.is_initialized():
+        return True
+    if int(os.environ.get("WORLD_SIZE", 1)) <= 1:
+        return False
+    dist.init_process_group(backend=config.DISTRIBUTED_BACKEND)
+    return True
+
+
+def is_initialized():
+    """Whether this process is part of a distributed training."""
+    return dist.is_available() and dist.is_initialized()
+
+
+def rank():
+    return dist.get_rank() if is_initialized() else 0
+
+
+def world_size():
+    return dist.get_world_size() if is_initialized() else 1
+
+
+def is_main_process():
+    """Rank 0 saves the checkpoints and the loss plots."""
+    return rank() == 0
+
+
+def broadcast_parameters(module):
+    """Copies the parameters and buffers of rank 0 to the other ranks, so
+    all replicas start from the same weights, including the randomly
+    initialized ones.
+    """
+    for tensor in module.state_dict().values():
+        dist.broadcast(tensor, 0)
+
+
+def buckets(parameters, bucket_size):
+    """Splits parameters into consecutive groups of about bucket_size
+    bytes.
+    """
+    bucket = []
+    size = 0
+    for parameter in parameters:
+        bucket.append(parameter)
+        size += parameter.numel() * parameter.element_size()
+        if size >= bucket_size:
+            yield bucket
+            bucket = []
+            size = 0
+    if bucket:
+        yield bucket
+
+
+def all_reduce_gradients(parameters, bucket_size):
+    """Averages the gradients of parameters across ranks. The gradients of
+    a bucket of parameters are flattened into a single tensor and reduced
+    together, which takes far less round trips than one all-reduce per
+    parameter.
+    Parameters without a gradient on this rank, e.g. those of the heads
+    when an image had no ROIs, take part with zeros so that all ranks
+    reduce the same buckets.
+    parameters: list of the parameters that require gradients.
+    bucket_size: Size of the buckets in bytes.
+    """
+    size = world_size()
+    for bucket in buckets(parameters, bucket_size):
+        flat = torch.cat([(p.grad if p.grad is not None else torch.zeros_like(p)).reshape(-1)
+                          for p in bucket])
+        dist.all_reduce(flat)
+        flat /= size
+
+        offset = 0
+        for p in bucket:
+            p.grad = flat[offset:offset + p.numel()].view_as(p)
+            offset += p.numel()
+
+
+def all_reduce_mean(values):
+    """Averages a list of floats across ranks, e.g. the losses of an epoch.
+    Returns a list of floats.
+    """
+    if not is_initialized():
+        return list(values)
+    tensor = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(tensor)
+    return (tensor / world_size()).tolist()
@@ -1,23 +1,33 @@
 import argparse
 import os
+import queue
+import threading
+import multiprocessing
+import numpy as np
 import skimage.io
 import torch
 import fnmatch
 import re
 import isic
 import model as modellib
+import quantization
 import visualize as visualize
+import matplotlib.pyplot as plt
 
 ROOT_DIR = os.getcwd()
 
 LOGS_DIR = os.path.join(ROOT_DIR, "logs")
 ISIC_MODEL_PATH = os.path.join(LOGS_DIR, "2017_200_epochs_with_mean", "mask_rcnn_isic_0180.pth")
+# Written by quantization.py from ISIC_MODEL_PATH
+ISIC_QUANTIZED_MODEL_PATH = os.path.splitext(ISIC_MODEL_PATH)[0] + "_int8.pth"
 OUTPUTS_DIR = os.path.join(ROOT_DIR, "outputs")
 
 IGNORE_VAL = "ISIC_0013945, ISIC_0006815, ISIC_0013863"
 IGNORE_TEST = "ISIC_0012147, ISIC_0012941"
 IGNORE = IGNORE_VAL + ", " + IGNORE_TEST
 
+CLASS_NAMES = ["BG", "Lesion"]
+
 
 class InferenceConfig(isic.ISICConfig):
     IMAGES_PER_GPU = 1
@@ -31,45 +41,211 @@ def filter_by_file_types(root, files, file_types):
     return files
 
 
-def predict(images_dir):
+def list_images(images_dir):
+    images = filter_by_file_types(images_dir, os.listdir(images_dir), ["*.jpeg", "*.jpg"])
+    images = sorted(images)
+    images = [image for image in images if image.split("/")[-1][:-4] not in IGNORE]
+
+    return images
+
+
+def load_model(quantized=False):
     config = InferenceConfig()
+    if quantized:
+        # Quantized kernels only run on CPU
+        config.DEVICE = "cpu"
     config.display()
 
     # Create model object.
     model = modellib.MaskRCNN(model_dir=LOGS_DIR, config=config)
-    if config.GPU_COUNT:
-        model = model.cuda()
 
-    # Load weights trained
-    model.load_state_dict(torch.load(ISIC_MODEL_PATH))
+    # Load weights trained, into int8 modules for the quantized model
+    if quantized:
+        quantization.quantizable(model)
+    model.load_state_dict(torch.load(ISIC_QUANTIZED_MODEL_PATH if quantized else ISIC_MODEL_PATH,
+                                     map_location=model.device))
 
     if not os.path.exists(OUTPUTS_DIR):
         os.makedirs(OUTPUTS_DIR)
 
-    images = filter_by_file_types(images_dir, os.listdir(images_dir), ["*.jpeg", "*.jpg"])
-    images = sorted(images)
+    return model
+
+
+def output_path(image):
+    image_name = image.split("/")[-1][:-4]
+    return os.path.join(OUTPUTS_DIR, image_name + ".png")
+
+
+def write_output(output_name, image, image_shape, detections, output_format):
+    if output_format == "overlay":
+        visualize.display_detections(image, detections, CLASS_NAMES, output_name)
+        # Free the figure, otherwise every rendered image stays in memory
+        plt.close("all")
+    else:
+        # Binary lesion mask, the union of all the detected instances
+        mask = np.zeros(image_shape[:2], dtype=np.uint8)
+        for detection in detections:
+            y1, x1, y2, x2 = detection.box
+            mask[y1:y2, x1:x2][detection.bitmap] = 255
+        skimage.io.imsave(output_name, mask)
+
+
+def predict(images_dir, batch_size=1, quantized=False):
+    model = load_model(quantized)
+
+    images = list_images(images_dir)
     total_images = len(images)
     cont = 0
 
-    class_names = ["BG", "Lesion"]
+    # Run the images through the model batch_size images at a time
+    for start in range(0, total_images, batch_size):
+        batch = images[start:start + batch_size]
+        imgs = [skimage.io.imread(image) for image in batch]
+
+        results = model.detect(imgs, mask_format="crop", as_detections=True)
+
+        for image, img, detections in zip(batch, imgs, results):
+            write_output(output_path(image), img, img.shape, detections, "overlay")
+
+            cont = cont + 1
+            print("Processed {}/{} images.".format(cont, total_images))
+
 
+############################################################
+#  Pipelined prediction
+############################################################
+
+def read_images(model, paths, decoded):
+    """Reader stage. Decodes and molds images ahead of the model.
+    Puts a None in the decoded queue when there are no paths left.
+    """
+    while True:
+        try:
+            path = paths.get_nowait()
+        except queue.Empty:
+            break
+
+        try:
+            image = skimage.io.imread(path)
+            molded_images, image_metas, windows = model.mold_inputs([image])
+        except Exception as e:
+            print("Could not read {}: {}".format(path, e))
+            continue
+
+        decoded.put((path, image, molded_images[0], image_metas[0], windows[0]))
+
+    decoded.put(None)
+
+
+def write_outputs(written, output_format):
+    """Writer stage. Renders or encodes the detections of each image until
+    it gets a None from the written queue.
+    """
+    while True:
+        item = written.get()
+        if item is None:
+            break
+
+        output_name, image, image_shape, detections = item
+        # Keep draining the queue, one bad image must not stop the writer
+        try:
+            write_output(output_name, image, image_shape, detections, output_format)
+        except Exception as e:
+            print("Could not write {}: {}".format(output_name, e))
+
+
+def put_output(written, item, writer_procs):
+    """Queues an item for the writers. Raises instead of blocking forever
+    if all of them have died.
+    """
+    while True:
+        try:
+            written.put(item, timeout=1)
+            return
+        except queue.Full:
+            if not any(p.is_alive() for p in writer_procs):
+                raise RuntimeError("All writer processes exited, with codes {}".format(
+                    [p.exitcode for p in writer_procs]))
+
+
+def predict_pipelined(images_dir, batch_size=1, readers=4, writers=4, queue_size=16,
+                      output_format="overlay", quantized=False):
+    """Streams the images through three stages connected by bounded queues:
+    a pool of reader threads decoding and molding the images, the model
+    itself, and a pool of writer processes rendering or encoding the outputs.
+    The bounded queues keep the memory use flat on large folders.
+    """
+    model = load_model(quantized)
+
+    images = list_images(images_dir)
+    total_images = len(images)
+    cont = 0
+
+    paths = queue.Queue()
     for image in images:
-        image_name = image.split("/")[-1][:-4]
+        paths.put(image)
+    decoded = queue.Queue(maxsize=queue_size)
+
+    # Rendering goes through matplotlib which is neither thread safe nor
+    # releases the GIL, so writers are processes. Spawn them rather than
+    # fork to not inherit the threads of torch.
+    context = multiprocessing.get_context("spawn")
+    written = context.Queue(maxsize=queue_size)
+    writer_procs = [context.Process(target=write_outputs, args=(written, output_format))
+                    for _ in range(writers)]
+    for p in writer_procs:
+        p.start()
+
+    reader_threads = [threading.Thread(target=read_images, args=(model, paths, decoded))
+                      for _ in range(readers)]
+    for t in reader_threads:
+        t.daemon = True
+        t.start()
+
+    try:
+        finished = 0
+        while finished < readers:
+            # Fill a batch with whatever the readers have decoded
+            batch = []
+            while len(batch) < batch_size and finished < readers:
+                item = decoded.get()
+                if item is None:
+                    finished += 1
+                else:
+                    batch.append(item)
+            if not batch:
+                continue
 
-        if image_name not in IGNORE:
-            img = skimage.io.imread(image)
+            batch_paths, imgs, molded_images, image_metas, windows = zip(*batch)
+            results = model.detect_molded(np.stack(molded_images), np.stack(image_metas),
+                                          np.stack(windows), [img.shape for img in imgs],
+                                          mask_format="crop", as_detections=True)
 
-            result = model.detect([img])
-            pred = result[0]
+            for image, img, detections in zip(batch_paths, imgs, results):
+                # Only the overlay needs the image itself
+                put_output(written, (output_path(image), img if output_format == "overlay" else None,
+                                     img.shape, detections), writer_procs)
 
-            output_name = os.path.join(OUTPUTS_DIR, image_name + ".png")
-            #visualize.display_instances(
-                #img, pred["rois"], pred["masks"], title=output_name)
-            visualize.display_instances(img, pred['rois'], pred['masks'], pred['class_ids'],
-                            class_names, output_name, pred['scores'])
+                cont = cont + 1
+                print("Processed {}/{} images.".format(cont, total_images))
+    except BaseException:
+        # On errors and Ctrl-C no more outputs are coming. Stop the writers
+        # blocked on the queue, the interpreter would wait for them forever
+        # at exit, and don't wait either for the outputs still buffered.
+        written.cancel_join_thread()
+        for p in writer_procs:
+            p.terminate()
+        for p in writer_procs:
+            p.join()
+        raise
 
-        cont = cont + 1
-        print("Processed {}/{} images.".format(cont, total_images))
+    for _ in writer_procs:
+        put_output(written, None, writer_procs)
+    for p in writer_procs:
+        p.join()
+    failed = [p.exitcode for p in writer_procs if p.exitcode != 0]
+    if failed:
+        raise RuntimeError("Writer processes exited with codes {}, some outputs may be missing".format(failed))
 
 
 def get_args():
@@ -77,6 +253,21 @@ def get_args():
 
     parser.add_argument("-d", "--images-dir", required=True,
                         help="Dir where the images are located.")
+    parser.add_argument("-b", "--batch-size", type=int, default=1,
+                        help="Number of images run through the model at once.")
+    parser.add_argument("-p", "--pipeline", action="store_true",
+                        help="Decode, predict and write the outputs in parallel stages.")
+    parser.add_argument("--readers", type=int, default=4,
+                        help="Number of reader threads in pipeline mode.")
+    parser.add_argument("--writers", type=int, default=4,
+                        help="Number of writer processes in pipeline mode.")
+    parser.add_argument("--queue-size", type=int, default=16,
+                        help="Maximum number of images waiting between two stages in pipeline mode.")
+    parser.add_argument("--output-format", choices=["overlay", "mask"], default="overlay",
+                        help="Write the detections drawn over the image or a binary lesion mask "
+                             "(pipeline mode).")
+    parser.add_argument("-q", "--quantized", action="store_true",
+                        help="Use the int8 model written by quantization.py, faster on CPU.")
 
     return parser.parse_args()
 
@@ -84,4 +275,8 @@ def get_args():
 if __name__ == "__main__":
     args = get_args()
 
-    predict(args.images_dir)
\ No newline at end of file
+    if args.pipeline:
+        predict_pipelined(args.images_dir, args.batch_size, args.readers, args.writers,
+                          args.queue_size, args.output_format, args.quantized)
+    else:
+        predict(args.images_dir, args.batch_size, args.quantized)
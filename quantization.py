@@ -0,0 +1,240 @@
+"""
+Mask R-CNN
+Post-training int8 quantization of the backbone for CPU inference.
+
+Most of the inference time on CPU goes into the ResNet101 and the FPN.
+quantize() fuses their convolutions with the batch norms and ReLUs that
+follow them, records the ranges of their activations on a sample of
+images and converts them to int8 convolutions (eager mode
+torch.ao.quantization). The RPN and the heads stay in float32.
+
+A quantized model is saved with its state dict, like any checkpoint, and
+loaded back with load_state_dict() into a model whose backbone was made
+quantizable first:
+
+    import quantization
+    model = modellib.MaskRCNN(config=config, model_dir=LOGS_DIR)
+    quantization.quantizable(model)
+    model.load_state_dict(torch.load("mask_rcnn_isic_0180_int8.pth"))
+
+Quantized models only run on CPU, and can't be trained further.
+
+Usage: run from the command line as such:
+
+    # Quantize trained weights, calibrating on 32 training images, and
+    # compare the lesion masks of the int8 and float32 models on 50
+    # validation images. Writes mask_rcnn_isic_0180_int8.pth.
+    python3 quantization.py --weights=logs/2017_200_epochs_with_mean/mask_rcnn_isic_0180.pth
+
+    # Use it for prediction
+    python3 predict.py --images-dir=/path/to/images --quantized
+"""
+
+import argparse
+import os
+import time
+import warnings
+
+import numpy as np
+import torch
+import torch.ao.quantization as quant
+
+import isic
+import model as modellib
+
+
+# Quantized kernels of x86 CPUs (fbgemm and oneDNN), QNNPACK on ARM
+BACKEND = "x86" if "x86" in torch.backends.quantized.supported_engines else "qnnpack"
+
+
+############################################################
+#  Quantization
+############################################################
+
+def fuse(fpn):
+    """Fuses the convolutions of the ResNet with the batch norms and ReLUs
+    that follow them, in place. The batch norms must be in eval mode.
+    """
+    quant.fuse_modules(fpn.C1, [["0", "1", "2"]], inplace=True)
+    for stage in [fpn.C2, fpn.C3, fpn.C4, fpn.C5]:
+        for block in stage:
+            quant.fuse_modules(block, [["conv1", "bn1", "relu1"],
+                                       ["conv2", "bn2", "relu2"],
+                                       ["conv3", "bn3"]], inplace=True)
+            if block.downsample is not None:
+                quant.fuse_modules(block.downsample, [["0", "1"]], inplace=True)
+
+
+def prepare(model, backend=BACKEND):
+    """Fuses the backbone of a float32 model and inserts the observers that
+    record the ranges of its activations.
+    """
+    if model.device.type != "cpu":
+        raise ValueError("Quantized models run on CPU only, set DEVICE = 'cpu' in the config")
+    torch.backends.quantized.engine = backend
+    model.eval()
+    fuse(model.fpn)
+    model.fpn.qconfig = quant.get_default_qconfig(backend)
+    quant.prepare(model.fpn, inplace=True)
+
+
+def calibrate(model, images):
+    """Runs images through the backbone of a prepared model, for its
+    observers to record the ranges of the activations.
+    images: List of images, e.g. from Dataset.load_image().
+    """
+    with torch.no_grad():
+        for image in images:
+            molded_images, image_metas, windows = model.mold_inputs([image])
+            molded_images = torch.from_numpy(molded_images.transpose(0, 3, 1, 2)).float()
+            model.fpn(molded_images)
+
+
+def quantize(model, images, backend=BACKEND):
+    """Quantizes the ResNet and FPN of a float32 model to int8, in place.
+    images: List of images to calibrate on, a few dozen representative ones.
+    Returns the model.
+    """
+    prepare(model, backend)
+    calibrate(model, images)
+    quant.convert(model.fpn, inplace=True)
+    return model
+
+
+def quantizable(model, backend=BACKEND):
+    """Replaces the backbone of a float32 model with int8 modules, in place,
+    for load_state_dict() to load the weights and activation ranges of a
+    quantized model into.
+    Returns the model.
+    """
+    prepare(model, backend)
+    with warnings.catch_warnings():
+        # The observers have seen no data, the state dict has the ranges
+        warnings.simplefilter("ignore")
+        quant.convert(model.fpn, inplace=True)
+    return model
+
+
+############################################################
+#  Evaluation
+############################################################
+
+def lesion_mask(result, shape):
+    """Union of the instance masks of a detect() result."""
+    if not result["masks"].shape[-1]:
+        return np.zeros(shape[:2], dtype=bool)
+    return np.any(result["masks"], axis=2)
+
+
+def mask_iou(mask1, mask2):
+    """IoU of two binary masks, 1 if both are empty."""
+    union = np.sum(mask1 | mask2)
+    return np.sum(mask1 & mask2) / union if union else 1.0
+
+
+def compare(reference, quantized, dataset, image_ids):
+    """Runs the float32 and int8 models on images and reports the IoU of
+    their lesion masks with each other and with the ground truth, and the
+    time they take.
+    Returns the [N, (int8 vs float32, float32 vs GT, int8 vs GT)] IoUs.
+    """
+    ious = []
+    times = np.zeros(2)
+    for i, image_id in enumerate(image_ids):
+        image = dataset.load_image(image_id)
+        gt_masks, gt_class_ids = dataset.load_mask(image_id)
+        gt_mask = np.any(gt_masks[:, :, gt_class_ids > 0], axis=2)
+
+        masks = []
+        for m, model in enumerate([reference, quantized]):
+            start = time.perf_counter()
+            result = model.detect([image])[0]
+            times[m] += time.perf_counter() - start
+            masks.append(lesion_mask(result, image.shape))
+
+        ious.append((mask_iou(masks[1], masks[0]), mask_iou(masks[0], gt_mask),
+                     mask_iou(masks[1], gt_mask)))
+        print("Compared {}/{} images.".format(i + 1, len(image_ids)))
+
+    ious = np.array(ious)
+    times = times / len(image_ids) * 1000
+    print("Lesion mask IoU of int8 against float32: mean {:.4f}, min {:.4f}".format(
+        np.mean(ious[:, 0]), np.min(ious[:, 0])))
+    print("Lesion mask IoU against ground truth: float32 {:.4f}, int8 {:.4f}".format(
+        np.mean(ious[:, 1]), np.mean(ious[:, 2])))
+    print("Time per image: float32 {:.0f} ms, int8 {:.0f} ms (x{:.1f})".format(
+        times[0], times[1], times[0] / times[1]))
+    return ious
+
+
+############################################################
+#  Command line
+############################################################
+
+class QuantizationConfig(isic.ISICConfig):
+    IMAGES_PER_GPU = 1
+    DEVICE = "cpu"
+
+
+def load_model(config, weights):
+    model = modellib.MaskRCNN(config=config, model_dir=isic.DEFAULT_LOGS_DIR)
+    model.load_state_dict(torch.load(weights, map_location=model.device))
+    return model
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Quantize the backbone of a trained Mask R-CNN to int8.')
+    parser.add_argument('--weights', required=True,
+                        metavar="/path/to/weights.pth",
+                        help='Trained float32 weights')
+    parser.add_argument('--output', required=False,
+                        metavar="/path/to/weights_int8.pth",
+                        help='Where to save the quantized model (default=<weights>_int8.pth)')
+    parser.add_argument('--calibration-dir', required=False,
+                        default=isic.ISIC_TRAIN_DIR,
+                        metavar="/path/to/ISIC/subset/",
+                        help='ISIC subset to calibrate on (default=' + isic.ISIC_TRAIN_DIR + ')')
+    parser.add_argument('--calibration-subset', required=False,
+                        default="Train",
+                        help="Subset of the annotations file of --calibration-dir (default=Train)")
+    parser.add_argument('--calibration-images', type=int, default=32,
+                        help='Number of images to calibrate on (default=32)')
+    parser.add_argument('--eval-dir', required=False,
+                        default=isic.ISIC_VAL_DIR,
+                        metavar="/path/to/ISIC/subset/",
+                        help='ISIC subset to compare the models on (default=' + isic.ISIC_VAL_DIR + ')')
+    parser.add_argument('--eval-subset', required=False,
+                        default="Val",
+                        help="Subset of the annotations file of --eval-dir (default=Val)")
+    parser.add_argument('--eval-images', type=int, default=50,
+                        help='Number of images to compare the models on, 0 to skip (default=50)')
+    parser.add_argument('--backend', required=False,
+                        default=BACKEND,
+                        choices=torch.backends.quantized.supported_engines,
+                        help='Quantized kernels to use (default=' + BACKEND + ')')
+    args = parser.parse_args()
+
+    config = QuantizationConfig()
+    output = args.output or os.path.splitext(args.weights)[0] + "_int8.pth"
+    rng = np.random.RandomState(0)
+
+    dataset = isic.load_dataset(args.calibration_dir, args.calibration_subset, config)
+    image_ids = rng.choice(dataset.image_ids, min(args.calibration_images, len(dataset.image_ids)),
+                           replace=False)
+    print("Calibrating on {} images of {}".format(len(image_ids), args.calibration_dir))
+    model = quantize(load_model(config, args.weights), [dataset.load_image(i) for i in image_ids],
+                     args.backend)
+    torch.save(model.state_dict(), output)
+    print("Saved the quantized model to {}".format(output))
+
+    if args.eval_images:
+        # The quantized model as predict.py loads it
+        quantized = quantizable(modellib.MaskRCNN(config=config, model_dir=isic.DEFAULT_LOGS_DIR),
+                                args.backend)
+        quantized.load_state_dict(torch.load(output, map_location=quantized.device))
+
+        dataset = isic.load_dataset(args.eval_dir, args.eval_subset, config)
+        image_ids = rng.choice(dataset.image_ids, min(args.eval_images, len(dataset.image_ids)),
+                               replace=False)
+        compare(load_model(config, args.weights), quantized, dataset, image_ids)
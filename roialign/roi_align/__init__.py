@@ -0,0 +1,65 @@
+"""
+Crop and resize, the op behind RoIAlign, with selectable backends:
+
+ext:    The compiled C/CUDA extension built with build.py.
+torch:  Vectorized PyTorch ops (crop_and_resize_torch.py). Runs on any
+        device and PyTorch version and gives the same crops as ext.
+
+The extension is used when it is built and imports, PyTorch otherwise.
+Set the ROI_ALIGN_BACKEND environment variable or call set_backend() to
+pick one explicitly.
+"""
+
+import os
+
+from . import crop_and_resize as crop_and_resize_ext
+from . import crop_and_resize_torch
+
+BACKENDS = ["ext", "torch"]
+
+
+def available_backends():
+    """Returns the names of the backends that can be used."""
+    if crop_and_resize_ext._backend is None:
+        return ["torch"]
+    return list(BACKENDS)
+
+
+def set_backend(name):
+    """Selects the backend used by CropAndResizeFunction."""
+    global _backend
+    if name not in BACKENDS:
+        raise ValueError("Unknown crop and resize backend '{}'. Use one of {}".format(name, BACKENDS))
+    if name not in available_backends():
+        raise RuntimeError("Crop and resize backend '{}' is not available. "
+                           "Build it with roialign/roi_align/build.py".format(name))
+    _backend = name
+
+
+def get_backend():
+    """Returns the name of the selected backend."""
+    return _backend
+
+
+class CropAndResizeFunction(object):
+    """Crops and resizes boxes with the selected backend.
+    Same interface as the Function of the extension:
+        CropAndResizeFunction(crop_height, crop_width)(image, boxes, box_ind)
+    """
+
+    def __init__(self, crop_height, crop_width, extrapolation_value=0):
+        self.crop_height = crop_height
+        self.crop_width = crop_width
+        self.extrapolation_value = extrapolation_value
+
+    def __call__(self, image, boxes, box_ind):
+        if _backend == "ext":
+            return crop_and_resize_ext.CropAndResizeFunction(
+                self.crop_height, self.crop_width, self.extrapolation_value)(image, boxes, box_ind)
+        return crop_and_resize_torch.crop_and_resize(
+            image, boxes, box_ind, self.crop_height, self.crop_width, self.extrapolation_value)
+
+
+_backend = available_backends()[0]
+if os.environ.get("ROI_ALIGN_BACKEND"):
+    set_backend(os.environ["ROI_ALIGN_BACKEND"])
@@ -4,7 +4,12 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Function
 
-from ._ext import crop_and_resize as _backend
+try:
+    from ._ext import crop_and_resize as _backend
+except ImportError:
+    # Not built (see build.py), or can't be built with this version of
+    # PyTorch. roialign.roi_align falls back to crop_and_resize_torch.
+    _backend = None
 
 
 class CropAndResizeFunction(Function):
@@ -0,0 +1,163 @@
+import torch
+
+
+def sample_coordinates(c1, c2, crop_size, size):
+    """Coordinates at which crop_and_resize samples the feature map along
+    one axis, following tf.image.crop_and_resize and the C kernel.
+    c1, c2: [num_boxes] normalized box start and end along the axis.
+    crop_size: number of samples along the axis.
+    size: [num_boxes] or int. Feature map size along the axis.
+    Returns [num_boxes, crop_size] coordinates in feature map pixels and a
+    boolean mask of the coordinates that fall inside the feature map.
+    """
+    if torch.is_tensor(size):
+        size = size.to(c1.dtype)
+    if crop_size > 1:
+        scale = (c2 - c1) * (size - 1) / (crop_size - 1)
+        ix = torch.arange(crop_size, dtype=c1.dtype, device=c1.device)
+        coords = (c1 * (size - 1)).unsqueeze(1) + ix.unsqueeze(0) * scale.unsqueeze(1)
+    else:
+        coords = (0.5 * (c1 + c2) * (size - 1)).unsqueeze(1)
+
+    if torch.is_tensor(size):
+        size = size.unsqueeze(1)
+    valid = (coords >= 0) & (coords <= size - 1)
+    return coords, valid
+
+
+def _clamp_index(ix, size):
+    """Clamps [num_boxes, crop_size] pixel indices to [0, size - 1], with
+    size an int or a [num_boxes] tensor.
+    """
+    if torch.is_tensor(size):
+        return torch.min(ix.clamp(min=0), size.unsqueeze(1) - 1)
+    return ix.clamp(0, size - 1)
+
+
+def bilinear_crops(features, box_ind, in_y, in_x, valid, height, width, offset=0,
+                   extrapolation_value=0):
+    """Bilinear sampling of flattened feature maps at the grid of every box
+    in one gather per corner.
+    features: [batch, pixels, channels] channels last feature maps with their
+              spatial dimensions flattened. Several maps may be packed one
+              after the other along the pixels dimension.
+    box_ind: [num_boxes] image of the batch each box samples from.
+    in_y: [num_boxes, crop_height], in_x: [num_boxes, crop_width] sample
+          coordinates in pixels.
+    valid: [num_boxes, crop_height, crop_width] samples inside the map.
+    height, width, offset: int or [num_boxes]. Size of the map each box
+          samples from and where it starts in the pixels dimension.
+    Returns [num_boxes, channels, crop_height, crop_width]
+    """
+    # Out of the map samples are replaced by the extrapolation value
+    # below. Clamp them so the gathers stay in the map of the box.
+    top = in_y.floor()
+    left = in_x.floor()
+    y_lerp = (in_y - top).unsqueeze(2).unsqueeze(3)
+    x_lerp = (in_x - left).unsqueeze(1).unsqueeze(3)
+    top_ix = _clamp_index(top.long(), height)
+    bottom_ix = _clamp_index(in_y.ceil().long(), height)
+    left_ix = _clamp_index(left.long(), width).unsqueeze(1)
+    right_ix = _clamp_index(in_x.ceil().long(), width).unsqueeze(1)
+    if torch.is_tensor(width):
+        width = width.view(-1, 1)
+        offset = offset.view(-1, 1, 1)
+    # Rows of the features seen as [batch * pixels, channels]
+    pixels, channels = features.size()[1:3]
+    start = box_ind.long().view(-1, 1, 1) * pixels + offset
+    top_ix = (top_ix * width).unsqueeze(2) + start
+    bottom_ix = (bottom_ix * width).unsqueeze(2) + start
+    features = features.reshape(-1, channels)
+
+    def gather(ix):
+        # Each sample is a contiguous row of channels, which is what makes
+        # channels last fast. The backward scatters the gradients back with
+        # the same bilinear weights.
+        return features.index_select(0, ix.view(-1)).view(ix.size() + (channels,))
+
+    # [num_boxes, crop_height, crop_width, channels]
+    top_left = gather(top_ix + left_ix)
+    top_right = gather(top_ix + right_ix)
+    bottom_left = gather(bottom_ix + left_ix)
+    bottom_right = gather(bottom_ix + right_ix)
+
+    top = top_left + (top_right - top_left) * x_lerp
+    bottom = bottom_left + (bottom_right - bottom_left) * x_lerp
+    crops = top + (bottom - top) * y_lerp
+
+    crops = torch.where(valid.unsqueeze(3), crops, crops.new_full((1,), extrapolation_value))
+    return crops.permute(0, 3, 1, 2).contiguous()
+
+
+def channels_last(image):
+    """Lays a [batch, channels, height, width] feature map out as the
+    [batch, pixels, channels] features that crop_and_resize samples from.
+    """
+    return image.permute(0, 2, 3, 1).reshape(image.size(0), -1, image.size(1))
+
+
+def crop_and_resize(image, boxes, box_ind, crop_height, crop_width, extrapolation_value=0,
+                    features=None):
+    """Crop and resize ported from tensorflow in plain PyTorch ops. Gives the
+    same crops as the C extension and its gradient w.r.t. the image comes
+    from autograd. As in the extension, no gradient flows to the boxes.
+    image: [batch, channels, height, width]
+    boxes: [num_boxes, (y1, x1, y2, x2)] in normalized coordinates.
+    box_ind: [num_boxes] image of the batch each box crops from.
+    features: Optional channels_last(image), to copy a feature map cropped
+              several times only once.
+    Returns [num_boxes, channels, crop_height, crop_width]
+    """
+    height, width = image.size()[2:4]
+    boxes = boxes.detach()
+    y1, x1, y2, x2 = boxes.unbind(1)
+
+    in_y, valid_y = sample_coordinates(y1, y2, crop_height, height)
+    in_x, valid_x = sample_coordinates(x1, x2, crop_width, width)
+    valid = valid_y.unsqueeze(2) & valid_x.unsqueeze(1)
+
+    if features is None:
+        features = channels_last(image)
+    return bilinear_crops(features, box_ind, in_y, in_x, valid, height, width,
+                          extrapolation_value=extrapolation_value)
+
+
+def pack_levels(feature_maps):
+    """Packs feature maps of different sizes into a single tensor that
+    multilevel_crop_and_resize can sample from.
+    feature_maps: list of [batch, channels, height, width]
+    Returns [batch, pixels, channels] channels last features and the
+    [num_levels] heights, widths and offsets of the levels in the pixels
+    dimension.
+    """
+    device = feature_maps[0].device
+    heights = torch.tensor([f.size(2) for f in feature_maps], device=device)
+    widths = torch.tensor([f.size(3) for f in feature_maps], device=device)
+    offsets = torch.cumsum(heights * widths, 0) - heights * widths
+    features = torch.cat([f.permute(0, 2, 3, 1).reshape(f.size(0), -1, f.size(1))
+                          for f in feature_maps], dim=1)
+    return features, heights, widths, offsets
+
+
+def multilevel_crop_and_resize(packed, boxes, box_ind, levels, crop_height, crop_width,
+                               extrapolation_value=0):
+    """Crop and resize of boxes that each sample a different level of a
+    feature pyramid, done for all boxes at once.
+    packed: the output of pack_levels.
+    boxes: [num_boxes, (y1, x1, y2, x2)] in normalized coordinates.
+    box_ind: [num_boxes] image of the batch each box crops from.
+    levels: [num_boxes] index in the pyramid of the level of each box.
+    Returns [num_boxes, channels, crop_height, crop_width] in box order.
+    """
+    features, heights, widths, offsets = packed
+    boxes = boxes.detach()
+    y1, x1, y2, x2 = boxes.unbind(1)
+    height, width, offset = heights[levels], widths[levels], offsets[levels]
+
+    in_y, valid_y = sample_coordinates(y1, y2, crop_height, height)
+    in_x, valid_x = sample_coordinates(x1, x2, crop_width, width)
+    valid = valid_y.unsqueeze(2) & valid_x.unsqueeze(1)
+
+    return bilinear_crops(features, box_ind, in_y, in_x, valid, height, width, offset,
+                          extrapolation_value)
+
@@ -1,7 +1,7 @@
 import torch
 from torch import nn
 
-from .crop_and_resize import CropAndResizeFunction, CropAndResize
+from . import CropAndResizeFunction
 
 
 class RoIAlign(nn.Module):
@@ -0,0 +1,82 @@
+"""
+Mask R-CNN
+Cache of preprocessed training samples.
+
+Most of the time of load_image_gt() goes into decoding the image and the
+annotations, resizing them and building the mini masks, the same way every
+epoch. With SAMPLE_CACHE_DIR set in the config, the result of this
+deterministic part is stored once per image and read back in the following
+epochs. Random augmentations are applied on top of it at load time.
+
+The samples of a config live in a subdirectory named after the hash of the
+config fields they depend on and of the resize backend, so changing any of
+them starts a new cache.
+"""
+
+import hashlib
+import io
+import os
+
+import numpy as np
+
+import utils
+
+
+# Bump when the preprocessing or the layout of the cached samples changes
+CACHE_VERSION = 2
+
+# Config fields the preprocessing depends on
+CONFIG_FIELDS = ["IMAGE_MIN_DIM", "IMAGE_MAX_DIM", "IMAGE_PADDING", "MINI_MASK_SHAPE"]
+
+# Arrays of a sample, see model.load_image_sample()
+SAMPLE_FIELDS = ["image", "shape", "window", "class_ids", "bbox", "mask"]
+
+
+def config_hash(config, use_mini_mask):
+    """Hash of what the cached samples of a config depend on. The resize
+    backends don't give exactly the same pixels, so it is part of it.
+    """
+    values = [CACHE_VERSION, bool(use_mini_mask), utils.get_resize_backend()]
+    values += [(name, np.asarray(getattr(config, name)).tolist()) for name in CONFIG_FIELDS]
+    return hashlib.sha1(repr(values).encode()).hexdigest()[:16]
+
+
+class SampleCache(object):
+    """Directory of preprocessed samples, one .npz file per image."""
+
+    def __init__(self, cache_dir, config, use_mini_mask):
+        self.cache_dir = os.path.join(cache_dir, config_hash(config, use_mini_mask))
+
+    def path(self, dataset, image_id):
+        """File of an image. Images are identified by their source, their id
+        in the source and their path, not by their index in the dataset,
+        which changes from a dataset to the other.
+        """
+        info = dataset.image_info[image_id]
+        key = repr((info["source"], info["id"], info.get("path")))
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".npz")
+
+    def load(self, dataset, image_id):
+        """Returns the cached sample as a tuple of SAMPLE_FIELDS, or None if
+        the image isn't cached yet.
+        """
+        path = self.path(dataset, image_id)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as sample:
+            return tuple(sample[name] for name in SAMPLE_FIELDS)
+
+    def save(self, dataset, image_id, sample):
+        """Stores a sample, a tuple of SAMPLE_FIELDS."""
+        path = self.path(dataset, image_id)
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        # Several DataLoader workers may write the same sample. Write to a
+        # temporary file and rename, so readers never see a partial file.
+        buffer = io.BytesIO()
+        np.savez(buffer, **dict(zip(SAMPLE_FIELDS, sample)))
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            f.write(buffer.getvalue())
+        os.replace(tmp_path, path)
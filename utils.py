@@ -12,39 +12,62 @@ import os
 import math
 import random
 import numpy as np
-import scipy.misc
-import scipy.ndimage
 import skimage.color
 import skimage.io
 import torch
+import torch.nn.functional as F
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
 
 ############################################################
 #  Bounding Boxes
 ############################################################
 
+# Max number of elements of each temporary array of compute_overlaps().
+# 2**16 float64 values are 512KB, small enough to stay in cache, which is
+# faster than larger chunks.
+OVERLAPS_MAX_ELEMENTS = 2 ** 16
+
 def extract_bboxes(mask):
     """Compute bounding boxes from masks.
     mask: [height, width, num_instances]. Mask pixels are either 1 or 0.
 
     Returns: bbox array [num_instances, (y1, x1, y2, x2)].
     """
-    boxes = np.zeros([mask.shape[-1], 4], dtype=np.int32)
-    for i in range(mask.shape[-1]):
-        m = mask[:, :, i]
-        # Bounding box.
-        horizontal_indicies = np.where(np.any(m, axis=0))[0]
-        vertical_indicies = np.where(np.any(m, axis=1))[0]
-        if horizontal_indicies.shape[0]:
-            x1, x2 = horizontal_indicies[[0, -1]]
-            y1, y2 = vertical_indicies[[0, -1]]
-            # x2 and y2 should not be part of the box. Increment by 1.
-            x2 += 1
-            y2 += 1
-        else:
-            # No mask for this instance. Might happen due to
-            # resizing or cropping. Set bbox to zeros
-            x1, x2, y1, y2 = 0, 0, 0, 0
-        boxes[i] = np.array([y1, x1, y2, x2])
+    # Columns and rows of each instance that have mask pixels
+    # [width, num_instances] and [height, num_instances]
+    mask = mask.astype(bool, copy=False)
+    horizontal = np.any(mask, axis=0)
+    # np.any(mask, axis=1) reduces runs of num_instances values, which is
+    # slow. OR the two halves of the columns instead until one is left,
+    # each step on large contiguous blocks.
+    vertical = mask
+    while vertical.shape[1] > 1:
+        half = vertical.shape[1] // 2
+        odd = vertical[:, 2 * half:]
+        vertical = vertical[:, :half] | vertical[:, half:2 * half]
+        vertical[:, :odd.shape[1]] |= odd
+    vertical = vertical[:, 0]
+
+    # First and last of them, for all instances at once.
+    # x2 and y2 should not be part of the box, hence the + 1.
+    x1 = np.argmax(horizontal, axis=0)
+    x2 = horizontal.shape[0] - np.argmax(horizontal[::-1], axis=0)
+    y1 = np.argmax(vertical, axis=0)
+    y2 = vertical.shape[0] - np.argmax(vertical[::-1], axis=0)
+    boxes = np.stack([y1, x1, y2, x2], axis=1)
+
+    # No mask for an instance. Might happen due to
+    # resizing or cropping. Set bbox to zeros
+    boxes[~np.any(horizontal, axis=0)] = 0
     return boxes.astype(np.int32)
 
 
@@ -69,22 +92,41 @@ def compute_iou(box, boxes, box_area, boxes_area):
     return iou
 
 
-def compute_overlaps(boxes1, boxes2):
+def compute_overlaps(boxes1, boxes2, area1=None, max_elements=OVERLAPS_MAX_ELEMENTS):
     """Computes IoU overlaps between two sets of boxes.
     boxes1, boxes2: [N, (y1, x1, y2, x2)].
+    area1: Optional precomputed areas of boxes1, e.g. of the anchors.
+    max_elements: Bound on the size of the temporary arrays. boxes1 is
+        processed in chunks of max_elements / len(boxes2) boxes.
 
     For better performance, pass the largest set first and the smaller second.
     """
     # Areas of anchors and GT boxes
-    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    if area1 is None:
+        area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
     area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
 
     # Compute overlaps to generate matrix [boxes1 count, boxes2 count]
     # Each cell contains the IoU value.
     overlaps = np.zeros((boxes1.shape[0], boxes2.shape[0]))
-    for i in range(overlaps.shape[1]):
-        box2 = boxes2[i]
-        overlaps[:, i] = compute_iou(box2, boxes1, area2[i], area1)
+    if boxes2.shape[0] == 0:
+        return overlaps
+    chunk = max(max_elements // boxes2.shape[0], 1)
+    for start in range(0, boxes1.shape[0], chunk):
+        box1 = boxes1[start:start + chunk]
+        # Calculate intersection areas, [chunk, boxes2 count]. In place, to
+        # keep the temporaries few and in cache.
+        h = np.minimum(box1[:, 2, np.newaxis], boxes2[:, 2])
+        h -= np.maximum(box1[:, 0, np.newaxis], boxes2[:, 0])
+        np.maximum(h, 0, out=h)
+        w = np.minimum(box1[:, 3, np.newaxis], boxes2[:, 3])
+        w -= np.maximum(box1[:, 1, np.newaxis], boxes2[:, 1])
+        np.maximum(w, 0, out=w)
+        intersection = h
+        intersection *= w
+        union = area2 + area1[start:start + chunk, np.newaxis]
+        union -= intersection
+        np.divide(intersection, union, out=overlaps[start:start + chunk])
     return overlaps
 
 def box_refinement(box, gt_box):
@@ -137,6 +179,7 @@ class Dataset(object):
         # Background is always the first class
         self.class_info = [{"source": "", "id": 0, "name": "BG"}]
         self.source_class_ids = {}
+        self._instance_counts = None
 
     def add_class(self, source, class_id, class_name):
         assert "." not in source, "Source name cannot contain a dot"
@@ -186,6 +229,7 @@ class Dataset(object):
         self.class_names = [clean_name(c["name"]) for c in self.class_info]
         self.num_images = len(self.image_info)
         self._image_ids = np.arange(self.num_images)
+        self._instance_counts = None
 
         self.class_from_source_map = {"{}.{}".format(info['source'], info['id']): id
                                       for info, id in zip(self.class_info, self.class_ids)}
@@ -231,6 +275,25 @@ class Dataset(object):
     def image_ids(self):
         return self._image_ids
 
+    def instance_count(self, image_id):
+        """Returns the number of instances of an image the model trains on,
+        that is without crowds.
+
+        This loads the masks. Override it with a cheaper count if the
+        dataset has one, e.g. from its annotations.
+        """
+        _, class_ids = self.load_mask(image_id)
+        return int(np.sum(class_ids > 0))
+
+    def instance_counts(self):
+        """Returns the instance_count() of every image, computed on the
+        first call and cached.
+        """
+        if self._instance_counts is None:
+            self._instance_counts = np.array([self.instance_count(image_id)
+                                              for image_id in self.image_ids], dtype=np.int32)
+        return self._instance_counts
+
     def source_image_link(self, image_id):
         """Returns the path or URL to the image.
         Override this to return a URL to the image if it's availble online for easy
@@ -267,6 +330,158 @@ class Dataset(object):
         return mask, class_ids
 
 
+############################################################
+#  Resizing
+############################################################
+
+# Backends of imresize(), in order of preference:
+# pil:   Pillow, or Pillow-SIMD which replaces it. Gives the same results as
+#        the scipy.misc.imresize() this code was written against, which
+#        resized with PIL too.
+# cv2:   OpenCV. Resizes up to 512 channels per call. Its bilinear filter
+#        doesn't antialias when downscaling, so results differ from PIL's.
+# torch: torch.nn.functional.interpolate on a batch of channels. Rounds in
+#        float, results may differ from PIL's by one gray level.
+# Set the RESIZE_BACKEND environment variable or call set_resize_backend()
+# to pick one explicitly.
+RESIZE_BACKENDS = ["pil", "cv2", "torch"]
+
+# Max number of elements of the temporary arrays of unmold_masks()
+UNMOLD_MAX_ELEMENTS = 2 ** 22
+
+# Bits of the fractional part of the fixed point resampling weights of PIL
+# for 8 bit images
+PIL_PRECISION_BITS = 32 - 8 - 2
+
+
+def available_resize_backends():
+    """Returns the names of the resize backends that can be used."""
+    modules = {"pil": Image, "cv2": cv2, "torch": torch}
+    return [name for name in RESIZE_BACKENDS if modules[name] is not None]
+
+
+def set_resize_backend(name):
+    """Selects the backend used by imresize()."""
+    global _resize_backend
+    if name not in RESIZE_BACKENDS:
+        raise ValueError("Unknown resize backend '{}'. Use one of {}".format(name, RESIZE_BACKENDS))
+    if name not in available_resize_backends():
+        raise RuntimeError("Resize backend '{}' is not available, install it first".format(name))
+    _resize_backend = name
+
+
+def get_resize_backend():
+    """Returns the name of the selected resize backend."""
+    return _resize_backend
+
+
+_resize_backend = available_resize_backends()[0]
+if os.environ.get("RESIZE_BACKEND"):
+    set_resize_backend(os.environ["RESIZE_BACKEND"])
+
+
+def bytescale(data):
+    """Converts an array to uint8 like scipy.misc.bytescale(), which
+    scipy.misc.imresize() applied to its input: uint8 arrays are returned
+    as is, other arrays are scaled from [min, max] to [0, 255] and rounded.
+    """
+    if data.dtype == np.uint8:
+        return data
+    cmin = data.min()
+    cmax = data.max()
+    cscale = cmax - cmin
+    if cscale == 0:
+        cscale = 1
+    scale = 255.0 / cscale
+    bytedata = (data - cmin) * scale
+    return (bytedata.clip(0, 255) + 0.5).astype(np.uint8)
+
+
+def _resize_pil(image, size, interp):
+    resample = {"nearest": Image.NEAREST, "bilinear": Image.BILINEAR,
+                "bicubic": Image.BICUBIC}[interp]
+    if image.ndim == 2 or image.shape[2] == 3:
+        # Grayscale and RGB images in one call
+        return np.asarray(Image.fromarray(image).resize((size[1], size[0]), resample))
+    # Any other number of channels one by one
+    return np.stack([_resize_pil(image[:, :, i], size, interp)
+                     for i in range(image.shape[2])], axis=2)
+
+
+def _resize_cv2(image, size, interp):
+    flags = {"nearest": cv2.INTER_NEAREST, "bilinear": cv2.INTER_LINEAR,
+             "bicubic": cv2.INTER_CUBIC}[interp]
+    if image.ndim == 3 and image.shape[2] > 512:
+        # OpenCV resizes at most 512 channels at once
+        return np.concatenate([_resize_cv2(image[:, :, i:i + 512], size, interp)
+                               for i in range(0, image.shape[2], 512)], axis=2)
+    resized = cv2.resize(image, (size[1], size[0]), interpolation=flags)
+    if image.ndim == 3 and resized.ndim == 2:
+        # A single channel comes back without its channel dimension
+        resized = resized[:, :, np.newaxis]
+    return resized
+
+
+def _resize_torch(image, size, interp):
+    x = torch.from_numpy(np.ascontiguousarray(image))
+    x = x.view(x.size(0), x.size(1), -1).permute(2, 0, 1).unsqueeze(0).float()
+    if interp == "nearest":
+        # Same pixel centers as PIL
+        x = F.interpolate(x, size=tuple(size), mode="nearest-exact")
+    else:
+        x = F.interpolate(x, size=tuple(size), mode=interp, align_corners=False, antialias=True)
+    resized = x.round().clamp(0, 255).to(torch.uint8)[0].permute(1, 2, 0).numpy()
+    return resized[:, :, 0] if image.ndim == 2 else resized
+
+
+def imresize(image, size, interp='bilinear'):
+    """Resizes an image with the selected backend. Replaces
+    scipy.misc.imresize(), which was removed from SciPy, with the same
+    semantics: the image is converted to uint8 with bytescale() and the
+    result is uint8.
+
+    image: [height, width] or [height, width, channels]. Any number of
+        channels, e.g. a stack of masks, is resized at once.
+    size: (height, width) of the result.
+    interp: 'nearest', 'bilinear' or 'bicubic'.
+    """
+    image = bytescale(np.asarray(image))
+    size = (int(size[0]), int(size[1]))
+    if _resize_backend == "cv2":
+        return _resize_cv2(image, size, interp)
+    if _resize_backend == "torch":
+        return _resize_torch(image, size, interp)
+    return _resize_pil(image, size, interp)
+
+
+def resize_masks(masks, size):
+    """Bilinear resize of binary masks, thresholded at half.
+    masks: [height, width] or [height, width, count] of type bool.
+    size: (height, width) of the result.
+    Returns bool masks of the given size.
+
+    The masks are resized as 0/255 uint8 images, as scipy.misc.imresize()
+    did with float masks, except that masks that are all ones stay all
+    ones (bytescale() of a constant array is all zeros).
+    """
+    masks = np.asarray(masks)
+    if masks.dtype != np.uint8:
+        masks = masks.astype(bool).view(np.uint8)
+    return imresize(masks * np.uint8(255), size, interp='bilinear') >= 128
+
+
+def zoom_indices(size, new_size):
+    """Pixels that scipy.ndimage.zoom(order=0) picks along an axis of the
+    given size when resizing it to new_size. The centers of the first and
+    last pixels are aligned and the nearest pixel is taken, rounding half up.
+    Unlike zoom(), a last pixel that lands a rounding error past the edge
+    gets the edge pixel rather than zero.
+    """
+    zoom = (size - 1) / (new_size - 1) if new_size > 1 else 1.0
+    indices = np.floor(np.arange(new_size) * zoom + 0.5).astype(np.intp)
+    return np.minimum(indices, size - 1)
+
+
 def resize_image(image, min_dim=None, max_dim=None, padding=False):
     """
     Resizes an image keeping the aspect ratio.
@@ -302,8 +517,7 @@ def resize_image(image, min_dim=None, max_dim=None, padding=False):
             scale = max_dim / image_max
     # Resize image and mask
     if scale != 1:
-        image = scipy.misc.imresize(
-            image, (round(h * scale), round(w * scale)))
+        image = imresize(image, (round(h * scale), round(w * scale)))
     # Need padding?
     if padding:
         # Get new height and width
@@ -327,8 +541,12 @@ def resize_mask(mask, scale, padding):
     padding: Padding to add to the mask in the form
             [(top, bottom), (left, right), (0, 0)]
     """
+    # Same pixels as scipy.ndimage.zoom(mask, zoom=[scale, scale, 1], order=0),
+    # picked for all instances at once.
     h, w = mask.shape[:2]
-    mask = scipy.ndimage.zoom(mask, zoom=[scale, scale, 1], order=0)
+    new_h, new_w = int(round(h * scale)), int(round(w * scale))
+    if (new_h, new_w) != (h, w):
+        mask = mask[zoom_indices(h, new_h)[:, np.newaxis], zoom_indices(w, new_w)]
     mask = np.pad(mask, padding, mode='constant', constant_values=0)
     return mask
 
@@ -346,8 +564,7 @@ def minimize_mask(bbox, mask, mini_shape):
         m = m[y1:y2, x1:x2]
         if m.size == 0:
             raise Exception("Invalid bounding box with area of zero")
-        m = scipy.misc.imresize(m.astype(float), mini_shape, interp='bilinear')
-        mini_mask[:, :, i] = np.where(m >= 128, 1, 0)
+        mini_mask[:, :, i] = resize_masks(m, mini_shape)
     return mini_mask
 
 
@@ -363,8 +580,7 @@ def expand_mask(bbox, mini_mask, image_shape):
         y1, x1, y2, x2 = bbox[i][:4]
         h = y2 - y1
         w = x2 - x1
-        m = scipy.misc.imresize(m.astype(float), (h, w), interp='bilinear')
-        mask[y1:y2, x1:x2, i] = np.where(m >= 128, 1, 0)
+        mask[y1:y2, x1:x2, i] = resize_masks(m, (h, w))
     return mask
 
 
@@ -383,8 +599,7 @@ def unmold_mask(mask, bbox, image_shape):
     """
     threshold = 0.5
     y1, x1, y2, x2 = bbox
-    mask = scipy.misc.imresize(
-        mask, (y2 - y1, x2 - x1), interp='bilinear').astype(np.float32) / 255.0
+    mask = imresize(mask, (y2 - y1, x2 - x1), interp='bilinear').astype(np.float32) / 255.0
     mask = np.where(mask >= threshold, 1, 0).astype(np.uint8)
 
     # Put the mask in the right location.
@@ -393,6 +608,249 @@ def unmold_mask(mask, bbox, image_shape):
     return full_mask
 
 
+def bilinear_coefficients(in_size, out_size, length=None):
+    """Weights of PIL's bilinear filter resizing an axis of in_size pixels
+    to out_size pixels, in the fixed point PIL computes them in for 8 bit
+    images (see PIL_PRECISION_BITS).
+    length: Number of rows of the result, at least out_size. Rows past
+        out_size are zero.
+    Returns [length, in_size], where each row has the weights of the input
+    pixels for one output pixel.
+    """
+    length = length or out_size
+    scale = in_size / out_size
+    filterscale = max(scale, 1.0)
+    support = filterscale
+    center = (np.arange(out_size) + 0.5) * scale
+    xmin = np.maximum(np.trunc(center - support + 0.5), 0)[:, np.newaxis]
+    xmax = np.minimum(np.trunc(center + support + 0.5), in_size)[:, np.newaxis]
+    x = np.arange(in_size, dtype=np.float64)[np.newaxis]
+    weights = np.maximum(1.0 - np.abs((x - center[:, np.newaxis] + 0.5) * (1.0 / filterscale)), 0)
+    weights[(x < xmin) | (x >= xmax)] = 0
+    weights /= weights.sum(axis=1, keepdims=True)
+    coefficients = np.zeros([length, in_size])
+    coefficients[:out_size] = np.trunc(weights * (1 << PIL_PRECISION_BITS) + 0.5)
+    return coefficients
+
+
+def _pil_round(values):
+    """Rounds fixed point sums of bilinear_coefficients() to uint8 values
+    as PIL does, still as floats. The sums are exact in float64."""
+    values += 1 << (PIL_PRECISION_BITS - 1)
+    values /= 1 << PIL_PRECISION_BITS
+    return np.clip(np.floor(values, out=values), 0, 255, out=values)
+
+
+def _resize_crops_pil(masks, heights, widths, max_elements):
+    """Resizes masks to their box sizes at once, as two batched matrix
+    products with the bilinear filter of PIL. Gives the same crops as
+    imresize() with the pil backend.
+    Returns a list of N [height, width] bool arrays.
+    """
+    N, mask_height, mask_width = masks.shape[:3]
+
+    # Group masks of similar sizes, each group is resized on an array of
+    # the largest box of the group.
+    crops = [None] * N
+    order = np.argsort(heights * widths, kind="stable")
+    start = 0
+    while start < N:
+        end = start + 1
+        height, width = heights[order[start]], widths[order[start]]
+        while end < N:
+            h = max(height, heights[order[end]])
+            w = max(width, widths[order[end]])
+            if (end + 1 - start) * h * max(w, mask_width) > max_elements:
+                break
+            height, width = h, w
+            end += 1
+        ids = order[start:end]
+        start = end
+
+        # Same uint8 input as imresize()
+        resized = np.stack([bytescale(masks[i]) for i in ids]).astype(np.float64)
+        # PIL resizes horizontally first, rounding to uint8 in between
+        x_coefficients = np.stack([bilinear_coefficients(mask_width, widths[i], width)
+                                   for i in ids])
+        resized = _pil_round(np.matmul(resized, x_coefficients.transpose(0, 2, 1)))
+        y_coefficients = np.stack([bilinear_coefficients(mask_height, heights[i], height)
+                                   for i in ids])
+        resized = _pil_round(np.matmul(y_coefficients, resized))
+        for j, i in enumerate(ids):
+            # >= 0.5 after scaling to [0, 1], as in unmold_mask()
+            crops[i] = resized[j, :heights[i], :widths[i]] >= 128
+    return crops
+
+
+def unmold_masks(masks, boxes, image_shape, mask_format="full",
+                 max_elements=UNMOLD_MAX_ELEMENTS):
+    """Batched unmold_mask(), gives the same masks with any resize backend.
+    With the pil backend, all the masks are resized to their boxes at once
+    with PIL's bilinear filter. Other backends resize them one by one with
+    imresize().
+    masks: [N, height, width] of type float. Small, typically 28x28, masks.
+    boxes: [N, (y1, x1, y2, x2)]. The boxes to fit the masks in.
+    image_shape: [height, width, ...] of the original image.
+    mask_format: How to return the masks:
+        "full": [height, width, N] uint8 binary masks of the size of the image.
+        "crop": A list of N [y2 - y1, x2 - x1] bool arrays, the part of each
+                mask inside its box. The masks are zero outside their box.
+        "rle":  A list of N uncompressed COCO RLEs. See rle_encode().
+    max_elements: Max number of elements of the temporary arrays of the pil
+        backend. Masks are resized in groups of similar sizes that fit.
+    """
+    if mask_format not in ["full", "crop", "rle"]:
+        raise ValueError("Unknown mask format '{}'".format(mask_format))
+    N = masks.shape[0]
+    heights = boxes[:, 2] - boxes[:, 0]
+    widths = boxes[:, 3] - boxes[:, 1]
+
+    if get_resize_backend() == "pil":
+        crops = _resize_crops_pil(masks, heights, widths, max_elements)
+    else:
+        # The filters of cv2 and torch differ from PIL's
+        crops = [imresize(masks[i], (heights[i], widths[i]), interp='bilinear') >= 128
+                 for i in range(N)]
+
+    if mask_format == "crop":
+        return crops
+    if mask_format == "rle":
+        return [rle_encode_crop(crop, box, image_shape) for crop, box in zip(crops, boxes)]
+    full_masks = np.zeros(tuple(image_shape[:2]) + (N,), dtype=np.uint8)
+    for i, (y1, x1, y2, x2) in enumerate(boxes):
+        full_masks[y1:y2, x1:x2, i] = crops[i]
+    return full_masks
+
+
+############################################################
+#  Run-length encoding
+############################################################
+
+def rle_encode(mask):
+    """Encodes a binary mask as an uncompressed COCO RLE: the lengths of
+    alternating runs of zeros and ones, starting with zeros, in column
+    major order. pycocotools.mask.frPyObjects() reads it.
+    mask: [height, width]
+    Returns {"size": [height, width], "counts": [...]}
+    """
+    height, width = mask.shape[:2]
+    return rle_encode_crop(mask, (0, 0, height, width), mask.shape)
+
+
+def rle_encode_crop(crop, box, image_shape):
+    """rle_encode() of a mask that is zero outside of a box, from the part
+    of the mask inside the box, without building the full mask.
+    crop: [y2 - y1, x2 - x1] the mask inside the box.
+    box: (y1, x1, y2, x2) in the image.
+    image_shape: [height, width, ...] of the full mask.
+    """
+    y1, x1, y2, x2 = [int(c) for c in box]
+    height, width = int(image_shape[0]), int(image_shape[1])
+    crop_height = y2 - y1
+    # Columns of the crop one after the other, each with a zero above and
+    # below so that runs of ones start and end within their column.
+    columns = np.zeros([x2 - x1, crop_height + 2], dtype=np.int8)
+    columns[:, 1:-1] = np.asarray(crop, dtype=bool).T
+    changes = np.diff(columns.ravel())
+    starts = np.nonzero(changes == 1)[0] + 1
+    ends = np.nonzero(changes == -1)[0] + 1
+    # Positions in the column major full mask
+    starts = (x1 + starts // (crop_height + 2)) * height + y1 + starts % (crop_height + 2) - 1
+    ends = (x1 + ends // (crop_height + 2)) * height + y1 + ends % (crop_height + 2) - 1
+    # A run that ends at the bottom of the image goes on at the top of the
+    # next column if the box spans the full height.
+    joined = ends[:-1] == starts[1:]
+    starts = starts[np.append(True, ~joined)] if len(starts) else starts
+    ends = ends[np.append(~joined, True)] if len(ends) else ends
+    bounds = np.stack([starts, ends], axis=1).ravel()
+    counts = np.diff(np.concatenate([[0], bounds, [height * width]]))
+    if len(counts) > 1 and counts[-1] == 0:
+        # The mask ends with ones
+        counts = counts[:-1]
+    return {"size": [height, width], "counts": counts.tolist()}
+
+
+def rle_decode(rle):
+    """Decodes an uncompressed RLE of rle_encode().
+    Returns a [height, width] uint8 binary mask.
+    """
+    height, width = rle["size"]
+    counts = np.asarray(rle["counts"], dtype=np.intp)
+    values = (np.arange(len(counts)) % 2).astype(np.uint8)
+    return np.repeat(values, counts).reshape(width, height).T
+
+
+############################################################
+#  Detections
+############################################################
+
+class Detection(object):
+    """A detected instance, as returned by MaskRCNN.detect(as_detections=True).
+    Keeps the mask either as an RLE or as the bitmap of its box, and only
+    builds the mask of the size of the image when .mask is read.
+
+    box: (y1, x1, y2, x2) in pixels of the original image.
+    class_id: Integer class ID.
+    score: Float probability score of the class ID.
+    image_shape: [height, width, ...] of the original image.
+    rle: Uncompressed COCO RLE of the mask, see rle_encode().
+    crop: [y2 - y1, x2 - x1] bool mask inside the box. Zero outside.
+    """
+    __slots__ = ["box", "class_id", "score", "image_shape", "rle", "crop"]
+
+    def __init__(self, box, class_id, score, image_shape, rle=None, crop=None):
+        assert (rle is None) != (crop is None), "Give either an RLE or a crop"
+        self.box = box
+        self.class_id = class_id
+        self.score = score
+        self.image_shape = tuple(image_shape[:2])
+        self.rle = rle
+        self.crop = crop
+
+    @property
+    def bitmap(self):
+        """[y2 - y1, x2 - x1] bool mask inside the box."""
+        if self.crop is not None:
+            return self.crop
+        y1, x1, y2, x2 = self.box
+        return rle_decode(self.rle)[y1:y2, x1:x2].astype(bool)
+
+    @property
+    def mask(self):
+        """[height, width] uint8 binary mask of the size of the image. Built
+        on every access, keep the result rather than reading it again."""
+        if self.rle is not None:
+            return rle_decode(self.rle)
+        y1, x1, y2, x2 = self.box
+        mask = np.zeros(self.image_shape, dtype=np.uint8)
+        mask[y1:y2, x1:x2] = self.crop
+        return mask
+
+    def to_rle(self):
+        """Uncompressed COCO RLE of the mask."""
+        if self.rle is not None:
+            return self.rle
+        return rle_encode_crop(self.crop, self.box, self.image_shape)
+
+    def __repr__(self):
+        return "Detection(box={}, class_id={}, score={:.3f})".format(
+            [int(c) for c in self.box], self.class_id, self.score)
+
+
+def build_detections(boxes, class_ids, scores, masks, image_shape):
+    """Detection objects of the results of MaskRCNN.unmold_detections().
+    masks: A list of crops or of RLEs, see unmold_masks().
+    Returns a list of Detection.
+    """
+    detections = []
+    for box, class_id, score, mask in zip(boxes, class_ids, scores, masks):
+        if isinstance(mask, dict):
+            detections.append(Detection(box, class_id, score, image_shape, rle=mask))
+        else:
+            detections.append(Detection(box, class_id, score, image_shape, crop=mask))
+    return detections
+
+
 ############################################################
 #  Anchors
 ############################################################
@@ -130,24 +130,78 @@ def display_instances(image, boxes, masks, class_ids, class_names, path_to_save,
                 color='w', size=11, backgroundcolor="none")
 
         # Mask
-        mask = masks[:, :, i]
-        masked_image = apply_mask(masked_image, mask, color)
-
-        # Mask Polygon
-        # Pad to ensure proper polygons for masks that touch image edges.
-        padded_mask = np.zeros(
-            (mask.shape[0] + 2, mask.shape[1] + 2), dtype=np.uint8)
-        padded_mask[1:-1, 1:-1] = mask
-        contours = find_contours(padded_mask, 0.5)
-        for verts in contours:
-            # Subtract the padding and flip (y, x) to (x, y)
-            verts = np.fliplr(verts) - 1
-            p = Polygon(verts, facecolor="none", edgecolor=color)
-            ax.add_patch(p)
+        draw_mask(ax, masked_image, masks[:, :, i], color)
     ax.imshow(masked_image.astype(np.uint8))
     plt.savefig(path_to_save)
     #plt.show()
-    
+
+
+def draw_mask(ax, masked_image, mask, color, offset=(0, 0)):
+    """Applies a mask to the image in place and draws its outline.
+    mask: [height, width] mask of the part of the image at offset.
+    offset: (y, x) of the top left corner of the mask in the image.
+    """
+    y, x = offset
+    apply_mask(masked_image[y:y + mask.shape[0], x:x + mask.shape[1]], mask, color)
+
+    # Mask Polygon
+    # Pad to ensure proper polygons for masks that touch image edges.
+    padded_mask = np.zeros(
+        (mask.shape[0] + 2, mask.shape[1] + 2), dtype=np.uint8)
+    padded_mask[1:-1, 1:-1] = mask
+    contours = find_contours(padded_mask, 0.5)
+    for verts in contours:
+        # Subtract the padding and flip (y, x) to (x, y)
+        verts = np.fliplr(verts) - 1 + [x, y]
+        p = Polygon(verts, facecolor="none", edgecolor=color)
+        ax.add_patch(p)
+
+
+def display_detections(image, detections, class_names, path_to_save, title="",
+                       figsize=(16, 16), ax=None):
+    """Same as display_instances() for the utils.Detection objects of
+    MaskRCNN.detect(as_detections=True). Only draws the masks inside their
+    boxes, never the masks of the size of the image.
+    detections: list of utils.Detection
+    class_names: list of class names of the dataset
+    figsize: (optional) the size of the image.
+    """
+    N = len(detections)
+    if not N:
+        print("\n*** No instances to display *** \n")
+
+    if not ax:
+        _, ax = plt.subplots(1, figsize=figsize)
+
+    # Generate random colors
+    colors = random_colors(N)
+
+    # Show area outside image boundaries.
+    height, width = image.shape[:2]
+    ax.set_ylim(height + 10, -10)
+    ax.set_xlim(-10, width + 10)
+    ax.axis('off')
+    ax.set_title(title)
+
+    masked_image = image.astype(np.uint32).copy()
+    for detection, color in zip(detections, colors):
+        # Bounding box
+        y1, x1, y2, x2 = detection.box
+        p = patches.Rectangle((x1, y1), x2 - x1, y2 - y1, linewidth=2,
+                              alpha=0.7, linestyle="dashed",
+                              edgecolor=color, facecolor='none')
+        ax.add_patch(p)
+
+        # Label
+        caption = "{} {:.3f}".format(class_names[detection.class_id], detection.score)
+        ax.text(x1, y1 + 8, caption,
+                color='w', size=11, backgroundcolor="none")
+
+        # Mask
+        draw_mask(ax, masked_image, detection.bitmap, color, offset=(y1, x1))
+    ax.imshow(masked_image.astype(np.uint8))
+    plt.savefig(path_to_save)
+
 
 def draw_rois(image, rois, refined_rois, mask, class_ids, class_names, limit=10):
     """